@@ -1,17 +1,26 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, request, jsonify, send_from_directory, render_template, g, Response, stream_with_context
 import os
+import io
+import csv
+import json
+import itertools
+import time
+import zlib
 import logging
-from datetime import datetime, timedelta
-from db_utils import Database
+import threading
+from datetime import datetime
+from db_utils import Database, EXPORT_COLUMNS
+from log_utils import setup_logging
+from sweep_archive import SweepArchive, summarize_results
+from snapshot import SnapshotStore, SNAPSHOT_PATH
+from time_utils import convert_to_jakarta_time
+import metrics
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(
-    level=logging.ERROR,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Di api.py
@@ -20,24 +29,53 @@ app = Flask(__name__,
         template_folder=os.path.join(current_dir, 'templates'),
         static_folder=os.path.join(current_dir, 'static'))
 
-def convert_to_jakarta_time(timestamp_str):
-    """Convert a timestamp string to Jakarta time (UTC+7)"""
-    if not timestamp_str:
-        return timestamp_str
-        
-    try:
-        # Check if timestamp is already in Jakarta time
-        if datetime.now().astimezone().utcoffset() == timedelta(hours=7):
-            # System is already in Jakarta timezone
-            return timestamp_str
-        else:
-            # Convert UTC time to Jakarta time
-            dt = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-            jakarta_dt = dt + timedelta(hours=7)
-            return jakarta_dt.strftime('%Y-%m-%d %H:%M:%S')
-    except Exception as e:
-        logger.error(f"Error converting timestamp to Jakarta time: {e}")
-        return timestamp_str
+# Local sweep archive written by main.py, served when the database is unreachable
+archive = SweepArchive()
+
+# 'combined' runs the sweeper inside the API process (one gunicorn worker) and
+# serves the latest rows and the latest-sweep summary from its snapshot
+SWEEP_MODE = os.getenv('SWEEP_MODE', 'serial')
+
+# Latest-state snapshot published by the combined sweeper after each sweep
+snapshots = SnapshotStore()
+
+def archived_logs(fields, limit, offset, site_name=None):
+    """Rows of the latest archived sweep, shaped like the ping_logs query results"""
+    results = archive.read_sweep()
+    if site_name:
+        results = [result for result in results if result.get('site_name') == site_name]
+    results.sort(key=lambda result: result.get('timestamp') or '', reverse=True)
+    return [{field: result.get(field) for field in fields} for result in results[offset:offset + limit]]
+
+def snapshot_page(section, limit, offset):
+    """Pre-serialized response for a page of the latest sweep's rows, or None outside combined mode or without a fresh snapshot"""
+    if SWEEP_MODE != 'combined':
+        return None
+    snapshot = snapshots.latest()
+    if snapshot is None:
+        return None
+    page, count = snapshot.page(section, limit, offset)
+    if not count and offset:
+        # Pages past the latest sweep come from the database
+        return None
+    meta = json.dumps({'total': count, 'limit': limit, 'offset': offset, 'source': 'snapshot'})
+    body = b'{"status":"success","data":' + page + b',"meta":' + meta.encode('utf-8') + b'}'
+    return Response(body, mimetype='application/json')
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(response):
+    """Record per-route request latency"""
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - start, route, request.method, str(response.status_code)
+        )
+    return response
 
 @app.route('/', methods=['GET'])
 def index():
@@ -50,7 +88,8 @@ def index():
 @app.route('/dashboard', methods=['GET'])
 def serve_dashboard():
     """Serve the dashboard HTML page"""
-    return render_template('index.html')
+    # In combined mode the latest sweep's summary (hours=0) is served from the snapshot
+    return render_template('index.html', summary_hours=0 if SWEEP_MODE == 'combined' else 24)
 
 @app.route('/ping_logs', methods=['GET'])
 def get_ping_logs():
@@ -61,7 +100,19 @@ def get_ping_logs():
         offset = request.args.get('offset', default=0, type=int)
         site_name = request.args.get('site_name')
         
+        if not site_name:
+            cached = snapshot_page('ping_logs', limit, offset)
+            if cached is not None:
+                return cached
+        
         logs = Database.get_ping_logs(limit, offset, site_name)
+        source = 'database'
+        if not logs and not Database.check_connection():
+            logs = archived_logs(
+                ('timestamp', 'pr_code', 'site_name', 'ip_address', 'battery_version', 'ping_success', 'ping_time_ms', 'upstream_down'),
+                limit, offset, site_name
+            )
+            source = 'archive'
         
         # convert time from utc to Jakarta time
         for log in logs:
@@ -76,7 +127,8 @@ def get_ping_logs():
             'meta': {
                 'total': total_count,
                 'limit': limit,
-                'offset': offset
+                'offset': offset,
+                'source': source
             }
         })
     except Exception as e:
@@ -93,17 +145,28 @@ def get_summary():
         # Parse request parameters
         hours = request.args.get('hours', default=24, type=int)
         
+        if hours == 0 and SWEEP_MODE == 'combined':
+            # hours=0 asks for the latest sweep, served from the combined sweeper's snapshot
+            snapshot = snapshots.latest()
+            if snapshot is not None:
+                return Response(snapshot.section('summary'), mimetype='application/json')
+        
         # Get summary data from the database
         summary = Database.get_summary(hours)
         
+        if not summary and not Database.check_connection():
+            # Serve the latest archived sweep while the database is down
+            summary, down_sites = archived_summary()
+        
         if not summary:
             return jsonify({
                 'status': 'error',
                 'message': 'Failed to fetch summary data'
             }), 500
         
-        # Add pr_code with issue
-        down_sites = Database.get_down_sites(hours)
+        if summary.get('source') != 'archive':
+            # Add pr_code with issue
+            down_sites = Database.get_down_sites(hours)
         
         # convert last_check from utc to Jakarta time
         for site in down_sites:
@@ -124,6 +187,95 @@ def get_summary():
             'message': str(e)
         }), 500
 
+def archived_summary():
+    """Summary and down sites computed from the latest archived sweep"""
+    results = archive.read_sweep()
+    if not results:
+        return {}, []
+    
+    summary = summarize_results(results)
+    summary['time_period'] = 'Latest archived sweep'
+    summary['timestamp'] = max(result.get('timestamp') or '' for result in results)
+    summary['source'] = 'archive'
+    
+    down_sites = [
+        {
+            'pr_code': result.get('pr_code'),
+            'site_name': result.get('site_name'),
+            'ip_address': result.get('ip_address'),
+            'battery_version': result.get('battery_version'),
+            'last_check': result.get('timestamp'),
+            'outage_group': result.get('outage_group'),
+            'upstream_down': bool(result.get('upstream_down'))
+        }
+        for result in sorted(results, key=lambda result: result.get('site_name') or '')
+        if not result.get('ping_success')
+    ]
+    return summary, down_sites
+
+@app.route('/ping_logs/flapping', methods=['GET'])
+def get_flapping_sites():
+    """API endpoint to get flapping or degrading sites from the sweeper's health records"""
+    try:
+        limit = request.args.get('limit', default=100, type=int)
+        sites = Database.get_site_health(('flapping', 'degrading'), limit)
+        
+        for site in sites:
+            for field in ('last_change', 'last_probe'):
+                if site[field] is not None:
+                    site[field] = convert_to_jakarta_time(
+                        datetime.fromtimestamp(site[field]).strftime('%Y-%m-%d %H:%M:%S')
+                    )
+            for field in ('ewma_rtt_ms', 'baseline_rtt_ms'):
+                if site[field] is not None:
+                    site[field] = round(site[field], 2)
+            del site['transition_times']
+        
+        return jsonify({
+            'status': 'success',
+            'data': sites,
+            'meta': {
+                'total': len(sites),
+                'limit': limit
+            }
+        })
+    except Exception as e:
+        logger.error(f"Error in API Flapping: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/ping_logs/outages', methods=['GET'])
+def get_group_outages():
+    """API endpoint to get upstream group outages detected by the sweeper's sentinels"""
+    try:
+        hours = request.args.get('hours', default=24, type=int)
+        limit = request.args.get('limit', default=100, type=int)
+        outages = Database.get_group_outages(hours, limit)
+        
+        for outage in outages:
+            for field in ('started_at', 'last_seen_at', 'ended_at'):
+                outage[field] = convert_to_jakarta_time(outage[field])
+            outage['active'] = outage['ended_at'] is None
+        
+        return jsonify({
+            'status': 'success',
+            'data': outages,
+            'meta': {
+                'total': len(outages),
+                'active': sum(1 for outage in outages if outage['active']),
+                'hours': hours,
+                'limit': limit
+            }
+        })
+    except Exception as e:
+        logger.error(f"Error in API Outages: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
 @app.route('/length_loggers', methods=['GET'])
 def get_length_loggers():
     """API endpoint to get length loggers"""
@@ -133,7 +285,19 @@ def get_length_loggers():
         offset = request.args.get('offset', default=0, type=int)
         site_name = request.args.get('site_name')
         
+        if not site_name:
+            cached = snapshot_page('length_loggers', limit, offset)
+            if cached is not None:
+                return cached
+        
         logs = Database.get_length_loggers(limit, offset, site_name)
+        source = 'database'
+        if not logs and not Database.check_connection():
+            logs = archived_logs(
+                ('timestamp', 'pr_code', 'site_name', 'ip_address', 'battery_version', 'length_loggers'),
+                limit, offset, site_name
+            )
+            source = 'archive'
         
         # convert time from utc to Jakarta time
         for log in logs:
@@ -148,7 +312,8 @@ def get_length_loggers():
             'meta': {
                 'total': total_count,
                 'limit': limit,
-                'offset': offset
+                'offset': offset,
+                'source': source
             }
         })
     except Exception as e:
@@ -158,6 +323,241 @@ def get_length_loggers():
             'message': str(e)
         }), 500
 
+@app.route('/sweep_runs/slow_sites', methods=['GET'])
+def get_slow_sites():
+    """API endpoint to get the slowest sites and stages across recent sweep runs"""
+    try:
+        # Parse query parameters
+        runs = request.args.get('runs', default=10, type=int)
+        limit = request.args.get('limit', default=20, type=int)
+        
+        report = Database.get_slow_sites(runs, limit)
+        
+        if not report:
+            return jsonify({
+                'status': 'error',
+                'message': 'Failed to fetch sweep run data'
+            }), 500
+        
+        # convert run times from utc to Jakarta time
+        for run in report['runs']:
+            run['started_at'] = convert_to_jakarta_time(run['started_at'])
+            run['finished_at'] = convert_to_jakarta_time(run['finished_at'])
+        
+        return jsonify({
+            'status': 'success',
+            'data': report,
+            'meta': {
+                'runs': runs,
+                'limit': limit
+            }
+        })
+    except Exception as e:
+        logger.error(f"Error in API Slow Sites: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/archive/sweeps', methods=['GET'])
+def get_archived_sweeps():
+    """API endpoint to list sweeps in the local sweep archive"""
+    try:
+        limit = request.args.get('limit', default=20, type=int)
+        sweeps = archive.list_sweeps(limit)
+        
+        for sweep in sweeps:
+            sweep['swept_at'] = datetime.fromtimestamp(sweep['swept_at']).strftime('%Y-%m-%d %H:%M:%S')
+        
+        return jsonify({
+            'status': 'success',
+            'data': sweeps,
+            'meta': {
+                'total': len(sweeps),
+                'limit': limit
+            }
+        })
+    except Exception as e:
+        logger.error(f"Error in API Archive: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/archive/sweeps/<sweep_id>', methods=['GET'])
+def get_archived_sweep(sweep_id):
+    """API endpoint to get one archived sweep ('latest' or a sweep id), optionally for one site"""
+    try:
+        pr_code = request.args.get('pr_code')
+        target = None if sweep_id == 'latest' else int(sweep_id)
+        
+        if pr_code:
+            result = archive.find_site(pr_code, target)
+            data = [result] if result else []
+        else:
+            data = archive.read_sweep(target)
+        
+        if not data:
+            return jsonify({
+                'status': 'error',
+                'message': 'Sweep or site not found in archive'
+            }), 404
+        
+        return jsonify({
+            'status': 'success',
+            'data': data,
+            'meta': {
+                'total': len(data)
+            }
+        })
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'Invalid sweep id'
+        }), 400
+    except Exception as e:
+        logger.error(f"Error in API Archive: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+# Rows fetched from the server-side cursor per chunk of an export
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', 1000))
+
+def encode_rows(kind, export_format, chunks):
+    """Encode row chunks as CSV (with a header) or NDJSON, one bytes block per chunk"""
+    columns = EXPORT_COLUMNS[kind]
+    timestamp_column = columns.index('timestamp')
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue().encode('utf-8')
+    for rows in chunks:
+        # Stored timestamps are converted like every other endpoint's
+        rows = [
+            row[:timestamp_column] + (convert_to_jakarta_time(row[timestamp_column]),) + row[timestamp_column + 1:]
+            for row in rows
+        ]
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows(rows)
+            yield buffer.getvalue().encode('utf-8')
+        else:
+            yield ''.join(
+                json.dumps(dict(zip(columns, row)), default=str) + '\n' for row in rows
+            ).encode('utf-8')
+
+def gzip_stream(blocks):
+    """Gzip a stream of byte blocks, flushing after each so the client receives data as it comes"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for block in blocks:
+        data = compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/export/<kind>', methods=['GET'])
+def export(kind):
+    """API endpoint to stream ping_logs or length_loggers rows as CSV or NDJSON"""
+    try:
+        if kind not in EXPORT_COLUMNS:
+            return jsonify({
+                'status': 'error',
+                'message': f"Unknown export '{kind}', expected one of: {', '.join(EXPORT_COLUMNS)}"
+            }), 404
+        
+        export_format = request.args.get('format', default='csv')
+        if export_format not in ('csv', 'ndjson'):
+            return jsonify({
+                'status': 'error',
+                'message': "format must be 'csv' or 'ndjson'"
+            }), 400
+        use_gzip = request.args.get('gzip', default='false').lower() in ('1', 'true', 'yes')
+        
+        chunks = Database.stream_ping_logs(
+            kind,
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            site_name=request.args.get('site_name'),
+            pr_code=request.args.get('pr_code'),
+            chunk_size=EXPORT_CHUNK_ROWS,
+        )
+        # Fetch the first chunk now, so connection and query errors are a 500 before the response starts
+        first = next(chunks, None)
+        if first is not None:
+            chunks = itertools.chain([first], chunks)
+        body = encode_rows(kind, export_format, chunks)
+        filename = f"{kind}.{export_format}"
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        if use_gzip:
+            body = gzip_stream(body)
+            filename += '.gz'
+            mimetype = 'application/gzip'
+        
+        return Response(
+            stream_with_context(body),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
+    except Exception as e:
+        logger.error(f"Error in API Export: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics endpoint"""
+    return Response(metrics.generate_latest(), mimetype=metrics.CONTENT_TYPE_LATEST)
+
+# Lock file held by the worker running the combined sweeper
+sweeper_lock = None
+
+def start_combined_sweeper():
+    """
+    Run the sweeper in a background thread of this process (SWEEP_MODE=combined)
+    
+    Under gunicorn every worker imports this module; a lock next to the snapshot
+    file lets only the first one sweep, and the others map its snapshot file.
+    Combined mode needs SNAPSHOT_PATH, since the file is both the lock and the
+    way other workers see the snapshot.
+    """
+    global sweeper_lock
+    if not SNAPSHOT_PATH:
+        logger.error("SWEEP_MODE=combined needs SNAPSHOT_PATH; the sweeper is not started")
+        return None
+    try:
+        import fcntl
+    except ImportError:
+        logger.error("SWEEP_MODE=combined needs file locking (fcntl); the sweeper is not started")
+        return None
+    
+    directory = os.path.dirname(SNAPSHOT_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    lock_file = open(f"{SNAPSHOT_PATH}.lock", 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        logger.info("Combined sweeper already running in another worker")
+        return None
+    sweeper_lock = lock_file
+    
+    # main only configures its own log file when run as a script, so the API keeps its logging
+    import main
+    thread = threading.Thread(target=main.run_combined, args=(snapshots,), name='combined-sweeper', daemon=True)
+    thread.start()
+    logger.info(f"Combined sweeper started in process {os.getpid()}")
+    return thread
+
+if SWEEP_MODE == 'combined':
+    start_combined_sweeper()
+
 
 if __name__ == '__main__':
     logger.info("Starting Ping Data Logger Tracker API...")
@@ -1,9 +1,11 @@
 import os
 import logging
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json, execute_values
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+from metrics import instrument_query, instrument_connect
+from rtt_sketch import RttSketch, merge_sketches, percentiles, RTT_SKETCH_BUCKET_SECONDS, FLEET
 
 load_dotenv()
 
@@ -16,8 +18,221 @@ DB_NAME = os.getenv('DB_NAME', 'ping_logs_db')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', '')
 
+# Advisory lock key serializing creation of distributed sweeps
+SWEEP_LOCK_KEY = 7310421
+# Advisory lock key serializing read-merge-write of RTT sketches
+RTT_SKETCH_LOCK_KEY = 7310422
+
+# Columns of ping_logs per kind, for the /ping_logs and /length_loggers listings and exports
+EXPORT_COLUMNS = {
+    'ping_logs': ('timestamp', 'pr_code', 'site_name', 'ip_address', 'battery_version', 'ping_success', 'ping_time_ms', 'upstream_down'),
+    'length_loggers': ('timestamp', 'pr_code', 'site_name', 'ip_address', 'battery_version', 'length_loggers'),
+}
+
+# Read queries of the Database methods. They are module constants (or built by
+# the functions below) so test_query_plans.py explains exactly what the API runs.
+
+PR_CODE_LOOKUP_QUERY = "SELECT id from ping_logs WHERE pr_code = %s LIMIT 1"
+
+SUMMARY_TOTAL_SITES_QUERY = """
+    SELECT COUNT(DISTINCT pr_code) AS total_sites
+    FROM ping_logs
+    WHERE timestamp >= %s
+"""
+
+# Sites currently up, and those not probed behind a group outage (based on most recent ping)
+SUMMARY_SITES_UP_QUERY = """
+    WITH recent_pings AS (
+        SELECT 
+            pr_code,
+            ping_success,
+            upstream_down,
+            ROW_NUMBER() OVER (PARTITION BY pr_code ORDER BY timestamp DESC) AS rn
+        FROM ping_logs
+        WHERE timestamp >= %s
+    )
+    SELECT
+        COUNT(*) FILTER (WHERE ping_success = TRUE) AS sites_up,
+        COUNT(*) FILTER (WHERE upstream_down) AS sites_upstream_down
+    FROM recent_pings
+    WHERE rn = 1
+"""
+
+SUMMARY_RESPONSE_TIME_QUERY = """
+    SELECT AVG(ping_time_ms) AS avg_response_time
+    FROM ping_logs
+    WHERE timestamp >= %s AND ping_success = TRUE AND ping_time_ms IS NOT NULL
+"""
+
+SUMMARY_LOGGERS_QUERY = """
+    WITH recent_loggers AS (
+        SELECT 
+            pr_code,
+            length_loggers,
+            ROW_NUMBER() OVER (PARTITION BY pr_code ORDER BY timestamp DESC) AS rn
+        FROM ping_logs
+        WHERE timestamp >= %s AND length_loggers IS NOT NULL
+    )
+    SELECT COUNT(*) AS sites_with_loggers,
+    AVG(length_loggers) AS avg_loggers_per_site
+    FROM recent_loggers
+    WHERE rn = 1 AND length_loggers > 0
+"""
+
+SUMMARY_UPTIME_QUERY = """
+    SELECT 
+        pr_code,
+        AVG(CASE WHEN ping_success = TRUE THEN 1 ELSE 0 END) * 100 AS uptime_percentage
+    FROM ping_logs
+    WHERE timestamp >= %s
+    GROUP BY pr_code
+"""
+
+# Fleet sketches of every bucket in the summary window
+SUMMARY_SKETCHES_QUERY = """
+    SELECT sketch
+    FROM rtt_sketches
+    WHERE pr_code = %s AND bucket_start >= %s
+"""
+
+# Down sites based on most recent ping; upstream_down is set on the rows of
+# sites that were not probed behind a group outage
+DOWN_SITES_QUERY = """
+    WITH recent_pings AS (
+        SELECT 
+            pr_code,
+            site_name,
+            ip_address,
+            battery_version,
+            ping_success,
+            upstream_down,
+            timestamp,
+            ROW_NUMBER() OVER (PARTITION BY pr_code ORDER BY timestamp DESC) AS rn
+        FROM ping_logs
+        WHERE timestamp >= %s
+    )
+    SELECT 
+        r.pr_code,
+        r.site_name,
+        r.ip_address,
+        r.battery_version,
+        r.timestamp AS last_check,
+        o.group_key AS outage_group,
+        COALESCE(r.upstream_down, FALSE) AS upstream_down
+    FROM recent_pings r
+    LEFT JOIN group_outages o ON o.ended_at IS NULL AND r.pr_code = ANY(o.sites)
+    WHERE r.rn = 1 AND r.ping_success = FALSE
+    ORDER BY r.site_name
+"""
+
+RECENT_RUNS_QUERY = """
+    SELECT id, started_at, finished_at, concurrency, total_sites,
+           successful_sites, failed_sites, reachable_sites,
+           EXTRACT(EPOCH FROM (finished_at - started_at)) AS duration_seconds
+    FROM sweep_runs
+    ORDER BY id DESC
+    LIMIT %s
+"""
+
+# Slowest sites by average total time, with the stage that dominates
+SLOW_SITES_QUERY = """
+    SELECT
+        s.pr_code,
+        MAX(p.site_name) AS site_name,
+        COUNT(DISTINCT s.run_id) AS runs,
+        ROUND(AVG(s.total_ms))::INTEGER AS avg_total_ms,
+        MAX(s.total_ms) AS max_total_ms,
+        ROUND(AVG(s.ping_ms))::INTEGER AS avg_ping_ms,
+        ROUND(AVG(s.fallback_ms))::INTEGER AS avg_fallback_ms,
+        ROUND(AVG(s.logger_ms))::INTEGER AS avg_logger_ms,
+        ROUND(AVG(s.db_ms))::INTEGER AS avg_db_ms
+    FROM sweep_site_spans s
+    LEFT JOIN ping_logs p ON p.pr_code = s.pr_code
+    WHERE s.run_id = ANY(%s)
+    GROUP BY s.pr_code
+    ORDER BY AVG(s.total_ms) DESC
+    LIMIT %s
+"""
+
+# Share of sweep time spent in each stage
+SLOW_STAGES_QUERY = """
+    SELECT stage, SUM(ms)::BIGINT AS total_ms, ROUND(AVG(ms))::INTEGER AS avg_ms, MAX(ms) AS max_ms, COUNT(ms) AS samples
+    FROM sweep_site_spans s
+    CROSS JOIN LATERAL (VALUES
+        ('ping', s.ping_ms),
+        ('fallback', s.fallback_ms),
+        ('logger', s.logger_ms),
+        ('db', s.db_ms)
+    ) AS stages(stage, ms)
+    WHERE s.run_id = ANY(%s) AND ms IS NOT NULL
+    GROUP BY stage
+    ORDER BY SUM(ms) DESC
+"""
+
+GROUP_OUTAGES_QUERY = """
+    SELECT group_key, started_at, last_seen_at, ended_at, sentinels, sites,
+           cardinality(sites) AS site_count
+    FROM group_outages
+    WHERE ended_at IS NULL OR ended_at >= NOW() - %s * INTERVAL '1 hour'
+    ORDER BY ended_at IS NULL DESC, started_at DESC
+    LIMIT %s
+"""
+
+def listing_query(kind, limit=100, offset=0, site_name=None):
+    """(query, params) of the latest-first /ping_logs or /length_loggers listing"""
+    query = f"SELECT {', '.join(EXPORT_COLUMNS[kind])} FROM ping_logs"
+    params = []
+    
+    conditions = []
+    if site_name:
+        conditions.append("site_name = %s")
+        params.append(site_name)
+    
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+        
+    query += " ORDER BY timestamp DESC LIMIT %s OFFSET %s"
+    params.extend([limit, offset])
+    return query, params
+
+def export_query(kind, since=None, until=None, site_name=None, pr_code=None):
+    """(query, params) of an oldest-first export; length_loggers exports only rows with a logger count"""
+    conditions = []
+    params = []
+    if kind == 'length_loggers':
+        conditions.append("length_loggers IS NOT NULL")
+    for condition, value in (("timestamp >= %s", since), ("timestamp < %s", until),
+                             ("site_name = %s", site_name), ("pr_code = %s", pr_code)):
+        if value:
+            conditions.append(condition)
+            params.append(value)
+    
+    query = f"SELECT {', '.join(EXPORT_COLUMNS[kind])} FROM ping_logs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY timestamp"
+    return query, params
+
+def site_health_query(statuses=None, limit=None):
+    """(query, params) of checkpointed site health records, most unstable first"""
+    query = """
+        SELECT pr_code, site_name, ip_address, up, ewma_rtt_ms, baseline_rtt_ms, consecutive_failures,
+               transition_times, recent_transitions, last_change, last_probe, probes, status, probe_method
+        FROM site_health
+    """
+    params = []
+    if statuses:
+        query += " WHERE status = ANY(%s)"
+        params.append(list(statuses))
+    query += " ORDER BY recent_transitions DESC, ewma_rtt_ms DESC NULLS LAST"
+    if limit:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
 class Database:
     @staticmethod
+    @instrument_connect
     def get_connection():
         """Get a connection to the PostgreSQL database."""
         try:
@@ -30,10 +245,25 @@ class Database:
             )
             return connection
         except Exception as e:
-            logger.error(f"Error connecting to the database: {e}")
+            logger.error("Error connecting to the database: %s", e)
             raise
     
     @staticmethod
+    @instrument_query
+    def check_connection():
+        """Return True if the database is reachable"""
+        connection = None
+        try:
+            connection = Database.get_connection()
+            return True
+        except psycopg2.Error:
+            return False
+        finally:
+            if connection:
+                connection.close()
+    
+    @staticmethod
+    @instrument_query
     def create_tables():
         """Create necessary tables if they don't exist"""
         connection = None
@@ -66,7 +296,7 @@ class Database:
                 # Constraint already exists
                 connection.rollback()
             except Exception as e:
-                logger.warning(f"Could not add unique constraint: {e}")
+                logger.warning("Could not add unique constraint: %s", e)
                 connection.rollback()
             
             # Create index for faster queries
@@ -80,10 +310,114 @@ class Database:
             ON ping_logs(pr_code)
             ''')
             
+            # Sweep run ledger
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sweep_runs (
+                id SERIAL PRIMARY KEY,
+                started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMP,
+                concurrency INTEGER NOT NULL,
+                total_sites INTEGER NOT NULL,
+                successful_sites INTEGER,
+                failed_sites INTEGER,
+                reachable_sites INTEGER
+            )
+            ''')
+            
+            # Per-site timing spans in milliseconds, one row per site per run
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sweep_site_spans (
+                run_id INTEGER NOT NULL REFERENCES sweep_runs(id) ON DELETE CASCADE,
+                pr_code VARCHAR(10) NOT NULL,
+                ping_ms INTEGER,
+                fallback_ms INTEGER,
+                logger_ms INTEGER,
+                db_ms INTEGER,
+                total_ms INTEGER NOT NULL,
+                PRIMARY KEY (run_id, pr_code)
+            )
+            ''')
+            
+            # Distributed sweeps: 'serial' runs are a single process, 'distributed' runs are shared by workers
+            cursor.execute('''
+            ALTER TABLE sweep_runs ADD COLUMN IF NOT EXISTS mode VARCHAR(12) NOT NULL DEFAULT 'serial'
+            ''')
+            
+            # Claimable per-site jobs of the current distributed sweep
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sweep_jobs (
+                run_id INTEGER NOT NULL REFERENCES sweep_runs(id) ON DELETE CASCADE,
+                pr_code VARCHAR(10) NOT NULL,
+                site JSONB NOT NULL,
+                state VARCHAR(8) NOT NULL DEFAULT 'pending',
+                worker_id VARCHAR(100),
+                lease_expires_at TIMESTAMP,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                outcome VARCHAR(10),
+                ping_success BOOLEAN,
+                finished_at TIMESTAMP,
+                PRIMARY KEY (run_id, pr_code)
+            )
+            ''')
+            
+            # Checkpointed per-site health records of the sweeper (times are Unix seconds)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS site_health (
+                pr_code VARCHAR(10) PRIMARY KEY,
+                site_name VARCHAR(50),
+                ip_address VARCHAR(15),
+                up BOOLEAN,
+                ewma_rtt_ms REAL,
+                baseline_rtt_ms REAL,
+                consecutive_failures INTEGER NOT NULL DEFAULT 0,
+                transition_times DOUBLE PRECISION[] NOT NULL DEFAULT '{}',
+                recent_transitions INTEGER NOT NULL DEFAULT 0,
+                last_change DOUBLE PRECISION,
+                last_probe DOUBLE PRECISION,
+                probes INTEGER NOT NULL DEFAULT 0,
+                status VARCHAR(10) NOT NULL DEFAULT 'ok',
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+            ''')
+            
+            # Probe method that last reached each site ('system_ping' or 'http_request')
+            cursor.execute('''
+            ALTER TABLE site_health ADD COLUMN IF NOT EXISTS probe_method VARCHAR(16)
+            ''')
+            
+            # RTT quantile sketches per site and for the fleet (pr_code '*'), per time bucket
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rtt_sketches (
+                bucket_start BIGINT NOT NULL,
+                pr_code VARCHAR(10) NOT NULL,
+                samples INTEGER NOT NULL,
+                sketch BYTEA NOT NULL,
+                PRIMARY KEY (bucket_start, pr_code)
+            )
+            ''')
+            
+            # Upstream group outages seen by the sweeper; one open row (ended_at NULL) per group
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_outages (
+                id SERIAL PRIMARY KEY,
+                group_key VARCHAR(50) NOT NULL,
+                started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                last_seen_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                ended_at TIMESTAMP,
+                sentinels TEXT[] NOT NULL,
+                sites TEXT[] NOT NULL
+            )
+            ''')
+            
+            cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_group_outages_open
+            ON group_outages(group_key) WHERE ended_at IS NULL
+            ''')
+            
             connection.commit()
             logger.info("Database tables created successfully")
         except psycopg2.Error as e:
-            logger.error(f"Error creating tables: {e}")
+            logger.error("Error creating tables: %s", e)
             if connection:
                 connection.rollback()
             raise
@@ -92,6 +426,7 @@ class Database:
                 connection.close()
     
     @staticmethod
+    @instrument_query
     def insert_ping_log(timestamp, pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms):
         """
         Insert or update ping log data based on pr_code
@@ -104,10 +439,7 @@ class Database:
             cursor = connection.cursor()
             
             # Check if the pr_code already exists
-            cursor.execute(
-                "SELECT id from ping_logs WHERE pr_code = %s LIMIT 1",
-                (pr_code,)
-            )
+            cursor.execute(PR_CODE_LOOKUP_QUERY, (pr_code,))
             existing_record = cursor.fetchone()
             
             if existing_record:
@@ -120,11 +452,12 @@ class Database:
                     timestamp = %s, 
                     battery_version = %s,
                     ping_success = %s, 
-                    ping_time_ms = %s
+                    ping_time_ms = %s,
+                    upstream_down = NULL
                 WHERE pr_code = %s
                 ''', (ip_address, site_name, timestamp, battery_version, ping_success, ping_time_ms, pr_code))
                 
-                logger.info(f"Updated existing record for PR code: {pr_code}")
+                logger.info("Updated existing record for PR code: %s", pr_code)
             else:
                 # PR code doesn't exist, insert a new record
                 cursor.execute('''
@@ -132,12 +465,12 @@ class Database:
                 VALUES (%s, %s, %s, %s, %s, %s)
                 ''', (timestamp, pr_code, site_name, ip_address, ping_success, ping_time_ms))
                 
-                logger.info(f"Inserted new record for PR code: {pr_code}")
+                logger.info("Inserted new record for PR code: %s", pr_code)
             
             connection.commit()
             return True
         except psycopg2.Error as e:
-            logger.error(f"Error handling ping log for PR code {pr_code}: {e}")
+            logger.error("Error handling ping log for PR code %s: %s", pr_code, e)
             if connection:
                 connection.rollback()
             return False
@@ -146,6 +479,7 @@ class Database:
                 connection.close()
     
     @staticmethod
+    @instrument_query
     def get_ping_logs(limit=100, offset=0, site_name=None):
         """Get ping logs with optional filtering"""
         connection = None
@@ -153,31 +487,18 @@ class Database:
             connection = Database.get_connection()
             cursor = connection.cursor(cursor_factory=RealDictCursor)
             
-            # Build query with optional filters
-            query = "SELECT timestamp, pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms FROM ping_logs"
-            params = []
-            
-            conditions = []
-            if site_name:
-                conditions.append("site_name = %s")
-                params.append(site_name)
-            
-            if conditions:
-                query += " WHERE " + " AND ".join(conditions)
-                
-            query += " ORDER BY timestamp DESC LIMIT %s OFFSET %s"
-            params.extend([limit, offset])
-            
+            query, params = listing_query('ping_logs', limit, offset, site_name)
             cursor.execute(query, params)
             return cursor.fetchall()
         except psycopg2.Error as e:
-            logger.error(f"Error fetching ping logs: {e}")
+            logger.error("Error fetching ping logs: %s", e)
             return []
         finally:
             if connection:
                 connection.close()
 
     @staticmethod
+    @instrument_query
     def insert_length_loggers(pr_code, site_name, ip_address, length_loggers):
         """
         Insert or update length loggers data based on pr_code
@@ -202,7 +523,7 @@ class Database:
                 WHERE pr_code = %s
                 ''', (length_loggers, pr_code))
                 
-                logger.info(f"Updated length loggers for Site: {site_name} and PR code: {pr_code}")
+                logger.info("Updated length loggers for Site: %s and PR code: %s", site_name, pr_code)
             else:
                 # Record doesn't exist, insert a new record
                 cursor.execute('''
@@ -210,12 +531,84 @@ class Database:
                 VALUES (%s, %s, %s)
                 ''', (pr_code, site_name, ip_address, length_loggers))
                 
-                logger.info(f"Inserted new length loggers for Site: {site_name} and PR code: {pr_code}")
+                logger.info("Inserted new length loggers for Site: %s and PR code: %s", site_name, pr_code)
             
             connection.commit()
             return True
         except psycopg2.Error as e:
-            logger.error(f"Error handling length loggers for Site: {site_name}: {e}")
+            logger.error("Error handling length loggers for Site: %s: %s", site_name, e)
+            if connection:
+                connection.rollback()
+            return False
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def replay_spooled_writes(records):
+        """
+        Apply spooled insert_ping_log / insert_length_loggers calls in one transaction
+
+        Records are applied in order, keeping the last write per pr_code. A write
+        never overwrites a row with a newer timestamp, so replaying the same
+        records twice, or after newer sweeps were written directly, is harmless.
+
+        Args:
+            records (list): {'kind': 'ping_log' or 'length_loggers', 'args': {...}} dicts
+        """
+        ping_logs = {}
+        length_loggers = {}
+        for record in records:
+            args = record['args']
+            if record['kind'] == 'ping_log':
+                ping_logs[args['pr_code']] = (
+                    args['timestamp'], args['pr_code'], args['site_name'], args['ip_address'],
+                    args['battery_version'], args['ping_success'], args['ping_time_ms'],
+                    # Records spooled before upstream_down was written were probed
+                    args.get('upstream_down'),
+                )
+            elif record['kind'] == 'length_loggers':
+                length_loggers[args['pr_code']] = (args['pr_code'], args['length_loggers'], args['timestamp'])
+
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            Database._write_ping_rows(cursor, list(ping_logs.values()), list(length_loggers.values()))
+            connection.commit()
+            logger.info("Replayed %s spooled ping logs and %s length loggers", len(ping_logs), len(length_loggers))
+            return True
+        except psycopg2.Error as e:
+            logger.error("Error replaying spooled writes: %s", e)
+            if connection:
+                connection.rollback()
+            return False
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def write_ping_results(ping_rows, logger_rows):
+        """
+        Bulk insert or update ping logs and logger counts of many sites in one transaction
+
+        Args:
+            ping_rows (iterable): (timestamp, pr_code, site_name, ip_address, battery_version,
+                ping_success, ping_time_ms, upstream_down) tuples, at most one per pr_code; read
+                once. upstream_down is True for a site skipped behind a group outage, else None
+            logger_rows (iterable): (pr_code, length_loggers, timestamp) tuples; read once
+        """
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            Database._write_ping_rows(cursor, ping_rows, logger_rows)
+            connection.commit()
+            return True
+        except psycopg2.Error as e:
+            logger.error("Error writing ping logs: %s", e)
             if connection:
                 connection.rollback()
             return False
@@ -224,6 +617,88 @@ class Database:
                 connection.close()
 
     @staticmethod
+    def _write_ping_rows(cursor, ping_rows, logger_rows):
+        """
+        Upsert ping_logs rows by pr_code, then set logger counts
+
+        A row never overwrites one with a newer timestamp, and a logger count
+        only lands on the ping log of the same sweep (or an older one). Each
+        page of rows is one statement, so the rows are read only once and can
+        come from a generator.
+        """
+        # The INSERT sees the table as it was before the UPDATE, so each row
+        # either updates its existing ping log or is inserted
+        execute_values(cursor, '''
+        WITH v(timestamp, pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms, upstream_down) AS (VALUES %s),
+        updated AS (
+            UPDATE ping_logs AS p
+            SET
+                ip_address = v.ip_address,
+                site_name = v.site_name,
+                timestamp = v.timestamp,
+                battery_version = v.battery_version,
+                ping_success = v.ping_success,
+                ping_time_ms = v.ping_time_ms,
+                upstream_down = v.upstream_down
+            FROM v
+            WHERE p.pr_code = v.pr_code AND p.timestamp <= v.timestamp
+        )
+        INSERT INTO ping_logs (timestamp, pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms, upstream_down)
+        SELECT v.* FROM v
+        WHERE NOT EXISTS (SELECT 1 FROM ping_logs p WHERE p.pr_code = v.pr_code)
+        ''', ping_rows, template='(%s, %s, %s, %s, %s, %s::BOOLEAN, %s::INTEGER, %s::BOOLEAN)', page_size=1000)
+
+        if logger_rows:
+            execute_values(cursor, '''
+            UPDATE ping_logs AS p
+            SET length_loggers = v.length_loggers
+            FROM (VALUES %s) AS v(pr_code, length_loggers, timestamp)
+            WHERE p.pr_code = v.pr_code AND p.timestamp <= v.timestamp
+            ''', logger_rows, template='(%s, %s::INTEGER, %s)', page_size=1000)
+
+    @staticmethod
+    def stream_ping_logs(kind, since=None, until=None, site_name=None, pr_code=None, chunk_size=1000):
+        """
+        Stream ping_logs rows oldest first through a server-side cursor
+        
+        Not instrumented: rows are fetched lazily while the response is sent.
+        
+        Args:
+            kind (str): 'ping_logs' or 'length_loggers' (rows with a logger count)
+            since (str): Only rows with timestamp >= since
+            until (str): Only rows with timestamp < until
+            site_name (str): Only rows of this site
+            pr_code (str): Only rows of this PR code
+            chunk_size (int): Rows fetched per round trip
+            
+        Returns:
+            generator: Lists of up to chunk_size row tuples in EXPORT_COLUMNS[kind] order.
+            Nothing is opened until the first chunk is requested, and the connection is
+            closed when the generator is exhausted, closed or garbage collected.
+        """
+        query, params = export_query(kind, since, until, site_name, pr_code)
+        
+        connection = None
+        try:
+            connection = Database.get_connection()
+            # Named cursor: rows stay on the server until fetched
+            cursor = connection.cursor(name=f"export_{kind}")
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        except psycopg2.Error as e:
+            logger.error("Error streaming %s export: %s", kind, e)
+            raise
+        finally:
+            if connection is not None:
+                connection.rollback()
+                connection.close()
+
+    @staticmethod
+    @instrument_query
     def get_length_loggers(limit=100, offset=0, site_name=None):
         """Get ping logs with optional filtering"""
         connection = None
@@ -231,31 +706,18 @@ class Database:
             connection = Database.get_connection()
             cursor = connection.cursor(cursor_factory=RealDictCursor)
             
-            # Build query with optional filters
-            query = "SELECT timestamp, pr_code, site_name, ip_address, battery_version, length_loggers FROM ping_logs"
-            params = []
-            
-            conditions = []
-            if site_name:
-                conditions.append("site_name = %s")
-                params.append(site_name)
-            
-            if conditions:
-                query += " WHERE " + " AND ".join(conditions)
-                
-            query += " ORDER BY timestamp DESC LIMIT %s OFFSET %s"
-            params.extend([limit, offset])
-            
+            query, params = listing_query('length_loggers', limit, offset, site_name)
             cursor.execute(query, params)
             return cursor.fetchall()
         except psycopg2.Error as e:
-            logger.error(f"Error fetching ping logs: {e}")
+            logger.error("Error fetching ping logs: %s", e)
             return []
         finally:
             if connection:
                 connection.close()
 
     @staticmethod
+    @instrument_query
     def get_summary(hours=24):
         """
         Get a summary of ping logs for the last specified hours
@@ -276,75 +738,36 @@ class Database:
             time_ago_str = time_ago.strftime('%Y-%m-%d %H:%M:%S')
             
             # Get total unique sites
-            cursor.execute("""
-                SELECT COUNT(DISTINCT pr_code) AS total_sites
-                FROM ping_logs
-                WHERE timestamp >= %s
-            """, (time_ago_str,))
+            cursor.execute(SUMMARY_TOTAL_SITES_QUERY, (time_ago_str,))
             
             result = cursor.fetchone()
             total_sites = result['total_sites'] if result else 0
             
             # Get number of sites currently up (based on most recent ping)
-            cursor.execute("""
-                WITH recent_pings AS (
-                    SELECT 
-                        pr_code,
-                        ping_success,
-                        ROW_NUMBER() OVER (PARTITION BY pr_code ORDER BY timestamp DESC) AS rn
-                    FROM ping_logs
-                    WHERE timestamp >= %s
-                )
-                SELECT COUNT(*) AS sites_up
-                FROM recent_pings
-                WHERE rn = 1 AND ping_success = TRUE
-            """, (time_ago_str,))
+            cursor.execute(SUMMARY_SITES_UP_QUERY, (time_ago_str,))
             
             result = cursor.fetchone()
             sites_up = result['sites_up'] if result else 0
+            sites_upstream_down = result['sites_upstream_down'] if result else 0
             
             # Calculate sites down
             sites_down = total_sites - sites_up
             
             # Get average response time for successful pings
-            cursor.execute("""
-                SELECT AVG(ping_time_ms) AS avg_response_time
-                FROM ping_logs
-                WHERE timestamp >= %s AND ping_success = TRUE AND ping_time_ms IS NOT NULL
-            """, (time_ago_str,))
+            cursor.execute(SUMMARY_RESPONSE_TIME_QUERY, (time_ago_str,))
             
             result = cursor.fetchone()
             avg_response_time = round(float(result['avg_response_time']), 2) if result and result['avg_response_time'] else 0
             
             # Get sites with loggers
-            cursor.execute("""
-                WITH recent_loggers AS (
-                    SELECT 
-                        pr_code,
-                        length_loggers,
-                        ROW_NUMBER() OVER (PARTITION BY pr_code ORDER BY timestamp DESC) AS rn
-                    FROM ping_logs
-                    WHERE timestamp >= %s AND length_loggers IS NOT NULL
-                )
-                SELECT COUNT(*) AS sites_with_loggers,
-                AVG(length_loggers) AS avg_loggers_per_site
-                FROM recent_loggers
-                WHERE rn = 1 AND length_loggers > 0
-            """, (time_ago_str,))
+            cursor.execute(SUMMARY_LOGGERS_QUERY, (time_ago_str,))
             
             result = cursor.fetchone()
             sites_with_loggers = result['sites_with_loggers'] if result else 0
             avg_loggers_per_site = round(float(result['avg_loggers_per_site']), 1) if result and result['avg_loggers_per_site'] else 0
             
             # Get uptime percentage for the last 24 hours
-            cursor.execute("""
-                SELECT 
-                    pr_code,
-                    AVG(CASE WHEN ping_success = TRUE THEN 1 ELSE 0 END) * 100 AS uptime_percentage
-                FROM ping_logs
-                WHERE timestamp >= %s
-                GROUP BY pr_code
-            """, (time_ago_str,))
+            cursor.execute(SUMMARY_UPTIME_QUERY, (time_ago_str,))
             
             uptime_results = cursor.fetchall()
             avg_uptime = 0
@@ -352,6 +775,12 @@ class Database:
             if uptime_results:
                 uptime_sum = sum(float(result['uptime_percentage']) for result in uptime_results)
                 avg_uptime = round(uptime_sum / len(uptime_results), 2)
+            
+            # Response time percentiles from the fleet sketches of every bucket in the window
+            window_start = int(time_ago.timestamp()) // RTT_SKETCH_BUCKET_SECONDS * RTT_SKETCH_BUCKET_SECONDS
+            cursor.execute(SUMMARY_SKETCHES_QUERY, (FLEET, window_start))
+            
+            response_percentiles = percentiles(merge_sketches(row['sketch'] for row in cursor.fetchall()))
                 
             # Check timezone for Jakarta
             if datetime.now().astimezone().utcoffset() != timedelta(hours=7):
@@ -365,8 +794,10 @@ class Database:
                 'total_sites': total_sites,
                 'sites_up': sites_up,
                 'sites_down': sites_down,
+                'sites_upstream_down': sites_upstream_down,
                 'uptime_percentage': avg_uptime,
                 'average_response_time': avg_response_time,
+                **response_percentiles,
                 'sites_with_loggers': sites_with_loggers,
                 'average_loggers_per_site': avg_loggers_per_site,
                 'time_period': f"Last {hours} hours",
@@ -374,13 +805,14 @@ class Database:
             }
             
         except psycopg2.Error as e:
-            logger.error(f"Error getting ping logs summary: {e}")
+            logger.error("Error getting ping logs summary: %s", e)
             return {}
         finally:
             if connection:
                 connection.close()
 
     @staticmethod
+    @instrument_query
     def get_down_sites(hours=24):
         """
         Get a list of sites that are currently down
@@ -400,30 +832,9 @@ class Database:
             time_ago = datetime.now() - timedelta(hours=hours)
             time_ago_str = time_ago.strftime('%Y-%m-%d %H:%M:%S')
             
-            # Find down sites based on most recent ping
-            cursor.execute("""
-                WITH recent_pings AS (
-                    SELECT 
-                        pr_code,
-                        site_name,
-                        ip_address,
-                        battery_version,
-                        ping_success,
-                        timestamp,
-                        ROW_NUMBER() OVER (PARTITION BY pr_code ORDER BY timestamp DESC) AS rn
-                    FROM ping_logs
-                    WHERE timestamp >= %s
-                )
-                SELECT 
-                    pr_code,
-                    site_name,
-                    ip_address,
-                    battery_version,
-                    timestamp AS last_check
-                FROM recent_pings
-                WHERE rn = 1 AND ping_success = FALSE
-                ORDER BY site_name
-            """, (time_ago_str,))
+            # Find down sites based on most recent ping, with the open group
+            # outage of those that were not probed
+            cursor.execute(DOWN_SITES_QUERY, (time_ago_str,))
             
             down_sites = cursor.fetchall()
             
@@ -436,8 +847,616 @@ class Database:
             return down_sites
             
         except psycopg2.Error as e:
-            logger.error(f"Error getting down sites: {e}")
+            logger.error("Error getting down sites: %s", e)
             return []
         finally:
             if connection:
-                connection.close()
\ No newline at end of file
+                connection.close()
+    @staticmethod
+    @instrument_query
+    def start_sweep_run(concurrency, total_sites, mode='serial'):
+        """Record the start of a sweep and return its run id (None if the DB is unavailable)"""
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            cursor.execute(
+                "INSERT INTO sweep_runs (mode, concurrency, total_sites) VALUES (%s, %s, %s) RETURNING id",
+                (mode, concurrency, total_sites)
+            )
+            run_id = cursor.fetchone()[0]
+            connection.commit()
+            return run_id
+        except psycopg2.Error as e:
+            logger.error("Error starting sweep run: %s", e)
+            if connection:
+                connection.rollback()
+            return None
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def finish_sweep_run(run_id, successful_sites, failed_sites, reachable_sites):
+        """Record the end time and counts of a sweep"""
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            cursor.execute('''
+            UPDATE sweep_runs
+            SET finished_at = NOW(), successful_sites = %s, failed_sites = %s, reachable_sites = %s
+            WHERE id = %s
+            ''', (successful_sites, failed_sites, reachable_sites, run_id))
+            connection.commit()
+            return True
+        except psycopg2.Error as e:
+            logger.error("Error finishing sweep run %s: %s", run_id, e)
+            if connection:
+                connection.rollback()
+            return False
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def insert_sweep_spans(run_id, spans):
+        """
+        Bulk insert per-site timing spans for a sweep run
+
+        Args:
+            run_id (int): Sweep run id
+            spans (list): (pr_code, ping_ms, fallback_ms, logger_ms, db_ms, total_ms) tuples
+        """
+        if not spans:
+            return True
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            execute_values(cursor, '''
+            INSERT INTO sweep_site_spans (run_id, pr_code, ping_ms, fallback_ms, logger_ms, db_ms, total_ms)
+            VALUES %s
+            ON CONFLICT (run_id, pr_code) DO NOTHING
+            ''', [(run_id,) + tuple(span) for span in spans], page_size=1000)
+            connection.commit()
+            return True
+        except psycopg2.Error as e:
+            logger.error("Error inserting spans for sweep run %s: %s", run_id, e)
+            if connection:
+                connection.rollback()
+            return False
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def get_slow_sites(runs=10, limit=20):
+        """
+        Get the slowest sites and stages across the last N sweep runs
+
+        Args:
+            runs (int): Number of most recent runs to look at
+            limit (int): Number of sites to return
+
+        Returns:
+            dict: recent runs, slowest sites and per-stage totals
+        """
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor(cursor_factory=RealDictCursor)
+
+            cursor.execute(RECENT_RUNS_QUERY, (runs,))
+            recent_runs = cursor.fetchall()
+            run_ids = [run['id'] for run in recent_runs]
+
+            for run in recent_runs:
+                for key in ('started_at', 'finished_at'):
+                    if isinstance(run[key], datetime):
+                        run[key] = run[key].strftime('%Y-%m-%d %H:%M:%S')
+                if run['duration_seconds'] is not None:
+                    run['duration_seconds'] = round(float(run['duration_seconds']), 1)
+
+            if not run_ids:
+                return {'runs': [], 'slowest_sites': [], 'stages': []}
+
+            # Slowest sites by average total time, with the stage that dominates
+            cursor.execute(SLOW_SITES_QUERY, (run_ids, limit))
+            slowest_sites = cursor.fetchall()
+
+            # Share of sweep time spent in each stage
+            cursor.execute(SLOW_STAGES_QUERY, (run_ids,))
+            stages = cursor.fetchall()
+
+            return {
+                'runs': recent_runs,
+                'slowest_sites': slowest_sites,
+                'stages': stages
+            }
+        except psycopg2.Error as e:
+            logger.error("Error getting slow sites: %s", e)
+            return {}
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def open_distributed_sweep(load_sites, interval_seconds):
+        """
+        Join the current distributed sweep or create a new one
+
+        An unfinished sweep is always joined, so sites left behind by crashed
+        workers are picked up. A new sweep is created (and its jobs seeded from
+        load_sites()) only if the last one finished and started more than
+        interval_seconds ago. Creation is serialized with an advisory lock so
+        concurrent workers agree on one run; the inventory is fetched before
+        the lock is taken, so a slow inventory API never holds it.
+
+        Args:
+            load_sites (callable): Returns the site inventory as a list of dicts
+            interval_seconds (int): Minimum time between distributed sweeps
+
+        Returns:
+            int: Run id of the sweep to work on, or None if the DB is unavailable
+        """
+        current_run_query = """
+            SELECT id FROM sweep_runs
+            WHERE mode = 'distributed'
+              AND (finished_at IS NULL OR started_at > NOW() - %s * INTERVAL '1 second')
+            ORDER BY id DESC
+            LIMIT 1
+        """
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            cursor.execute(current_run_query, (interval_seconds,))
+            existing = cursor.fetchone()
+            connection.commit()
+            if existing:
+                return existing[0]
+
+            # Fetch the inventory outside the lock; deduplicate by pr_code so every site is one job
+            jobs = {}
+            for site in load_sites() or []:
+                if isinstance(site, dict) and site.get('pr_code') and (site.get('ip_address') or site.get('ip_site')):
+                    jobs.setdefault(site['pr_code'], site)
+
+            # Another worker may have created the sweep while the inventory was fetched
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SWEEP_LOCK_KEY,))
+            cursor.execute(current_run_query, (interval_seconds,))
+            existing = cursor.fetchone()
+            if existing:
+                connection.commit()
+                return existing[0]
+
+            # Jobs of finished sweeps are no longer needed
+            cursor.execute("DELETE FROM sweep_jobs")
+
+            cursor.execute(
+                "INSERT INTO sweep_runs (mode, concurrency, total_sites) VALUES ('distributed', 0, %s) RETURNING id",
+                (len(jobs),)
+            )
+            run_id = cursor.fetchone()[0]
+            execute_values(
+                cursor,
+                "INSERT INTO sweep_jobs (run_id, pr_code, site) VALUES %s",
+                [(run_id, pr_code, Json(site)) for pr_code, site in jobs.items()],
+                page_size=1000
+            )
+            connection.commit()
+            logger.info("Created distributed sweep %s with %s jobs", run_id, len(jobs))
+            return run_id
+        except psycopg2.Error as e:
+            logger.error("Error opening distributed sweep: %s", e)
+            if connection:
+                connection.rollback()
+            return None
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def claim_sweep_jobs(run_id, worker_id, batch_size, lease_seconds):
+        """
+        Claim up to batch_size pending jobs, or jobs whose lease has expired
+
+        Returns:
+            list: Site dicts claimed by this worker
+        """
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            cursor.execute("""
+                UPDATE sweep_jobs j
+                SET state = 'claimed',
+                    worker_id = %s,
+                    lease_expires_at = NOW() + %s * INTERVAL '1 second',
+                    attempts = j.attempts + 1
+                FROM (
+                    SELECT pr_code FROM sweep_jobs
+                    WHERE run_id = %s
+                      AND (state = 'pending' OR (state = 'claimed' AND lease_expires_at < NOW()))
+                    ORDER BY pr_code
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ) AS claimable
+                WHERE j.run_id = %s AND j.pr_code = claimable.pr_code
+                RETURNING j.site
+            """, (worker_id, lease_seconds, run_id, batch_size, run_id))
+            sites = [row[0] for row in cursor.fetchall()]
+            connection.commit()
+            return sites
+        except psycopg2.Error as e:
+            logger.error("Error claiming jobs for sweep %s: %s", run_id, e)
+            if connection:
+                connection.rollback()
+            return []
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def renew_sweep_job(run_id, pr_code, worker_id, lease_seconds):
+        """Extend this worker's lease on a job; False if the lease expired or was lost to another worker"""
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            cursor.execute("""
+                UPDATE sweep_jobs
+                SET lease_expires_at = NOW() + %s * INTERVAL '1 second'
+                WHERE run_id = %s AND pr_code = %s AND worker_id = %s AND state = 'claimed'
+                  AND lease_expires_at > NOW()
+            """, (lease_seconds, run_id, pr_code, worker_id))
+            renewed = cursor.rowcount == 1
+            connection.commit()
+            return renewed
+        except psycopg2.Error as e:
+            logger.error("Error renewing job %s for sweep %s: %s", pr_code, run_id, e)
+            if connection:
+                connection.rollback()
+            return False
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def complete_sweep_job(run_id, pr_code, worker_id, outcome, ping_success, ping_rows=None, logger_rows=None):
+        """
+        Mark a job done and write its results if this worker's lease is still live
+
+        The job update and the ping_logs write share one transaction, so a
+        worker whose lease expired (and whose site may have been re-claimed)
+        writes nothing.
+
+        Args:
+            ping_rows (list): ping_logs rows, as Database.write_ping_results takes them
+            logger_rows (list): Logger count rows, as Database.write_ping_results takes them
+
+        Returns:
+            bool: True if the job was completed (and its rows written)
+        """
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            cursor.execute("""
+                UPDATE sweep_jobs
+                SET state = 'done', outcome = %s, ping_success = %s, finished_at = NOW()
+                WHERE run_id = %s AND pr_code = %s AND worker_id = %s AND state = 'claimed'
+                  AND lease_expires_at > NOW()
+            """, (outcome, ping_success, run_id, pr_code, worker_id))
+            completed = cursor.rowcount == 1
+            if not completed:
+                connection.rollback()
+                return False
+            Database._write_ping_rows(cursor, ping_rows or [], logger_rows or [])
+            connection.commit()
+            return completed
+        except psycopg2.Error as e:
+            logger.error("Error completing job %s for sweep %s: %s", pr_code, run_id, e)
+            if connection:
+                connection.rollback()
+            return False
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def finish_distributed_sweep(run_id):
+        """
+        Close a distributed sweep once all of its jobs are done
+
+        Returns:
+            bool: True if this call closed the sweep
+        """
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            cursor.execute("""
+                UPDATE sweep_runs r
+                SET finished_at = NOW(),
+                    concurrency = counts.workers,
+                    successful_sites = counts.successful,
+                    failed_sites = counts.failed,
+                    reachable_sites = counts.reachable
+                FROM (
+                    SELECT
+                        COUNT(DISTINCT worker_id) AS workers,
+                        COUNT(*) FILTER (WHERE outcome = 'saved') AS successful,
+                        COUNT(*) FILTER (WHERE outcome IN ('db_failed', 'error')) AS failed,
+                        COUNT(*) FILTER (WHERE ping_success) AS reachable
+                    FROM sweep_jobs
+                    WHERE run_id = %s
+                ) AS counts
+                WHERE r.id = %s AND r.finished_at IS NULL
+                  AND NOT EXISTS (SELECT 1 FROM sweep_jobs WHERE run_id = %s AND state <> 'done')
+            """, (run_id, run_id, run_id))
+            finished = cursor.rowcount == 1
+            connection.commit()
+            return finished
+        except psycopg2.Error as e:
+            logger.error("Error finishing distributed sweep %s: %s", run_id, e)
+            if connection:
+                connection.rollback()
+            return False
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def get_sweep_job_counts(run_id):
+        """Get the number of jobs per state for a distributed sweep"""
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT state, COUNT(*) FROM sweep_jobs WHERE run_id = %s GROUP BY state",
+                (run_id,)
+            )
+            return dict(cursor.fetchall())
+        except psycopg2.Error as e:
+            logger.error("Error counting jobs for sweep %s: %s", run_id, e)
+            return {}
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def save_site_health(rows):
+        """
+        Upsert checkpointed site health records
+
+        A stored row is only replaced by a record built on it: one whose
+        probes grew beyond stored_probes since (another process wrote it) is
+        left alone for the caller to merge.
+
+        Args:
+            rows (list): (pr_code, site_name, ip_address, up, ewma_rtt_ms, baseline_rtt_ms,
+                consecutive_failures, transition_times, recent_transitions, last_change,
+                last_probe, probes, status, probe_method, stored_probes) tuples
+
+        Returns:
+            list: pr_codes written, or None on error
+        """
+        if not rows:
+            return []
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            saved = execute_values(cursor, '''
+            WITH v(
+                pr_code, site_name, ip_address, up, ewma_rtt_ms, baseline_rtt_ms, consecutive_failures,
+                transition_times, recent_transitions, last_change, last_probe, probes, status, probe_method,
+                stored_probes
+            ) AS (VALUES %s)
+            INSERT INTO site_health (
+                pr_code, site_name, ip_address, up, ewma_rtt_ms, baseline_rtt_ms, consecutive_failures,
+                transition_times, recent_transitions, last_change, last_probe, probes, status, probe_method
+            )
+            SELECT
+                pr_code, site_name, ip_address, up, ewma_rtt_ms, baseline_rtt_ms, consecutive_failures,
+                transition_times, recent_transitions, last_change, last_probe, probes, status, probe_method
+            FROM v
+            ON CONFLICT (pr_code) DO UPDATE SET
+                site_name = EXCLUDED.site_name,
+                ip_address = EXCLUDED.ip_address,
+                up = EXCLUDED.up,
+                ewma_rtt_ms = EXCLUDED.ewma_rtt_ms,
+                baseline_rtt_ms = EXCLUDED.baseline_rtt_ms,
+                consecutive_failures = EXCLUDED.consecutive_failures,
+                transition_times = EXCLUDED.transition_times,
+                recent_transitions = EXCLUDED.recent_transitions,
+                last_change = EXCLUDED.last_change,
+                last_probe = EXCLUDED.last_probe,
+                probes = EXCLUDED.probes,
+                status = EXCLUDED.status,
+                probe_method = EXCLUDED.probe_method,
+                updated_at = NOW()
+            WHERE site_health.probes <= (SELECT v.stored_probes FROM v WHERE v.pr_code = EXCLUDED.pr_code)
+            RETURNING pr_code
+            ''', rows, template=(
+                '(%s, %s, %s, %s::BOOLEAN, %s::REAL, %s::REAL, %s::INTEGER, %s::DOUBLE PRECISION[], %s::INTEGER, '
+                '%s::DOUBLE PRECISION, %s::DOUBLE PRECISION, %s::INTEGER, %s, %s, %s::INTEGER)'
+            ), page_size=1000, fetch=True)
+            connection.commit()
+            return [row[0] for row in saved]
+        except psycopg2.Error as e:
+            logger.error("Error checkpointing site health: %s", e)
+            if connection:
+                connection.rollback()
+            return None
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def get_site_health(statuses=None, limit=None):
+        """
+        Get checkpointed site health records
+
+        Args:
+            statuses (list): Only records with one of these statuses (all if None)
+            limit (int): Maximum number of records (all if None)
+        """
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor(cursor_factory=RealDictCursor)
+            
+            query, params = site_health_query(statuses, limit)
+            
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        except psycopg2.Error as e:
+            logger.error("Error fetching site health: %s", e)
+            return []
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def merge_rtt_sketches(sketches):
+        """
+        Merge RTT sketches into the stored sketch of their bucket
+
+        Args:
+            sketches (dict): {(bucket_start, pr_code): RttSketch}
+        """
+        if not sketches:
+            return True
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            
+            # Sweepers on other hosts may merge into the same buckets
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (RTT_SKETCH_LOCK_KEY,))
+            stored = execute_values(cursor, '''
+            SELECT s.bucket_start, s.pr_code, s.sketch
+            FROM rtt_sketches s
+            JOIN (VALUES %s) AS k(bucket_start, pr_code)
+            ON s.bucket_start = k.bucket_start AND s.pr_code = k.pr_code
+            ''', list(sketches), template='(%s::BIGINT, %s)', page_size=1000, fetch=True)
+            
+            merged = {key: RttSketch().merge(sketch) for key, sketch in sketches.items()}
+            for bucket_start, pr_code, blob in stored:
+                merged[(bucket_start, pr_code)].merge(RttSketch.from_bytes(blob))
+            
+            execute_values(cursor, '''
+            INSERT INTO rtt_sketches (bucket_start, pr_code, samples, sketch)
+            VALUES %s
+            ON CONFLICT (bucket_start, pr_code) DO UPDATE SET
+                samples = EXCLUDED.samples,
+                sketch = EXCLUDED.sketch
+            ''', [
+                (bucket_start, pr_code, sketch.count, psycopg2.Binary(sketch.to_bytes()))
+                for (bucket_start, pr_code), sketch in merged.items()
+            ], page_size=1000)
+            connection.commit()
+            return True
+        except psycopg2.Error as e:
+            logger.error("Error merging RTT sketches: %s", e)
+            if connection:
+                connection.rollback()
+            return False
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def record_group_outages(outages, recovered_groups):
+        """
+        Open or extend group outages seen in a sweep and close those of recovered groups
+
+        Args:
+            outages (list): (group_key, sentinel pr_codes, member pr_codes) of groups whose sentinels all failed
+            recovered_groups (list): group keys whose sentinels answered
+        """
+        if not outages and not recovered_groups:
+            return True
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor()
+            
+            if outages:
+                template = '(%s, %s::TEXT[], %s::TEXT[])'
+                execute_values(cursor, '''
+                UPDATE group_outages AS o
+                SET last_seen_at = NOW(), sentinels = v.sentinels, sites = v.sites
+                FROM (VALUES %s) AS v(group_key, sentinels, sites)
+                WHERE o.group_key = v.group_key AND o.ended_at IS NULL
+                ''', outages, template=template, page_size=1000)
+                execute_values(cursor, '''
+                INSERT INTO group_outages (group_key, sentinels, sites)
+                SELECT v.* FROM (VALUES %s) AS v(group_key, sentinels, sites)
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM group_outages o WHERE o.group_key = v.group_key AND o.ended_at IS NULL
+                )
+                ''', outages, template=template, page_size=1000)
+            
+            if recovered_groups:
+                cursor.execute('''
+                UPDATE group_outages SET ended_at = NOW()
+                WHERE group_key = ANY(%s) AND ended_at IS NULL
+                ''', (list(recovered_groups),))
+            
+            connection.commit()
+            return True
+        except psycopg2.Error as e:
+            logger.error("Error recording group outages: %s", e)
+            if connection:
+                connection.rollback()
+            return False
+        finally:
+            if connection:
+                connection.close()
+
+    @staticmethod
+    @instrument_query
+    def get_group_outages(hours=24, limit=100):
+        """
+        Get open group outages and those that ended within the last hours, open ones first
+
+        Returns:
+            list: Outages with group_key, started_at, last_seen_at, ended_at, sentinels, sites and site_count
+        """
+        connection = None
+        try:
+            connection = Database.get_connection()
+            cursor = connection.cursor(cursor_factory=RealDictCursor)
+            
+            cursor.execute(GROUP_OUTAGES_QUERY, (hours, limit))
+            
+            outages = cursor.fetchall()
+            for outage in outages:
+                for field in ('started_at', 'last_seen_at', 'ended_at'):
+                    if isinstance(outage[field], datetime):
+                        outage[field] = outage[field].strftime('%Y-%m-%d %H:%M:%S')
+            return outages
+        except psycopg2.Error as e:
+            logger.error("Error fetching group outages: %s", e)
+            return []
+        finally:
+            if connection:
+                connection.close()
@@ -0,0 +1,275 @@
+import os
+import sys
+import logging
+from array import array
+from datetime import datetime
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Probed sites written to the database per bulk write
+FLEET_FLUSH_SITES = int(os.getenv('FLEET_FLUSH_SITES', 100))
+
+# Per-site state of the current sweep
+NOT_PROBED = 0
+UP = 1
+DOWN = 2
+UPSTREAM_DOWN = 3
+FAILED = 4
+
+# Integer columns use this for "no value"
+MISSING = -1
+
+# Measurement columns: typecode and the value every sweep starts from
+COLUMNS = {
+    'state': ('b', NOT_PROBED),
+    'saved': ('b', 0),
+    # Epoch seconds of the site's probe
+    'probed_at': ('q', 0),
+    'rtt_ms': ('i', MISSING),
+    'loggers': ('i', MISSING),
+    'ping_ms': ('i', MISSING),
+    'fallback_ms': ('i', MISSING),
+    'logger_ms': ('i', MISSING),
+    'db_ms': ('i', MISSING),
+    'total_ms': ('i', MISSING),
+}
+
+SITE_FIELDS = ('pr_code', 'site_name', 'ip_address', 'battery_version', 'gateway', 'probe_chain')
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _chain(probe_chain):
+    """Inventory probe_chain as a hashable value ("tcp:502,icmp" or a list of entries)"""
+    return tuple(probe_chain) if isinstance(probe_chain, list) else _intern(probe_chain)
+
+
+def _ms(seconds):
+    return int(seconds * 1000) if seconds is not None else MISSING
+
+
+def _value(value):
+    return None if value == MISSING else value
+
+
+@lru_cache(maxsize=4096)
+def _timestamp(seconds):
+    """Format epoch seconds like the rest of ping_logs; sites probed in the same second share one string"""
+    return datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SiteRecord:
+    """Inventory metadata of one site; strings are interned and records are reused across sweeps"""
+    __slots__ = ('index', 'group_key') + SITE_FIELDS
+
+    def __init__(self, site):
+        self.index = None
+        self.group_key = None
+        self.pr_code = _intern(site.get('pr_code', 'UNKNOWN'))
+        self.site_name = _intern(site.get('site_name'))
+        self.ip_address = _intern(site.get('ip_address') or site.get('ip_site'))
+        self.battery_version = _intern(site.get('battery_version', 'UNKNOWN'))
+        self.gateway = _intern(site.get('gateway'))
+        self.probe_chain = _chain(site.get('probe_chain'))
+
+    def matches(self, site):
+        """True if the inventory entry has the same metadata as this record"""
+        return (
+            self.pr_code == site.get('pr_code', 'UNKNOWN')
+            and self.site_name == site.get('site_name')
+            and self.ip_address == (site.get('ip_address') or site.get('ip_site'))
+            and self.battery_version == site.get('battery_version', 'UNKNOWN')
+            and self.gateway == site.get('gateway')
+            and self.probe_chain == _chain(site.get('probe_chain'))
+        )
+
+    def get(self, key, default=None):
+        """dict-style access, so a record can stand in for an inventory entry"""
+        value = getattr(self, key, None) if key in SITE_FIELDS else None
+        return default if value is None else value
+
+
+class FleetStore:
+    """
+    The sweeper's inventory and the current sweep's measurements.
+
+    Sites are SiteRecords sorted by pr_code; a site's index is its position.
+    Measurements live in typed arrays (see COLUMNS) indexed by site, which
+    are reset in place at the start of each sweep and only reallocated when
+    the number of sites changes. Rows for the database, the run ledger and
+    the sweep archive are generated from the arrays when they are written.
+    """
+
+    def __init__(self, grouper=None):
+        self.grouper = grouper
+        self.sites = []
+        self._by_pr_code = {}
+        self._groups = []
+        self._blank = {}
+        for name in COLUMNS:
+            setattr(self, name, None)
+        self._allocate(0)
+
+    def _allocate(self, size):
+        for name, (typecode, initial) in COLUMNS.items():
+            self._blank[name] = array(typecode, [initial]) * size
+            setattr(self, name, array(typecode, self._blank[name]))
+
+    def reset(self):
+        """Clear the measurements for a new sweep"""
+        for name in COLUMNS:
+            getattr(self, name)[:] = self._blank[name]
+
+    # Inventory
+
+    def load(self, inventory):
+        """
+        Replace the inventory with a fresh list of site dicts and reset the measurements
+
+        Records of unchanged sites are kept, so a steady inventory allocates no
+        new records. Entries without an IP address and repeated pr_codes are skipped.
+        """
+        records = []
+        seen = set()
+        changed = False
+        for site in inventory:
+            if not isinstance(site, dict):
+                logger.warning("Skipping invalid site data: %s", site)
+                continue
+            if not (site.get('ip_address') or site.get('ip_site')):
+                logger.warning("No IP address found for site: %s", site.get('site_name'))
+                continue
+            pr_code = site.get('pr_code', 'UNKNOWN')
+            if pr_code in seen:
+                logger.warning("Skipping duplicate site %s", pr_code)
+                continue
+            seen.add(pr_code)
+            record = self._by_pr_code.get(pr_code)
+            if record is None or not record.matches(site):
+                record = SiteRecord(site)
+                if self.grouper is not None:
+                    record.group_key = _intern(self.grouper.group_key(record))
+                changed = True
+            records.append(record)
+
+        if changed or len(records) != len(self.sites):
+            records.sort(key=lambda record: record.pr_code)
+            for index, record in enumerate(records):
+                record.index = index
+            self.sites = records
+            self._by_pr_code = {record.pr_code: record for record in records}
+            self._groups = self._group(records)
+        if len(self.state) != len(self.sites):
+            self._allocate(len(self.sites))
+        else:
+            self.reset()
+        return self.sites
+
+    @staticmethod
+    def _group(records):
+        groups = {}
+        ungrouped = []
+        for record in records:
+            if record.group_key is None:
+                ungrouped.append(record)
+            else:
+                groups.setdefault(record.group_key, []).append(record)
+        return list(groups.items()) + ([(None, ungrouped)] if ungrouped else [])
+
+    def groups(self):
+        """(group_key, records) pairs of the upstream groups; ungrouped sites have a key of None"""
+        return self._groups
+
+    # Measurements
+
+    def record(self, index, probed_at, success, rtt_ms, loggers, spans, total_seconds):
+        self.state[index] = UP if success else DOWN
+        self.probed_at[index] = int(probed_at)
+        self.rtt_ms[index] = rtt_ms if rtt_ms is not None else MISSING
+        self.loggers[index] = loggers if loggers is not None else MISSING
+        self.ping_ms[index] = _ms(spans.get('ping'))
+        self.fallback_ms[index] = _ms(spans.get('fallback'))
+        self.logger_ms[index] = _ms(spans.get('logger'))
+        self.total_ms[index] = _ms(total_seconds)
+
+    def record_upstream_down(self, index, probed_at):
+        self.state[index] = UPSTREAM_DOWN
+        self.probed_at[index] = int(probed_at)
+
+    def record_failed(self, index):
+        self.state[index] = FAILED
+
+    def record_write(self, indices, saved, db_seconds):
+        """Mark a bulk write of these sites; its time is shared between them"""
+        db_ms = _ms(db_seconds / len(indices)) if indices else MISSING
+        for index in indices:
+            self.saved[index] = 1 if saved else 0
+            if self.state[index] != UPSTREAM_DOWN:
+                self.db_ms[index] = db_ms
+
+    def count(self, *states):
+        return sum(self.state.count(state) for state in states)
+
+    def __len__(self):
+        """Sites with a result in this sweep"""
+        return self.count(UP, DOWN, UPSTREAM_DOWN)
+
+    # Rows
+
+    def ping_rows(self, indices):
+        """(timestamp, pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms, upstream_down) rows"""
+        sites = self.sites
+        state = self.state
+        rtt_ms = self.rtt_ms
+        probed_at = self.probed_at
+        for index in indices:
+            site = sites[index]
+            rtt = rtt_ms[index]
+            yield (
+                _timestamp(probed_at[index]), site.pr_code, site.site_name, site.ip_address, site.battery_version,
+                state[index] == UP, None if rtt == MISSING else rtt, True if state[index] == UPSTREAM_DOWN else None,
+            )
+
+    def logger_rows(self, indices):
+        """(pr_code, length_loggers, timestamp) rows of the sites that were up"""
+        for index in indices:
+            if self.state[index] == UP:
+                yield (self.sites[index].pr_code, _value(self.loggers[index]), _timestamp(self.probed_at[index]))
+
+    def span_rows(self):
+        """(pr_code, ping, fallback, logger, db, total) rows in ms for sites that were probed"""
+        for index, site in enumerate(self.sites):
+            if self.state[index] in (UP, DOWN):
+                yield (
+                    site.pr_code, _value(self.ping_ms[index]), _value(self.fallback_ms[index]),
+                    _value(self.logger_ms[index]), _value(self.db_ms[index]), self.total_ms[index],
+                )
+
+    def result(self, index):
+        """Result dict of one site, in the shape process_site returns"""
+        site = self.sites[index]
+        state = self.state[index]
+        result = {
+            'timestamp': _timestamp(self.probed_at[index]),
+            'pr_code': site.pr_code,
+            'site_name': site.site_name,
+            'ip_address': site.ip_address,
+            'battery_version': site.battery_version,
+            'ping_success': state == UP,
+            'ping_time_ms': _value(self.rtt_ms[index]),
+            'length_loggers': _value(self.loggers[index]),
+            'saved_to_db': bool(self.saved[index]),
+        }
+        if state == UPSTREAM_DOWN:
+            result['upstream_down'] = True
+            result['outage_group'] = site.group_key
+        return result
+
+    def __iter__(self):
+        """Result dicts of the sites with a result, in pr_code order"""
+        for index in range(len(self.sites)):
+            if self.state[index] in (UP, DOWN, UPSTREAM_DOWN):
+                yield self.result(index)
@@ -0,0 +1,271 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from db_utils import Database
+from rtt_sketch import RttSketch, RTT_SKETCH_BUCKET_SECONDS, FLEET
+
+logger = logging.getLogger(__name__)
+
+# Smoothing of the fast (recent) and slow (baseline) RTT averages
+HEALTH_RTT_ALPHA = float(os.getenv('HEALTH_RTT_ALPHA', 0.3))
+HEALTH_BASELINE_ALPHA = float(os.getenv('HEALTH_BASELINE_ALPHA', 0.02))
+# Up/down transitions are counted over this sliding window (seconds)
+HEALTH_FLAP_WINDOW = int(os.getenv('HEALTH_FLAP_WINDOW', 6 * 3600))
+# A site with at least this many transitions in the window is flapping
+HEALTH_FLAP_TRANSITIONS = int(os.getenv('HEALTH_FLAP_TRANSITIONS', 4))
+# A reachable site whose recent RTT is this many times its baseline is degrading
+HEALTH_DEGRADED_RTT_FACTOR = float(os.getenv('HEALTH_DEGRADED_RTT_FACTOR', 2.0))
+HEALTH_DEGRADED_MIN_RTT = float(os.getenv('HEALTH_DEGRADED_MIN_RTT', 50))
+# Transition timestamps kept per site, whatever the window
+MAX_TRANSITIONS = 64
+
+
+class SiteHealth:
+    """Health record of one site, updated in O(1) per probe"""
+    __slots__ = (
+        'pr_code', 'site_name', 'ip_address', 'up', 'ewma_rtt_ms', 'baseline_rtt_ms',
+        'consecutive_failures', 'transitions', 'last_change', 'last_probe', 'probes', 'probe_method',
+        'stored_probes'
+    )
+
+    def __init__(self, pr_code, site_name=None, ip_address=None):
+        self.pr_code = pr_code
+        self.site_name = site_name
+        self.ip_address = ip_address
+        self.up = None
+        self.ewma_rtt_ms = None
+        self.baseline_rtt_ms = None
+        self.consecutive_failures = 0
+        self.transitions = deque(maxlen=MAX_TRANSITIONS)
+        self.last_change = None
+        self.last_probe = None
+        self.probes = 0
+        # Probe method that last reached the site, tried first by hedged probes
+        self.probe_method = None
+        # Probes of the stored row this record was loaded from or last written as
+        self.stored_probes = 0
+
+    @classmethod
+    def from_row(cls, row):
+        """Record of a site_health row"""
+        health = cls(row['pr_code'], row['site_name'], row['ip_address'])
+        health.up = row['up']
+        health.ewma_rtt_ms = row['ewma_rtt_ms']
+        health.baseline_rtt_ms = row['baseline_rtt_ms']
+        health.consecutive_failures = row['consecutive_failures']
+        health.transitions.extend(row['transition_times'] or [])
+        health.last_change = row['last_change']
+        health.last_probe = row['last_probe']
+        health.probes = row['probes']
+        health.probe_method = row['probe_method']
+        health.stored_probes = row['probes']
+        return health
+
+    def merge(self, row):
+        """
+        Fold in a stored row written since this record was loaded, by another
+        process or before a failed load was retried: transitions are combined,
+        probes add up and the rest comes from whichever probed last
+        """
+        stored = SiteHealth.from_row(row)
+        local_probes = self.probes - self.stored_probes
+        transitions = sorted(set(self.transitions) | set(stored.transitions))
+        if (stored.last_probe or 0) > (self.last_probe or 0):
+            self.up = stored.up
+            self.ewma_rtt_ms = stored.ewma_rtt_ms
+            self.baseline_rtt_ms = stored.baseline_rtt_ms
+            self.consecutive_failures = stored.consecutive_failures
+            self.last_probe = stored.last_probe
+            self.probe_method = stored.probe_method
+        else:
+            if self.baseline_rtt_ms is None:
+                self.baseline_rtt_ms = stored.baseline_rtt_ms
+            since = stored.last_probe or 0
+            if (stored.up is not None and self.up != stored.up and (self.last_change or 0) > since
+                    and not any(change > since for change in transitions)):
+                # The state changed between the stored probe and this record's first one
+                transitions.append(self.last_change)
+        self.transitions.clear()
+        self.transitions.extend(transitions[-MAX_TRANSITIONS:])
+        self.last_change = max((change for change in (self.last_change, stored.last_change) if change is not None), default=None)
+        self.probes = stored.probes + local_probes
+        self.stored_probes = stored.probes
+
+    def update(self, success, rtt_ms, now):
+        if self.up is not None and success != self.up:
+            self.transitions.append(now)
+            self.last_change = now
+        elif self.up is None:
+            self.last_change = now
+        self.up = success
+        self.last_probe = now
+        self.probes += 1
+
+        if success:
+            self.consecutive_failures = 0
+            if rtt_ms is not None:
+                if self.ewma_rtt_ms is None:
+                    self.ewma_rtt_ms = self.baseline_rtt_ms = float(rtt_ms)
+                else:
+                    self.ewma_rtt_ms += HEALTH_RTT_ALPHA * (rtt_ms - self.ewma_rtt_ms)
+                    self.baseline_rtt_ms += HEALTH_BASELINE_ALPHA * (rtt_ms - self.baseline_rtt_ms)
+        else:
+            self.consecutive_failures += 1
+
+    def recent_transitions(self, now):
+        """Transitions within HEALTH_FLAP_WINDOW; expired ones are dropped from the left"""
+        while self.transitions and self.transitions[0] < now - HEALTH_FLAP_WINDOW:
+            self.transitions.popleft()
+        return len(self.transitions)
+
+    def status(self, now):
+        """'flapping', 'down', 'degrading' or 'ok'"""
+        if self.recent_transitions(now) >= HEALTH_FLAP_TRANSITIONS:
+            return 'flapping'
+        if self.up is False:
+            return 'down'
+        if (self.ewma_rtt_ms is not None and self.baseline_rtt_ms
+                and self.ewma_rtt_ms >= HEALTH_DEGRADED_MIN_RTT
+                and self.ewma_rtt_ms >= HEALTH_DEGRADED_RTT_FACTOR * self.baseline_rtt_ms):
+            return 'degrading'
+        return 'ok'
+
+
+class HealthTracker:
+    """
+    Per-site health records kept in memory by the sweeper.
+
+    Records are loaded from the site_health table on start and only the sites
+    probed since the last checkpoint are written back, with their status, so
+    the API can list flapping or degrading sites without reading ping history.
+    Nothing is written until the stored records were loaded, and a stored row
+    is only overwritten by a record built on it; rows written by other
+    processes in the meantime are merged in first.
+    """
+
+    def __init__(self):
+        self.sites = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.load()
+
+    def load(self):
+        """Read the stored records, merging rows that changed into the records in memory"""
+        rows = Database.get_site_health()
+        if not rows and not Database.check_connection():
+            logger.warning("Could not load site health records; they are not checkpointed until loaded")
+            return False
+        merged = 0
+        with self._lock:
+            for row in rows:
+                health = self.sites.get(row['pr_code'])
+                if health is None:
+                    self.sites[row['pr_code']] = SiteHealth.from_row(row)
+                elif row['probes'] > health.stored_probes:
+                    health.merge(row)
+                    merged += 1
+            self.loaded = True
+        if rows:
+            logger.info("Loaded health records for %s sites (%s merged)", len(rows), merged)
+        return True
+
+    def record(self, pr_code, site_name, ip_address, success, rtt_ms, method=None):
+        """Fold one probe result into the site's record; method is remembered if it succeeded"""
+        with self._lock:
+            health = self.sites.get(pr_code)
+            if health is None:
+                health = self.sites[pr_code] = SiteHealth(pr_code)
+            health.site_name = site_name
+            health.ip_address = ip_address
+            health.update(success, rtt_ms, time.time())
+            if success and method:
+                health.probe_method = method
+            self._dirty.add(pr_code)
+
+    def probe_method(self, pr_code):
+        """Probe method that last reached the site, or None"""
+        health = self.sites.get(pr_code)
+        return health.probe_method if health is not None else None
+
+    def checkpoint(self):
+        """Write records changed since the last checkpoint to Postgres"""
+        if not self.loaded and not self.load():
+            # Writing now would replace the stored history of every probed site
+            return False
+        
+        # A record whose stored row changed since it was loaded is merged and written on the retry
+        for _ in range(2):
+            now = time.time()
+            with self._lock:
+                if not self._dirty:
+                    return True
+                rows = []
+                for pr_code in self._dirty:
+                    health = self.sites[pr_code]
+                    rows.append((
+                        health.pr_code, health.site_name, health.ip_address, health.up,
+                        health.ewma_rtt_ms, health.baseline_rtt_ms, health.consecutive_failures,
+                        list(health.transitions), health.recent_transitions(now),
+                        health.last_change, health.last_probe, health.probes, health.status(now),
+                        health.probe_method, health.stored_probes,
+                    ))
+                dirty = self._dirty
+                self._dirty = set()
+            
+            saved = Database.save_site_health(rows)
+            with self._lock:
+                if saved is None:
+                    # Keep them for the next checkpoint
+                    self._dirty |= dirty
+                    return False
+                saved = set(saved)
+                for row in rows:
+                    if row[0] in saved:
+                        self.sites[row[0]].stored_probes = row[11]
+                stale = dirty - saved
+                self._dirty |= stale
+            if not stale:
+                return True
+            logger.info("Health records of %s sites changed in the database since they were loaded", len(stale))
+            self.load()
+        return False
+
+
+class RttSketchStore:
+    """
+    Per-site and fleet RTT sketches of the sweeper, one per time bucket.
+
+    Successful probes are added in memory; flush() merges the pending sketches
+    into the rtt_sketches table and starts over.
+    """
+
+    def __init__(self, bucket_seconds=RTT_SKETCH_BUCKET_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, pr_code, rtt_ms):
+        bucket = int(time.time()) // self.bucket_seconds * self.bucket_seconds
+        with self._lock:
+            for key in ((bucket, pr_code), (bucket, FLEET)):
+                sketch = self._pending.get(key)
+                if sketch is None:
+                    sketch = self._pending[key] = RttSketch()
+                sketch.add(rtt_ms)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return True
+        if Database.merge_rtt_sketches(pending):
+            return True
+        # Keep them for the next flush
+        with self._lock:
+            for key, sketch in pending.items():
+                current = self._pending.get(key)
+                self._pending[key] = sketch.merge(current) if current else sketch
+        return False
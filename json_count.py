@@ -0,0 +1,221 @@
+import re
+import json
+
+# Bytes that end a run of string content
+_STRING_SPECIAL = re.compile(rb'["\\]')
+# Outside strings: a structural byte, a string start, or a run of scalar bytes (number/true/false/null)
+_OUTSIDE_TOKEN = re.compile(rb'[{}\[\],:"]|[^\s{}\[\],:"]+')
+_SCALAR_RUN = re.compile(rb'[^\s{}\[\],:"]+')
+# Longest key or captured string value kept; longer ones are never interesting here
+_MAX_CAPTURE = 256
+
+_OBJECT = 0
+_ARRAY = 1
+
+
+class UnexpectedStructure(ValueError):
+    """The document parsed, but not in the shape the caller expected"""
+
+
+class _Frame:
+    __slots__ = ('kind', 'key', 'expect_key', 'commas', 'has_value', 'path')
+
+    def __init__(self, kind, path):
+        self.kind = kind
+        self.path = path
+        self.key = None
+        self.expect_key = kind == _OBJECT
+        self.commas = 0
+        self.has_value = False
+
+
+class JsonArrayCounter:
+    """
+    Incrementally scan a JSON document and count the top-level elements of
+    selected arrays without building any of the values.
+
+    Paths are tuples of object keys from the root, e.g. ('data', 'mppt'); the
+    empty tuple is the root itself (a bare list). Short string values at
+    value_paths are captured too, e.g. ('message',).
+
+    After close():
+        root_type: 'object', 'array' or 'scalar'
+        root_keys: keys of the root object
+        counts: {path: element count} for every array path that was present
+        types: {path: 'array' or 'other'} for every array path that was present
+        values: {path: str} for captured string values
+    """
+
+    def __init__(self, array_paths, value_paths=()):
+        self.array_paths = frozenset(tuple(path) for path in array_paths)
+        self.value_paths = frozenset(tuple(path) for path in value_paths)
+        # Last key of every watched path, to skip path building for other keys
+        self._watched_keys = frozenset(
+            path[-1] for path in self.array_paths | self.value_paths if path
+        )
+        self.root_type = None
+        self.root_keys = set()
+        self.counts = {}
+        self.types = {}
+        self.values = {}
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._capture = None
+        self._capture_path = None
+        self._string_is_key = False
+        self._in_scalar = False
+        self._done = False
+
+    def _current_path(self):
+        """Key path of the value being parsed, or None if it sits inside an array"""
+        path = []
+        for frame in self._stack:
+            if frame.kind == _ARRAY:
+                return None
+            path.append(frame.key)
+        return tuple(path)
+
+    def _value_start(self, token):
+        """Called for the first byte of every value"""
+        if not self._stack:
+            if self._done:
+                raise ValueError("Extra data after JSON document")
+            self.root_type = {b'{': 'object', b'[': 'array'}.get(token, 'scalar')
+            if () in self.array_paths:
+                self.types[()] = 'array' if token == b'[' else 'other'
+            return None
+        top = self._stack[-1]
+        if top.kind == _ARRAY:
+            top.has_value = True
+            return None
+        if top.key not in self._watched_keys:
+            return None
+        path = self._current_path()
+        if path in self.array_paths:
+            self.types[path] = 'array' if token == b'[' else 'other'
+        return path
+
+    def _value_end(self):
+        if not self._stack:
+            self._done = True
+
+    def _string_end(self, raw):
+        text = None
+        if raw is not None:
+            try:
+                text = json.loads(b'"' + raw + b'"')
+            except ValueError:
+                text = raw.decode('utf-8', 'replace')
+        if self._string_is_key:
+            top = self._stack[-1]
+            top.key = text
+            if len(self._stack) == 1:
+                self.root_keys.add(text)
+        else:
+            if self._capture_path is not None:
+                self.values[self._capture_path] = text
+            self._value_end()
+
+    def feed(self, chunk):
+        """Scan the next chunk of the document (bytes)"""
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if self._in_scalar:
+                # Rest of a scalar split across chunks
+                m = _SCALAR_RUN.match(chunk, i)
+                if m:
+                    i = m.end()
+                if i < n:
+                    self._in_scalar = False
+                continue
+            if self._in_string:
+                if self._escape:
+                    # Second byte of an escape sequence split across chunks
+                    if self._capture is not None:
+                        self._capture += chunk[i:i + 1]
+                    self._escape = False
+                    i += 1
+                    continue
+                m = _STRING_SPECIAL.search(chunk, i)
+                end = m.start() if m else n
+                if self._capture is not None:
+                    self._capture += chunk[i:end]
+                    if len(self._capture) > _MAX_CAPTURE:
+                        self._capture = self._capture[:_MAX_CAPTURE]
+                if not m:
+                    break
+                if chunk[end] == 0x5C:  # backslash
+                    if self._capture is not None:
+                        self._capture += b'\\'
+                    self._escape = True
+                    i = end + 1
+                    continue
+                # Closing quote
+                self._in_string = False
+                raw, self._capture = self._capture, None
+                self._string_end(raw)
+                i = end + 1
+                continue
+
+            m = _OUTSIDE_TOKEN.search(chunk, i)
+            if not m:
+                break
+            token = m.group()
+            i = m.end()
+            top = self._stack[-1] if self._stack else None
+
+            if token == b'"':
+                self._in_string = True
+                self._string_is_key = top is not None and top.kind == _OBJECT and top.expect_key
+                if self._string_is_key:
+                    self._capture = b''
+                    self._capture_path = None
+                else:
+                    path = self._value_start(token)
+                    self._capture_path = path if path in self.value_paths else None
+                    self._capture = b'' if self._capture_path is not None else None
+            elif token == b'{' or token == b'[':
+                path = self._value_start(token)
+                if path is None and not self._stack:
+                    path = ()
+                self._stack.append(_Frame(_OBJECT if token == b'{' else _ARRAY, path))
+            elif token == b'}' or token == b']':
+                if not top or top.kind != (_OBJECT if token == b'}' else _ARRAY):
+                    raise ValueError(f"Unbalanced {token.decode()} in JSON document")
+                self._stack.pop()
+                if top.kind == _ARRAY and top.path in self.array_paths:
+                    self.counts[top.path] = top.commas + 1 if top.has_value else 0
+                self._value_end()
+            elif token == b',':
+                if top is None:
+                    raise ValueError("Unexpected ',' in JSON document")
+                if top.kind == _ARRAY:
+                    top.commas += 1
+                else:
+                    top.expect_key = True
+            elif token == b':':
+                if top is None or top.kind != _OBJECT:
+                    raise ValueError("Unexpected ':' in JSON document")
+                top.expect_key = False
+            else:
+                # Scalar; only its start matters, but it may continue into the next chunk
+                self._value_start(token)
+                self._value_end()
+                self._in_scalar = i == n
+
+    def close(self):
+        """Check the document was complete; returns self"""
+        if self._stack or self._in_string or self.root_type is None:
+            raise ValueError("Truncated JSON document")
+        return self
+
+
+def count_json_arrays(chunks, array_paths, value_paths=()):
+    """Scan an iterable of byte chunks with a JsonArrayCounter and return it"""
+    counter = JsonArrayCounter(array_paths, value_paths)
+    for chunk in chunks:
+        if chunk:
+            counter.feed(chunk)
+    return counter.close()
@@ -0,0 +1,138 @@
+import os
+import json
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Site currently being processed on this thread/task, attached to every record
+_current_site = contextvars.ContextVar('log_site', default=None)
+
+# extra= of routine per-site messages (progress and successes) that SuccessSampler may drop
+SUCCESS = {'outcome': 'ok'}
+
+
+@contextmanager
+def site_context(site_name):
+    """Tag log records emitted inside the block with the given site"""
+    token = _current_site.set(site_name)
+    try:
+        yield
+    finally:
+        _current_site.reset(token)
+
+
+class SiteContextFilter(logging.Filter):
+    """Attach the current site (if any) to the record as `site`"""
+
+    def filter(self, record):
+        if not hasattr(record, 'site'):
+            record.site = _current_site.get()
+        return True
+
+
+class SuccessSampler(logging.Filter):
+    """
+    Keep 1 in `sample_rate` per-site INFO/DEBUG records marked as successes
+    (extra=SUCCESS), per message template. Everything else is always kept:
+    unmarked records such as failures, warnings and errors, and records not
+    tied to a site.
+    """
+
+    def __init__(self, sample_rate=1):
+        super().__init__()
+        self.sample_rate = max(int(sample_rate), 1)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.sample_rate == 1 or record.levelno >= logging.WARNING:
+            return True
+        if getattr(record, 'outcome', None) != SUCCESS['outcome']:
+            return True
+        site = getattr(record, 'site', None)
+        if site is None:
+            return True
+        # record.msg is the unformatted template, so each message type is sampled independently
+        key = (site, record.msg)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % self.sample_rate == 0
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler that enqueues the record untouched so message formatting
+    happens on the listener thread instead of the caller's thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the structured fields of the record"""
+
+    def format(self, record):
+        entry = {
+            'timestamp': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        site = getattr(record, 'site', None)
+        if site is not None:
+            entry['site'] = site
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(filename=None, level=None):
+    """
+    Route all logging through a queue to a background listener thread.
+
+    Args:
+        filename (str): Log file, rotated by size; logs go to stderr when None
+        level (str): Root level, defaults to LOG_LEVEL (ERROR)
+
+    Returns:
+        QueueListener: The running listener (stopped automatically at exit)
+    """
+    level = level or os.getenv('LOG_LEVEL', 'ERROR')
+    if filename:
+        handler = RotatingFileHandler(
+            filename,
+            maxBytes=int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+            backupCount=int(os.getenv('LOG_BACKUP_COUNT', 5)),
+            encoding='utf-8'
+        )
+    else:
+        handler = logging.StreamHandler()
+
+    if os.getenv('LOG_FORMAT', 'text').lower() == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SiteContextFilter())
+    queue_handler.addFilter(SuccessSampler(os.getenv('LOG_SUCCESS_SAMPLE_RATE', 1)))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
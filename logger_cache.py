@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import logging
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOGGER_CACHE_FILE = os.getenv('LOGGER_CACHE_FILE', 'logger_cache.json')
+LOGGER_CACHE_TTL = int(os.getenv('LOGGER_CACHE_TTL', 6 * 3600))
+
+LOGGER_CACHE_LOOKUPS = metrics.Counter(
+    'ping_tracker_logger_cache_lookups_total',
+    'Logger count cache lookups, by result (hit, miss, expired, recovered, battery_changed)',
+    ('result',)
+)
+LOGGER_ENDPOINT_REQUESTS = metrics.Counter(
+    'ping_tracker_logger_endpoint_requests_total',
+    'HTTP requests to site logger endpoints, by status (ok, not_modified, error)',
+    ('status',)
+)
+
+
+class LoggerCountCache:
+    """
+    Per-site logger counts, persisted to a JSON file across restarts.
+
+    An entry is served until its TTL expires, the site was seen down since it
+    was fetched, or the site's battery_version changes. Each endpoint's ETag /
+    Last-Modified validators are kept so refreshes can be conditional requests.
+    """
+
+    def __init__(self, path=LOGGER_CACHE_FILE, ttl=LOGGER_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+            logger.info("Loaded %s logger counts from %s", len(self._entries), self.path)
+        except FileNotFoundError:
+            self._entries = {}
+        except (IOError, ValueError) as e:
+            logger.error("Error loading logger cache from %s: %s", self.path, e)
+            self._entries = {}
+
+    def save(self):
+        """Write the cache, merging entries other processes saved in the meantime"""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                on_disk = json.load(f)
+            for ip_address, entry in on_disk.items():
+                mine = entries.get(ip_address)
+                if mine is None or entry.get('fetched_at', 0) > mine.get('fetched_at', 0):
+                    entries[ip_address] = entry
+        except (IOError, ValueError):
+            pass
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except IOError as e:
+            logger.error("Error saving logger cache to %s: %s", self.path, e)
+
+    def get(self, ip_address, battery_version):
+        """Return the cached logger count, or None if it must be refreshed"""
+        with self._lock:
+            entry = self._entries.get(ip_address)
+        if entry is None or entry.get('count') is None:
+            result = 'miss'
+        elif entry.get('battery_version') != battery_version:
+            result = 'battery_changed'
+        elif entry.get('down_since_fetch'):
+            result = 'recovered'
+        elif time.time() - entry.get('fetched_at', 0) >= self.ttl:
+            result = 'expired'
+        else:
+            result = 'hit'
+        LOGGER_CACHE_LOOKUPS.inc(1, result)
+        return entry['count'] if result == 'hit' else None
+
+    def last_count(self, ip_address):
+        """Last fetched logger count however old, or None if the site was never fetched"""
+        with self._lock:
+            entry = self._entries.get(ip_address)
+        return entry.get('count') if entry is not None else None
+
+    def mark_down(self, ip_address):
+        """Force a refresh the next time the site is reachable"""
+        with self._lock:
+            entry = self._entries.get(ip_address)
+            if entry is not None and not entry.get('down_since_fetch'):
+                entry['down_since_fetch'] = True
+                self._dirty = True
+
+    def put(self, ip_address, battery_version, count):
+        with self._lock:
+            entry = self._entries.setdefault(ip_address, {'endpoints': {}})
+            entry.update({
+                'count': count,
+                'battery_version': battery_version,
+                'fetched_at': time.time(),
+                'down_since_fetch': False,
+            })
+            self._dirty = True
+
+    def _endpoint(self, ip_address, path, battery_version):
+        with self._lock:
+            endpoint = self._entries.get(ip_address, {}).get('endpoints', {}).get(path)
+        # Validators from before a battery_version change are not trusted
+        if endpoint and endpoint.get('battery_version') == battery_version:
+            return endpoint
+        return None
+
+    def conditional_headers(self, ip_address, path, battery_version):
+        """If-None-Match / If-Modified-Since headers for an endpoint seen before"""
+        endpoint = self._endpoint(ip_address, path, battery_version)
+        if not endpoint:
+            return {}
+        headers = {}
+        if endpoint.get('etag'):
+            headers['If-None-Match'] = endpoint['etag']
+        if endpoint.get('last_modified'):
+            headers['If-Modified-Since'] = endpoint['last_modified']
+        return headers
+
+    def endpoint_count(self, ip_address, path, battery_version):
+        """Count stored for an endpoint, used when it answers 304 Not Modified"""
+        endpoint = self._endpoint(ip_address, path, battery_version)
+        return endpoint.get('count') if endpoint else None
+
+    def put_endpoint(self, ip_address, path, battery_version, response, count):
+        """Remember an endpoint's validators and count, if the controller sent validators"""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        with self._lock:
+            entry = self._entries.setdefault(ip_address, {'endpoints': {}})
+            entry.setdefault('endpoints', {})[path] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'battery_version': battery_version,
+                'count': count,
+            }
+            self._dirty = True
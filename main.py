@@ -4,25 +4,93 @@ import logging
 import json
 from dotenv import load_dotenv
 from datetime import datetime
-import subprocess
-import platform
+import time
+import socket
+import argparse
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from db_utils import Database
+from log_utils import setup_logging, site_context, SUCCESS
+from scheduler import ProbeScheduler
+from logger_cache import LoggerCountCache, LOGGER_ENDPOINT_REQUESTS
+from json_count import count_json_arrays, UnexpectedStructure
+from sweep_archive import SweepArchive
+from snapshot import SnapshotPublisher
+from health import HealthTracker, RttSketchStore
+from spool import WriteSpool, SpoolReplayer, SPOOL_RETRY_SECONDS
+from probes import ProbeChains, ProbeCancel, PROBE_BATCH_SIZE
+from fleet import FleetStore, FLEET_FLUSH_SITES, UP, UPSTREAM_DOWN
+from outage import SiteGrouper, pick_sentinels, OUTAGE_MIN_GROUP_SIZE, OUTAGE_GROUPS_DOWN, OUTAGE_SITES_SKIPPED
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
 url = os.getenv('API_URL')
+metrics_port = os.getenv('METRICS_PORT')
+metrics_textfile = os.getenv('METRICS_TEXTFILE', 'sweeper_metrics.prom')
+
+# Site controller logger endpoints
+TALIS_LOGGER_PATH = '/api/logger/talis'
+JSPRO_LOGGER_PATH = '/api/logger'
+TALIS_ARRAY_PATHS = (('data', 'mppt'), ('data', 'usb0'), ('data', 'usb1'))
+# Logger responses are counted while streaming; up to this many bytes are kept
+# so an unexpected structure can be re-parsed without fetching it again
+LOGGER_STREAM_CHUNK_BYTES = 16 * 1024
+LOGGER_STREAM_BUFFER_BYTES = int(os.getenv('LOGGER_STREAM_BUFFER_BYTES', 256 * 1024))
+
+# Probe mode: 'serial' tries a site's probe backends one after another, 'hedged'
+# starts the next one after PROBE_HEDGE_DELAY seconds and takes the first success
+PROBE_MODE = os.getenv('PROBE_MODE', 'serial')
+PROBE_HEDGE_DELAY = float(os.getenv('PROBE_HEDGE_DELAY', 1.0))
+# Threads running hedged probe legs, shared by every site and batch
+PROBE_HEDGE_WORKERS = int(os.getenv('PROBE_HEDGE_WORKERS', 16))
+
+# Distributed sweep settings
+sweep_interval = int(os.getenv('SWEEP_INTERVAL_SECONDS', 300))
+sweep_batch_size = int(os.getenv('SWEEP_BATCH_SIZE', 10))
+sweep_lease_seconds = int(os.getenv('SWEEP_LEASE_SECONDS', 120))
+sweep_poll_seconds = int(os.getenv('SWEEP_POLL_SECONDS', 5))
 
-# Configure logging
-logging.basicConfig(
-    level=logging.ERROR,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='ping_log_tracker.log'
-)
 logger = logging.getLogger(__name__)
 
+def configure_logging():
+    """Send the sweeper's logs to its own file (queued, rotated, sampled; see log_utils)"""
+    setup_logging(filename='ping_log_tracker.log')
+
 class SiteInfoFetcher:
     def __init__(self, api_url):
         self.api_url = api_url
+        self.logger_cache = LoggerCountCache()
+        # Writes made while Postgres is down are spooled and replayed in the background
+        self.spool = WriteSpool()
+        self.spool_replayer = SpoolReplayer(self.spool)
+        self.spool_replayer.start()
+        # Until this monotonic time writes go straight to the spool; shared by the scheduler's probe threads
+        self.db_retry_at = 0
+        self._db_retry_lock = threading.Lock()
+        self.health = HealthTracker()
+        self.rtt_sketches = RttSketchStore()
+        self.probe_chains = ProbeChains()
+        self.probe_executor = ThreadPoolExecutor(max_workers=PROBE_HEDGE_WORKERS, thread_name_prefix='probe-leg')
+        self.fleet = FleetStore(SiteGrouper())
+    
+    def _db_known_down(self):
+        with self._db_retry_lock:
+            return time.monotonic() < self.db_retry_at
+    
+    def _mark_db_down(self):
+        """Skip the database for SPOOL_RETRY_SECONDS"""
+        with self._db_retry_lock:
+            self.db_retry_at = time.monotonic() + SPOOL_RETRY_SECONDS
+    
+    def save_state(self):
+        """Persist per-site state kept across sweeps"""
+        self.logger_cache.save()
+        self.spool.flush()
+        self.health.checkpoint()
+        self.rtt_sketches.flush()
         
     def fetch_site_info(self):
         try:
@@ -30,7 +98,7 @@ class SiteInfoFetcher:
             response.raise_for_status()  # Raise an error for bad responses
             
             data = response.json()
-            logger.info(f"Successfully fetched site info: {len(data['data'])} records")
+            logger.info("Successfully fetched site info: %s records", len(data['data']))
             
             # Filter to get site_name, ip_address, pr_code, status_sites
             filtered_data = [
@@ -40,6 +108,8 @@ class SiteInfoFetcher:
                     'ip_address': site.get('ip_site'),
                     'status_sites': site.get('status_sites'),
                     'battery_version': site.get('battery_version'),
+                    'gateway': site.get('gateway'),
+                    'probe_chain': site.get('probe_chain'),
                 } for site in data['data'] if site.get('status_sites') == 'Active'
             ]
             
@@ -47,79 +117,333 @@ class SiteInfoFetcher:
                 json.dump(filtered_data, f, indent=2)
                 logger.info("Site info saved to site_info.json")
             
-            logger.info(f"Total Site Active: {len(filtered_data)} records")
+            logger.info("Total Site Active: %s records", len(filtered_data))
             return filtered_data
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching site info: {e}")
+            logger.error("Error fetching site info: %s", e)
             try:
                 logger.info("Attempting to load site info from local file")
                 with open('site_info.json', 'r') as f:
                     data = json.load(f)
-                    logger.info(f"Loaded site info from site_info.json: {len(data)} records")
+                    logger.info("Loaded site info from site_info.json: %s records", len(data))
                     return data
             except (IOError, json.JSONDecodeError) as e:
-                logger.error(f"Error loading site info from local file: {e}")
+                logger.error("Error loading site info from local file: %s", e)
                 return []
     
     def process_sites(self):
-        """Filtering and processing site info with enhanced logging data"""
-        site_data = self.fetch_site_info()
+        """
+        Filtering and processing site info with enhanced logging data
+        
+        Returns:
+            FleetStore: The sweep's results, iterable as result dicts in pr_code order
+        """
+        sweep_start = time.perf_counter()
+        # Replay anything spooled by earlier sweeps alongside this one
+        self.spool_replayer.kick()
+        with metrics.SWEEP_STAGE_SECONDS.time('inventory_fetch'):
+            site_data = self.fetch_site_info()
         
         if not site_data:
             logger.warning("No sites available to process")
             return []
         
-        results = []
-        sites = site_data
+        sites = self.fleet.load(site_data)
         
-        logger.info(f"Starting to process {len(sites)} sites")
+        logger.info("Starting to process %s sites", len(sites))
         successful_sites = 0
         failed_sites = 0
         
-        for site in sites:
-            if not isinstance(site, dict):
-                logger.warning(f"Skipping invalid site data: {site}")
+        # Record this sweep in the run ledger; spans are written in bulk at the end
+        run_id = Database.start_sweep_run(min(PROBE_BATCH_SIZE, len(sites)), len(sites))
+        
+        # Measurements go to the fleet store; every FLEET_FLUSH_SITES sites they are written in bulk
+        pending = []
+        def flush():
+            nonlocal successful_sites, failed_sites
+            if not pending:
+                return
+            if self.write_fleet(pending) in ('saved', 'spooled'):
+                successful_sites += len(pending)
+            else:
+                failed_sites += len(pending)
+            del pending[:]
+        
+        def done(index, measured):
+            nonlocal failed_sites
+            if not measured:
+                failed_sites += 1
+                return
+            pending.append(index)
+            if len(pending) >= FLEET_FLUSH_SITES:
+                flush()
+        
+        def sweep_batches(batch_sites):
+            # Sites are probed PROBE_BATCH_SIZE at a time, then their loggers are counted one by one
+            for start in range(0, len(batch_sites), PROBE_BATCH_SIZE):
+                batch = batch_sites[start:start + PROBE_BATCH_SIZE]
+                ping_results = self.probe_batch(batch)
+                for site in batch:
+                    done(site.index, self.sweep_site(site, ping_results.get(site.pr_code)))
+        
+        # Probe a few sentinels per upstream group first; if they all fail the
+        # rest of the group is marked upstream down instead of timing out one by one
+        outages = []
+        recovered_groups = []
+        for group_key, members in self.fleet.groups():
+            if group_key is None or len(members) < OUTAGE_MIN_GROUP_SIZE:
+                sweep_batches(members)
                 continue
-                
-            ip_address = site.get('ip_address') or site.get('ip_site')
-            site_name = site.get('site_name')
-            pr_code = site.get('pr_code', 'UNKNOWN')
-            battery_version = site.get('battery_version', 'UNKNOWN')
             
-            if not ip_address:
-                logger.warning(f"No IP address found for site: {site_name}")
-                continue
-                
+            sentinels, rest = pick_sentinels(members, self.health)
+            # Sentinels of a group are probed together
+            sweep_batches(sentinels)
+            
+            if any(self.fleet.state[site.index] == UP for site in sentinels):
+                recovered_groups.append(group_key)
+                sweep_batches(rest)
+            else:
+                logger.warning("All %s sentinels of %s failed, marking %s sites upstream down", len(sentinels), group_key, len(rest))
+                outages.append((group_key, [site.pr_code for site in sentinels], [site.pr_code for site in members]))
+                probed_at = time.time()
+                for site in rest:
+                    self.fleet.record_upstream_down(site.index, probed_at)
+                    # Refresh the logger count once the site is back
+                    self.logger_cache.mark_down(site.ip_address)
+                    done(site.index, True)
+                metrics.SWEEP_SITES_TOTAL.inc(len(rest), 'upstream_down')
+        flush()
+        
+        OUTAGE_GROUPS_DOWN.set(len(outages))
+        OUTAGE_SITES_SKIPPED.set(self.fleet.count(UPSTREAM_DOWN))
+        Database.record_group_outages(outages, recovered_groups)
+        
+        metrics.SWEEP_DURATION_SECONDS.observe(time.perf_counter() - sweep_start)
+        metrics.SWEEP_LAST_SUCCESS_TIMESTAMP.set(time.time())
+        
+        if run_id is not None:
+            Database.insert_sweep_spans(run_id, list(self.fleet.span_rows()))
+            Database.finish_sweep_run(run_id, successful_sites, failed_sites, self.fleet.count(UP))
+        self.save_state()
+        
+        # Log summary at the end
+        logger.info("Processing completed: %s successful, %s failed, %s total", successful_sites, failed_sites, len(self.fleet))
+        return self.fleet
+    
+    def sweep_site(self, site, ping_result=None):
+        """
+        Measure one site of the fleet into the fleet store
+        
+        ping_result is used instead of probing if the site was already probed in a batch
+        
+        Returns:
+            bool: False if the site could not be processed
+        """
+        with site_context(site.site_name):
+            try:
+                probed_at = ping_result['probed_at'] if ping_result else time.time()
+                site_start = time.perf_counter()
+                ping_success, ping_time_ms, length_loggers_data, site_spans = self.measure_site(site, ping_result)
+                self.fleet.record(
+                    site.index, probed_at, ping_success, ping_time_ms, length_loggers_data,
+                    site_spans, time.perf_counter() - site_start
+                )
+                return True
+            except Exception as site_error:
+                logger.error("Unexpected error processing site %s: %s", site.site_name, site_error)
+                metrics.SWEEP_SITES_TOTAL.inc(1, 'error')
+                self.fleet.record_failed(site.index)
+                return False
+    
+    def write_fleet(self, indices):
+        """
+        Write the fleet store's results of these sites to the database in bulk, or spool them while it is down
+        
+        Returns:
+            str: 'saved', 'spooled' or 'db_failed'
+        """
+        db_start = time.perf_counter()
+        saved = False
+        # While Postgres is known to be down, go straight to the spool
+        spool_writes = self._db_known_down()
+        if not spool_writes:
+            with metrics.SWEEP_STAGE_SECONDS.time('db_bulk_write'):
+                # Rows are generated from the fleet arrays as they are sent
+                saved = Database.write_ping_results(self.fleet.ping_rows(indices), self.fleet.logger_rows(indices))
+            if not saved and not Database.check_connection():
+                # Postgres is down: keep these writes and skip the DB for a while
+                self._mark_db_down()
+                spool_writes = True
+        
+        if saved:
+            logger.info("Logged data for %s sites", len(indices))
+            outcome = 'saved'
+        elif spool_writes and self._spool_rows(self.fleet.ping_rows(indices), self.fleet.logger_rows(indices)):
+            logger.info("Spooled data for %s sites until the database is back", len(indices))
+            outcome = 'spooled'
+        else:
+            logger.error("Failed to log data for %s sites", len(indices))
+            outcome = 'db_failed'
+        
+        self.fleet.record_write(indices, saved, time.perf_counter() - db_start)
+        probed = sum(1 for index in indices if self.fleet.state[index] != UPSTREAM_DOWN)
+        if probed:
+            metrics.SWEEP_SITES_TOTAL.inc(probed, outcome)
+        return outcome
+    
+    def _spool_rows(self, ping_rows, logger_rows):
+        """Spool ping_logs rows and logger counts in the shape Database.write_ping_results takes"""
+        for timestamp, pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms, upstream_down in ping_rows:
+            if not self.spool.append('ping_log', {
+                'timestamp': timestamp,
+                'pr_code': pr_code,
+                'site_name': site_name,
+                'ip_address': ip_address,
+                'battery_version': battery_version,
+                'ping_success': ping_success,
+                'ping_time_ms': ping_time_ms,
+                'upstream_down': upstream_down,
+            }):
+                return False
+        for pr_code, length_loggers, timestamp in logger_rows:
+            if not self.spool.append('length_loggers', {
+                'timestamp': timestamp,
+                'pr_code': pr_code,
+                'length_loggers': length_loggers,
+            }):
+                return False
+        return True
+    
+    def process_site(self, site, store=None):
+        """
+        Probe a single site and store the results
+        
+        store replaces _store_result (same arguments and return value), e.g. to
+        write only while a distributed job's lease is held.
+        
+        Returns:
+            tuple: (outcome, result, span) where outcome is 'saved', 'spooled',
+            'db_failed', 'error' or None when the site was skipped
+        """
+        if not isinstance(site, dict):
+            logger.warning("Skipping invalid site data: %s", site)
+            return None, None, None
+            
+        ip_address = site.get('ip_address') or site.get('ip_site')
+        site_name = site.get('site_name')
+        pr_code = site.get('pr_code', 'UNKNOWN')
+        battery_version = site.get('battery_version', 'UNKNOWN')
+        
+        if not ip_address:
+            logger.warning("No IP address found for site: %s", site_name)
+            return None, None, None
+            
+        with site_context(site_name):
             try:
                 # Create timestamp
                 timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                site_start = time.perf_counter()
+                ping_success, ping_time_ms, length_loggers_data, site_spans = self.measure_site(site)
                 
-                # Step 1: Ping the site
-                logger.info(f"Pinging site {site_name} at {ip_address}")
-                ping_result = self.ping_site(ip_address)
+                # Insert data to database in a transaction
+                db_start = time.perf_counter()
+                outcome, saved_to_db = (store or self._store_result)(
+                    timestamp, pr_code, site_name, ip_address, battery_version,
+                    ping_success, ping_time_ms, length_loggers_data
+                )
                 
-                # Step 2: If ping is successful, try to get loggers length
-                length_loggers_data = None
-                if ping_result.get('success', False):
-                    logger.info(f"Checking loggers for {site_name} at {ip_address}")
-                    logger_result = self.length_loggers_site(ip_address, battery_version)
-                    if logger_result.get('success', False):
-                        length_loggers_data = logger_result.get('data')
-                        logger.info(f"Found {length_loggers_data} loggers for {site_name}")
-                    else:
-                        logger.error(f"Failed to get loggers for {site_name}: {logger_result.get('error', 'Unknown error')}")
+                site_spans['db'] = time.perf_counter() - db_start
+                metrics.SWEEP_SITES_TOTAL.inc(1, outcome)
                 
-                # Prepare ping data
-                ping_success = ping_result.get('success', False)
-                ping_time_ms = ping_result.get('response_time')
+                span = self._span_row(pr_code, site_spans, time.perf_counter() - site_start)
                 
-                # Convert to int for database
-                if ping_time_ms is not None:
-                    ping_time_ms = int(ping_time_ms)
+                # Build result object for JSON output regardless of database success
+                result = {
+                    'timestamp': timestamp,
+                    'pr_code': pr_code,
+                    'site_name': site_name,
+                    'ip_address': ip_address,
+                    'battery_version': battery_version,
+                    'ping_success': ping_success,
+                    'ping_time_ms': ping_time_ms,
+                    'length_loggers': length_loggers_data,
+                    'saved_to_db': saved_to_db
+                }
+                return outcome, result, span
                 
-                # Insert data to database in a transaction
-                try:
-                    # Insert ping_log
+            except Exception as site_error:
+                logger.error("Unexpected error processing site %s: %s", site_name, site_error)
+                metrics.SWEEP_SITES_TOTAL.inc(1, 'error')
+                return 'error', None, None
+    
+    def measure_site(self, site, ping_result=None):
+        """
+        Probe a site (unless ping_result is given), count its loggers if it is up and update its health
+        
+        Returns:
+            tuple: (ping_success, ping_time_ms, length_loggers, spans)
+        """
+        ip_address = site.get('ip_address') or site.get('ip_site')
+        site_name = site.get('site_name')
+        pr_code = site.get('pr_code', 'UNKNOWN')
+        battery_version = site.get('battery_version', 'UNKNOWN')
+        
+        # Step 1: Ping the site
+        logger.info("Pinging site %s at %s", site_name, ip_address, extra=SUCCESS)
+        if ping_result is None:
+            ping_result = self.ping_site(ip_address, self.health.probe_method(pr_code), self.probe_chains.for_site(site))
+        site_spans = ping_result.get('spans', {})
+        
+        # Step 2: If ping is successful, try to get loggers length
+        length_loggers_data = None
+        if ping_result.get('success', False):
+            logger.info("Checking loggers for %s at %s", site_name, ip_address, extra=SUCCESS)
+            with metrics.SWEEP_STAGE_SECONDS.time('logger_fetch') as logger_timer:
+                logger_result = self.length_loggers_site(ip_address, battery_version)
+            site_spans['logger'] = logger_timer.elapsed
+            if logger_result.get('success', False):
+                length_loggers_data = logger_result.get('data')
+                logger.info("Found %s loggers for %s", length_loggers_data, site_name, extra=SUCCESS)
+            else:
+                logger.error("Failed to get loggers for %s: %s", site_name, logger_result.get('error', 'Unknown error'))
+        else:
+            # Refresh the logger count once the site is back
+            self.logger_cache.mark_down(ip_address)
+        
+        # Prepare ping data
+        ping_success = ping_result.get('success', False)
+        ping_time_ms = ping_result.get('response_time')
+        
+        # Convert to int for database
+        if ping_time_ms is not None:
+            ping_time_ms = int(ping_time_ms)
+        
+        self.health.record(pr_code, site_name, ip_address, ping_success, ping_time_ms, ping_result.get('method'))
+        if ping_success and ping_time_ms is not None:
+            self.rtt_sketches.add(pr_code, ping_time_ms)
+        
+        # Log comprehensive information about this site
+        if ping_success:
+            logger.info("Successfully Site: %s - Ping results: %s length_loggers: %s", site_name, ping_result, length_loggers_data, extra=SUCCESS)
+        else:
+            logger.info("Failed Site: %s - Ping results: %s length_loggers: %s", site_name, ping_result, length_loggers_data)
+        return ping_success, ping_time_ms, length_loggers_data, site_spans
+    
+    def _store_result(self, timestamp, pr_code, site_name, ip_address, battery_version,
+                      ping_success, ping_time_ms, length_loggers_data):
+        """
+        Write a site's ping log (and logger count if it is up), or spool them while the DB is down
+        
+        Returns:
+            tuple: (outcome, saved_to_db) where outcome is 'saved', 'spooled' or 'db_failed'
+        """
+        success_ping_log = success_length_loggers = False
+        # While Postgres is known to be down, go straight to the spool
+        spool_writes = self._db_known_down()
+        if not spool_writes:
+            try:
+                # Insert ping_log
+                with metrics.SWEEP_STAGE_SECONDS.time('db_ping_log'):
                     success_ping_log = Database.insert_ping_log(
                         timestamp=timestamp,
                         pr_code=pr_code, 
@@ -129,235 +453,352 @@ class SiteInfoFetcher:
                         ping_success=ping_success,
                         ping_time_ms=ping_time_ms,
                     )
-                    
-                    # Insert length_loggers data
-                    success_length_loggers = True  # Default to True for cases with no logger data
-                    if ping_success:  # Only try to insert length_loggers if ping was successful
+            
+                # Insert length_loggers data
+                success_length_loggers = True  # Default to True for cases with no logger data
+                if ping_success:  # Only try to insert length_loggers if ping was successful
+                    with metrics.SWEEP_STAGE_SECONDS.time('db_length_loggers'):
                         success_length_loggers = Database.insert_length_loggers(
                             pr_code=pr_code, 
                             site_name=site_name,
                             ip_address=ip_address,
                             length_loggers=length_loggers_data,
                         )
-                    
-                    if success_ping_log and success_length_loggers:
-                        logger.info(f"Successfully logged data for {site_name}")
-                        successful_sites += 1
-                    else:
-                        failed_operations = []
-                        if not success_ping_log:
-                            failed_operations.append("ping log")
-                        if not success_length_loggers:
-                            failed_operations.append("loggers data")
-                        
-                        logger.error(f"Failed to log {', '.join(failed_operations)} for {site_name}")
-                        failed_sites += 1
-                    
-                except Exception as db_error:
-                    logger.error(f"Database error for {site_name}: {db_error}")
-                    failed_sites += 1
-                
-                # Build result object for JSON output regardless of database success
-                result = {
-                    'timestamp': timestamp,
-                    'pr_code': pr_code,
-                    'site_name': site_name,
-                    'ip_address': ip_address,
-                    'battery_version': battery_version,
-                    'ping_success': ping_success,
-                    'ping_time_ms': ping_time_ms,
-                    'length_loggers': length_loggers_data,
-                    'saved_to_db': success_ping_log and success_length_loggers
-                }
-                
-                results.append(result)
-                
-                # Log comprehensive information about this site
-                logger_info = f"length_loggers: {length_loggers_data}" if length_loggers_data is not None else ""
-                status = "Successfully" if ping_success else "Failed"
-                logger.info(f"{status} Site: {site_name} - Ping results: {ping_result} {logger_info}")
+            
+                if success_ping_log and success_length_loggers:
+                    logger.info("Successfully logged data for %s", site_name, extra=SUCCESS)
+                    outcome = 'saved'
+                else:
+                    failed_operations = []
+                    if not success_ping_log:
+                        failed_operations.append("ping log")
+                    if not success_length_loggers:
+                        failed_operations.append("loggers data")
                 
-            except Exception as site_error:
-                logger.error(f"Unexpected error processing site {site_name}: {site_error}")
-                failed_sites += 1
+                    logger.error("Failed to log %s for %s", ', '.join(failed_operations), site_name)
+                    outcome = 'db_failed'
+            
+            except Exception as db_error:
+                logger.error("Database error for %s: %s", site_name, db_error)
+                outcome = 'db_failed'
+            if outcome == 'db_failed' and not Database.check_connection():
+                # Postgres is down: keep this site's writes and skip the DB for a while
+                self._mark_db_down()
+                spool_writes = True
         
-        # Log summary at the end
-        logger.info(f"Processing completed: {successful_sites} successful, {failed_sites} failed, {len(results)} total")
+        if spool_writes:
+            ping_row = (timestamp, pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms, None)
+            logger_rows = [(pr_code, length_loggers_data, timestamp)] if ping_success else []
+            if self._spool_rows([ping_row], logger_rows):
+                logger.info("Spooled data for %s until the database is back", site_name)
+                outcome = 'spooled'
+            else:
+                outcome = 'db_failed'
+        
+        return outcome, success_ping_log and success_length_loggers
+    
+    @staticmethod
+    def _span_row(pr_code, site_spans, total_seconds):
+        """Convert per-stage seconds to a (pr_code, ping, fallback, logger, db, total) row in ms"""
+        def to_ms(seconds):
+            return int(seconds * 1000) if seconds is not None else None
+        
+        return (
+            pr_code,
+            to_ms(site_spans.get('ping')),
+            to_ms(site_spans.get('fallback')),
+            to_ms(site_spans.get('logger')),
+            to_ms(site_spans.get('db')),
+            to_ms(total_seconds),
+        )
+    
+    def ping_site(self, ip_address, preferred_method=None, chain=None):
+        """
+        Probe a site with its backend chain and return results
+        
+        In serial mode the backends are tried in order until one succeeds. In
+        hedged mode they overlap, starting with the backend of preferred_method
+        (the method that last reached the site).
+        """
+        chain = chain or self.probe_chains.default
+        if PROBE_MODE == 'hedged':
+            return self._hedged_ping(ip_address, chain, preferred_method)
+        return self._serial_ping(ip_address, chain)
+    
+    @staticmethod
+    def _probe_span(spans, position, seconds):
+        """The first backend of a chain is the 'ping' span, the others add up to 'fallback'"""
+        key = 'ping' if position == 0 else 'fallback'
+        spans[key] = spans.get(key, 0) + seconds
+    
+    def _serial_ping(self, ip_address, chain):
+        """Try each backend in turn; return the first success or the last failure"""
+        spans = {}
+        result = None
+        for position, backend in enumerate(chain):
+            if position:
+                logger.info("%s probe unsuccessful for %s, trying %s", chain[position - 1], ip_address, backend)
+            probe_start = time.perf_counter()
+            try:
+                result = backend.probe(ip_address)
+            except Exception as e:
+                logger.error("%s probe error for %s: %s", backend, ip_address, e)
+                result = {"success": False, "response_time": None, "error": str(e)}
+            seconds = time.perf_counter() - probe_start
+            metrics.SWEEP_STAGE_SECONDS.observe(seconds, backend.stage)
+            self._probe_span(spans, position, seconds)
+            result["method"] = backend.method
+            if result["success"]:
+                break
+        result["spans"] = spans
+        return result
+    
+    def _hedged_ping(self, ip_address, chain, preferred_method=None):
+        """
+        Run the backends of a chain as hedged probes
+        
+        The next backend starts PROBE_HEDGE_DELAY seconds after the previous one,
+        or as soon as every running probe has failed. Probes run on the shared
+        probe executor. The first success wins and the probes still running,
+        or starting late, are cancelled.
+        """
+        order = sorted(chain, key=lambda backend: backend.method != preferred_method)
+        finished = queue.Queue()
+        cancel = ProbeCancel()
+        def run(position, backend):
+            probe_start = time.perf_counter()
+            try:
+                result = backend.probe(ip_address, cancel)
+            except Exception as e:
+                result = {"success": False, "response_time": None, "error": str(e)}
+            result["method"] = backend.method
+            finished.put((position, backend, result, time.perf_counter() - probe_start))
+        
+        started = 0
+        hedge_at = None
+        def launch():
+            nonlocal started, hedge_at
+            if started:
+                logger.info("Hedging %s probe of %s with %s", order[started - 1], ip_address, order[started])
+            self.probe_executor.submit(run, started, order[started])
+            started += 1
+            hedge_at = time.perf_counter() + PROBE_HEDGE_DELAY
+        
+        spans = {}
+        failed = []
+        winner = None
+        while winner is None and len(failed) < len(order):
+            if len(failed) == started:
+                # Nothing is running (or everything running failed)
+                launch()
+            try:
+                timeout = max(0, hedge_at - time.perf_counter()) if started < len(order) else None
+                position, backend, result, seconds = finished.get(timeout=timeout)
+            except queue.Empty:
+                # The hedge delay passed: start the next backend alongside
+                launch()
+                continue
+            self._probe_span(spans, position, seconds)
+            metrics.SWEEP_STAGE_SECONDS.observe(seconds, backend.stage)
+            if result["success"]:
+                winner = result
+            else:
+                failed.append(result)
+        
+        cancel.cancel()
+        
+        result = winner or failed[-1]
+        result["spans"] = spans
+        result["hedged"] = started > 1
+        return result
+    
+    def probe_batch(self, sites):
+        """
+        Probe several sites at once, each backend of the chains in one batch
+        
+        Like ping_site, serial mode tries a site with the next backend of its
+        chain only once every earlier one failed, and hedged mode starts each
+        next batch of backends PROBE_HEDGE_DELAY seconds after the previous one
+        (or once it has finished), with every site's chain starting at the
+        method that last reached it. Each site's spans are the batch times of
+        the backends it went through.
+        
+        Returns:
+            dict: {pr_code: ping result}, each with the batch's start time as probed_at
+        """
+        chains = {site.get('pr_code'): self._site_chain(site) for site in sites}
+        probed_at = time.time()
+        if PROBE_MODE == 'hedged':
+            results = self._hedged_batch(sites, chains)
+        else:
+            results = self._serial_batch(sites, chains)
+        for result in results.values():
+            result['probed_at'] = probed_at
         return results
     
-    def ping_site(self, ip_address):
-        """Ping a site and return results"""
-        # First try system ping command (more reliable)
+    def _site_chain(self, site):
+        """A site's backend chain; in hedged mode it starts at the method that last reached the site"""
+        chain = self.probe_chains.for_site(site)
+        if PROBE_MODE != 'hedged':
+            return chain
+        preferred = self.health.probe_method(site.get('pr_code'))
+        return sorted(chain, key=lambda backend: backend.method != preferred)
+    
+    def _probe_backend_batch(self, backend, batch):
+        """Probe a batch of sites with one backend; returns (answers by IP address, IP addresses, seconds)"""
+        ip_addresses = [site.get('ip_address') or site.get('ip_site') for site in batch]
+        batch_start = time.perf_counter()
         try:
-            system = platform.system().lower()
-            
-            if system == "windows":
-                # Windows ping command
-                ping_param = "-n 1 -w 10000"  # 1 packet, 10 second timeout
-                command = f"ping {ping_param} {ip_address}"
-                ping_output = subprocess.run(command, capture_output=True, text=True, check=False)
-                
-                if "Reply from" in ping_output.stdout:
-                    # Extract time from ping response
-                    time_str = ping_output.stdout.split("time=")[1].split("ms")[0].strip() if "time=" in ping_output.stdout else None
-                    response_time = float(time_str) if time_str else 0
-                    return {
-                        "success": True,
-                        "response_time": response_time,
-                        "method": "system_ping"
-                    }
-            
-            elif system in ("linux", "darwin"):
-                # Linux/macOS ping command
-                ping_param = "-c 1 -W 10"  # 1 packet, 10 second timeout
-                command = f"ping {ping_param} {ip_address}"
-                ping_output = subprocess.run(command, shell=True, capture_output=True, text=True, check=False)
-                
-                if " 0% packet loss" in ping_output.stdout:
-                    # Extract time from ping response
-                    time_str = ping_output.stdout.split("time=")[1].split(" ")[0].strip() if "time=" in ping_output.stdout else None
-                    response_time = float(time_str) if time_str else 0
-                    return {
-                        "success": True,
-                        "response_time": response_time,
-                        "method": "system_ping"
-                    }
-                    
-            # If system ping fails or we're on an unsupported system, fall back to HTTP request
-            logger.info(f"System ping unsuccessful for {ip_address}, trying HTTP request")
-            
+            answers = backend.probe_batch(ip_addresses)
         except Exception as e:
-            logger.error(f"System ping error for {ip_address}: {e}, trying HTTP request")
+            logger.error("%s batch probe error: %s", backend, e)
+            answers = {}
+        seconds = time.perf_counter() - batch_start
+        metrics.SWEEP_STAGE_SECONDS.observe(seconds, backend.stage)
+        return answers, ip_addresses, seconds
+    
+    def _serial_batch(self, sites, chains):
+        pending = list(sites)
+        results = {}
+        spans = {pr_code: {} for pr_code in chains}
+        position = 0
+        while pending:
+            by_backend = {}
+            for site in pending:
+                by_backend.setdefault(chains[site.get('pr_code')][position], []).append(site)
+            for backend, batch in by_backend.items():
+                answers, ip_addresses, seconds = self._probe_backend_batch(backend, batch)
+                for site, ip_address in zip(batch, ip_addresses):
+                    pr_code = site.get('pr_code')
+                    result = answers.get(ip_address) or {"success": False, "response_time": None, "error": "not probed"}
+                    self._probe_span(spans[pr_code], position, seconds)
+                    results[pr_code] = dict(result, method=backend.method, spans=spans[pr_code])
+            position += 1
+            pending = [
+                site for site in pending
+                if not results[site.get('pr_code')]["success"] and position < len(chains[site.get('pr_code')])
+            ]
+        return results
+    
+    def _hedged_batch(self, sites, chains):
+        results = {}
+        spans = {pr_code: {} for pr_code in chains}
+        started = {pr_code: 0 for pr_code in chains}
+        won = set()
+        finished = queue.Queue()
+        def run(position, backend, batch):
+            finished.put((position, backend, batch) + self._probe_backend_batch(backend, batch))
         
-        # Fall back to HTTP request ping
-        try:
-            start_time = datetime.now()
-            response = requests.get(f"http://{ip_address}", timeout=10)
-            end_time = datetime.now()
-            response_time = (end_time - start_time).total_seconds() * 1000  # Convert to ms
-            
-            return {
-                "success": response.status_code < 400,
-                "response_time": response_time,
-                "method": "http_request"
-            }
-            
-        except requests.RequestException as e:
-            return {
-                "success": False,
-                "response_time": None,
-                "method": "http_request",
-                "error": str(e)
-            }
+        longest = max((len(chain) for chain in chains.values()), default=0)
+        running = 0
+        position = 0
+        hedge_at = None
+        def launch():
+            nonlocal running, position, hedge_at
+            by_backend = {}
+            for site in sites:
+                pr_code = site.get('pr_code')
+                if pr_code not in won and position < len(chains[pr_code]):
+                    by_backend.setdefault(chains[pr_code][position], []).append(site)
+                    started[pr_code] += 1
+            if position and by_backend:
+                logger.info("Hedging batch probe of %s sites with %s", sum(map(len, by_backend.values())), list(by_backend))
+            for backend, batch in by_backend.items():
+                self.probe_executor.submit(run, position, backend, batch)
+                running += 1
+            position += 1
+            hedge_at = time.perf_counter() + PROBE_HEDGE_DELAY
+        
+        launch()
+        while running and len(won) < len(sites):
+            try:
+                timeout = max(0, hedge_at - time.perf_counter()) if position < longest else None
+                batch_position, backend, batch, answers, ip_addresses, seconds = finished.get(timeout=timeout)
+            except queue.Empty:
+                # The hedge delay passed: start the next backends alongside
+                launch()
+                continue
+            running -= 1
+            for site, ip_address in zip(batch, ip_addresses):
+                pr_code = site.get('pr_code')
+                self._probe_span(spans[pr_code], batch_position, seconds)
+                if pr_code in won:
+                    continue
+                result = answers.get(ip_address) or {"success": False, "response_time": None, "error": "not probed"}
+                results[pr_code] = dict(result, method=backend.method, spans=spans[pr_code])
+                if result["success"]:
+                    won.add(pr_code)
+            if not running and position < longest:
+                # Every running batch has finished: start the next backends now
+                launch()
+        
+        # Batches still running are losers; their answers are ignored
+        for pr_code, result in results.items():
+            result["hedged"] = started[pr_code] > 1
+        return results
     
     def length_loggers_site(self, ip_address, battery_version):
         """Get length of loggers from a specific IP address based on battery version"""
         try:
+            # Logger counts change rarely; serve from cache unless it must be refreshed
+            cached_count = self.logger_cache.get(ip_address, battery_version)
+            if cached_count is not None:
+                logger.info("Using cached logger count for %s: %s", ip_address, cached_count, extra=SUCCESS)
+                return {
+                    "success": True,
+                    "response_time": 0,
+                    "method": "cache",
+                    "data": cached_count,
+                    "battery_version": battery_version
+                }
+            
             start_time = datetime.now()
             Headers = {"Authorization": f"Bearer {os.getenv('EHUB_TOKEN')}"}
             
             # Initialize total logger count
             total_loggers_count = 0
+            # Only cache the total if every endpoint answered with a usable count
+            complete = True
             
             # Determine which endpoint(s) to use based on battery version
             if battery_version and "TALIS5" in battery_version.upper():
                 # For any TALIS5-related battery versions (FULL or MIX)
-                logger.info(f"Using Talis5 endpoint for {ip_address} with battery version {battery_version}")
-                
-                # Try fetching Talis5 data with better error handling
-                talis_loggers_count = 0
-                try:
-                    response_talis = requests.get(f"http://{ip_address}/api/logger/talis", headers=Headers, timeout=10)
-                    response_talis.raise_for_status()
-                    data_talis = response_talis.json()
-                    
-                    # Calculate Talis5 logger count
-                    if "data" in data_talis:
-                        logger.info(f"site {ip_address} message: {data_talis.get('message')}")
-                        if data_talis.get("message") == "Success":
-                            talis_data = data_talis["data"]
-                            # Sum the length of arrays for each interface
-                            mppt_count = len(talis_data.get("mppt", []))
-                            usb0_count = len(talis_data.get("usb0", []))
-                            usb1_count = len(talis_data.get("usb1", []))
-                        
-                            talis_loggers_count = mppt_count + usb0_count + usb1_count
-                            logger.info(f"Talis5 loggers: MPPT={mppt_count}, USB0={usb0_count}, USB1={usb1_count}, Talis Total={talis_loggers_count}")
-                        else:
-                            # Fallback if message isn't "Success" but data exists
-                            talis_loggers_count = len(data_talis.get("data", []))
-                            logger.info(f"Talis5 loggers count (from data array): {talis_loggers_count}")
-                    else:
-                        logger.warning(f"Unexpected Talis5 response structure from {ip_address}: Missing 'data' key")
-                        
-                except requests.exceptions.RequestException as e:
-                    logger.error(f"Error fetching Talis5 data from {ip_address}: {e}")
-                except (ValueError, json.JSONDecodeError) as e:
-                    logger.error(f"JSON decode error in Talis5 response from {ip_address}: {e}")
-                except Exception as e:
-                    logger.error(f"Unexpected error processing Talis5 data from {ip_address}: {e}")
+                logger.info("Using Talis5 endpoint for %s with battery version %s", ip_address, battery_version, extra=SUCCESS)
                 
+                talis_loggers_count = self._fetch_logger_count(
+                    ip_address, TALIS_LOGGER_PATH, battery_version, Headers,
+                    self._stream_count_talis_loggers, self._count_talis_loggers, "Talis5"
+                )
+                complete = complete and talis_loggers_count is not None
+                talis_loggers_count = talis_loggers_count or 0
                 total_loggers_count += talis_loggers_count
                 
                 # For MIX TALIS5, we also need to check the JSPro endpoint
                 if "MIX" in battery_version.upper():
-                    logger.info(f"MIX TALIS5 detected, also checking JSPro endpoint for {ip_address}")
-                    jspro_loggers_count = 0
-                    
-                    # Try fetching JSPro data with better error handling
-                    try:
-                        response_jspro = requests.get(f"http://{ip_address}/api/logger", headers=Headers, timeout=10)
-                        response_jspro.raise_for_status()
-                        data_jspro = response_jspro.json()
-                        
-                        # Handle JSPro response structure
-                        if "data" in data_jspro:
-                            logger.info(f"site {ip_address} message: {data_jspro.get('message')}")
-                            if data_jspro.get("message") == "Success":
-                                jspro_data = len(data_jspro["data"])
-                                jspro_loggers_count = jspro_data
-                                logger.info(f"JSPro loggers count: {jspro_loggers_count}")
-                            else:
-                                # Fallback if message isn't "Success" but data exists
-                                jspro_loggers_count = len(data_jspro.get("data", []))
-                                logger.info(f"JSPro loggers count (from data array): {jspro_loggers_count}")
-                        else:
-                            jspro_loggers_count = len(data_jspro.get("data", []))
-                            logger.info(f"JSPro loggers count (from data array): {jspro_loggers_count}")
-                            
-                    except requests.exceptions.RequestException as e:
-                        logger.error(f"Error fetching JSPro data from {ip_address}: {e}")
-                    except (ValueError, json.JSONDecodeError) as e:
-                        logger.error(f"JSON decode error in JSPro response from {ip_address}: {e}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error processing JSPro data from {ip_address}: {e}")
+                    logger.info("MIX TALIS5 detected, also checking JSPro endpoint for %s", ip_address, extra=SUCCESS)
+                    jspro_loggers_count = self._fetch_logger_count(
+                        ip_address, JSPRO_LOGGER_PATH, battery_version, Headers,
+                        self._stream_count_mix_jspro_loggers, self._count_mix_jspro_loggers, "JSPro"
+                    )
+                    complete = complete and jspro_loggers_count is not None
+                    jspro_loggers_count = jspro_loggers_count or 0
                     
                     total_loggers_count += jspro_loggers_count
-                    logger.info(f"Total loggers for MIX TALIS5: Talis={talis_loggers_count}, JSPro={jspro_loggers_count}, Combined={total_loggers_count}")
+                    logger.info("Total loggers for MIX TALIS5: Talis=%s, JSPro=%s, Combined=%s", talis_loggers_count, jspro_loggers_count, total_loggers_count, extra=SUCCESS)
             
             else:
                 # Default to JSPro endpoint for all other battery types
-                logger.info(f"Using JSPro endpoint for {ip_address} with battery version {battery_version}")
+                logger.info("Using JSPro endpoint for %s with battery version %s", ip_address, battery_version, extra=SUCCESS)
                 
-                # Try fetching JSPro data with better error handling
-                try:
-                    response = requests.get(f"http://{ip_address}/api/logger", headers=Headers, timeout=10)
-                    response.raise_for_status()
-                    data = response.json()
-                    
-                    # Handle JSPro response structure
-                    if isinstance(data, list):
-                        total_loggers_count = len(data)
-                        logger.info(f"JSPro loggers count: {total_loggers_count}")
-                    else:
-                        logger.error(f"Unexpected JSPro data structure from {ip_address}: {type(data)}")
-                        
-                except requests.exceptions.RequestException as e:
-                    logger.error(f"Error fetching JSPro data from {ip_address}: {e}")
-                except (ValueError, json.JSONDecodeError) as e:
-                    logger.error(f"JSON decode error in JSPro response from {ip_address}: {e}")
-                except Exception as e:
-                    logger.error(f"Unexpected error processing JSPro data from {ip_address}: {e}")
+                jspro_loggers_count = self._fetch_logger_count(
+                    ip_address, JSPRO_LOGGER_PATH, battery_version, Headers,
+                    self._stream_count_jspro_loggers, self._count_jspro_loggers, "JSPro"
+                )
+                complete = jspro_loggers_count is not None
+                total_loggers_count = jspro_loggers_count or 0
+            
+            if complete:
+                self.logger_cache.put(ip_address, battery_version, total_loggers_count)
             
             # Calculate response time
             end_time = datetime.now()
@@ -372,7 +813,7 @@ class SiteInfoFetcher:
             }
             
         except Exception as e:
-            logger.error(f"Unexpected error in length_loggers_site for {ip_address}: {e}")
+            logger.error("Unexpected error in length_loggers_site for %s: %s", ip_address, e)
             return {
                 "success": False,
                 "response_time": None,
@@ -380,45 +821,345 @@ class SiteInfoFetcher:
                 "error": str(e),
                 "battery_version": battery_version
             }
+    
+    def _fetch_logger_count(self, ip_address, path, battery_version, headers, stream_count, count_loggers, label):
+        """
+        Fetch one logger endpoint and count its loggers
+        
+        The request is conditional on the validators (ETag / Last-Modified) from
+        the previous fetch; a 304 reuses the count stored with them. The body is
+        counted as it streams (stream_count); if it isn't shaped as expected it
+        is fully parsed and counted with count_loggers instead.
+        
+        Returns:
+            int: Logger count, or None if the endpoint failed or answered unexpectedly
+        """
+        try:
+            conditional = self.logger_cache.conditional_headers(ip_address, path, battery_version)
+            url = f"http://{ip_address}{path}"
+            with requests.get(url, headers={**headers, **conditional}, timeout=10, stream=True) as response:
+                if response.status_code == 304 and conditional:
+                    LOGGER_ENDPOINT_REQUESTS.inc(1, 'not_modified')
+                    count = self.logger_cache.endpoint_count(ip_address, path, battery_version)
+                    logger.info("%s loggers not modified for %s: %s", label, ip_address, count, extra=SUCCESS)
+                    return count
+                
+                response.raise_for_status()
+                
+                # Keep the first bytes of the body in case we need a full parse
+                buffered = []
+                buffered_size = 0
+                def chunks():
+                    nonlocal buffered, buffered_size
+                    for chunk in response.iter_content(chunk_size=LOGGER_STREAM_CHUNK_BYTES):
+                        if buffered is not None:
+                            buffered_size += len(chunk)
+                            if buffered_size <= LOGGER_STREAM_BUFFER_BYTES:
+                                buffered.append(chunk)
+                            else:
+                                buffered = None
+                        yield chunk
+                
+                try:
+                    count = stream_count(chunks(), ip_address)
+                except UnexpectedStructure as e:
+                    logger.info("Falling back to full parse of %s response from %s: %s", label, ip_address, e)
+                    if buffered is not None:
+                        data = json.loads(b''.join(buffered))
+                    else:
+                        data = requests.get(url, headers=headers, timeout=10).json()
+                    count = count_loggers(data, ip_address)
+            LOGGER_ENDPOINT_REQUESTS.inc(1, 'ok')
+            if count is not None:
+                self.logger_cache.put_endpoint(ip_address, path, battery_version, response, count)
+            return count
+            
+        except requests.exceptions.RequestException as e:
+            logger.error("Error fetching %s data from %s: %s", label, ip_address, e)
+        except (ValueError, json.JSONDecodeError) as e:
+            logger.error("JSON decode error in %s response from %s: %s", label, ip_address, e)
+        except Exception as e:
+            logger.error("Unexpected error processing %s data from %s: %s", label, ip_address, e)
+        LOGGER_ENDPOINT_REQUESTS.inc(1, 'error')
+        return None
+    
+    @staticmethod
+    def _stream_count_talis_loggers(chunks, ip_address):
+        """Streaming Talis5 count; only handles a "Success" response with array interfaces"""
+        scan = count_json_arrays(chunks, TALIS_ARRAY_PATHS, value_paths=[('message',)])
+        if scan.root_type != 'object' or 'data' not in scan.root_keys:
+            raise UnexpectedStructure("missing 'data' key")
+        if scan.values.get(('message',)) != "Success":
+            raise UnexpectedStructure("message is not 'Success'")
+        if any(kind != 'array' for kind in scan.types.values()):
+            raise UnexpectedStructure("interface is not an array")
+        
+        mppt_count, usb0_count, usb1_count = (scan.counts.get(path, 0) for path in TALIS_ARRAY_PATHS)
+        talis_loggers_count = mppt_count + usb0_count + usb1_count
+        logger.info("site %s message: %s", ip_address, "Success", extra=SUCCESS)
+        logger.info("Talis5 loggers: MPPT=%s, USB0=%s, USB1=%s, Talis Total=%s", mppt_count, usb0_count, usb1_count, talis_loggers_count, extra=SUCCESS)
+        return talis_loggers_count
+    
+    @staticmethod
+    def _count_talis_loggers(data_talis, ip_address):
+        """Count Talis5 loggers: sum of the mppt, usb0 and usb1 arrays"""
+        if "data" not in data_talis:
+            logger.warning("Unexpected Talis5 response structure from %s: Missing 'data' key", ip_address)
+            return None
+        
+        logger.info("site %s message: %s", ip_address, data_talis.get('message'))
+        if data_talis.get("message") == "Success":
+            talis_data = data_talis["data"]
+            # Sum the length of arrays for each interface
+            mppt_count = len(talis_data.get("mppt", []))
+            usb0_count = len(talis_data.get("usb0", []))
+            usb1_count = len(talis_data.get("usb1", []))
+            
+            talis_loggers_count = mppt_count + usb0_count + usb1_count
+            logger.info("Talis5 loggers: MPPT=%s, USB0=%s, USB1=%s, Talis Total=%s", mppt_count, usb0_count, usb1_count, talis_loggers_count, extra=SUCCESS)
+        else:
+            # Fallback if message isn't "Success" but data exists
+            talis_loggers_count = len(data_talis.get("data", []))
+            logger.info("Talis5 loggers count (from data array): %s", talis_loggers_count, extra=SUCCESS)
+        return talis_loggers_count
+    
+    @staticmethod
+    def _stream_count_mix_jspro_loggers(chunks, ip_address):
+        """Streaming JSPro count on a MIX TALIS5 site; handles an object with a 'data' array"""
+        scan = count_json_arrays(chunks, [('data',)], value_paths=[('message',)])
+        if scan.root_type != 'object' or scan.types.get(('data',), 'array') != 'array':
+            raise UnexpectedStructure("'data' is not an array")
+        
+        if 'data' in scan.root_keys:
+            logger.info("site %s message: %s", ip_address, scan.values.get(('message',)))
+        jspro_loggers_count = scan.counts.get(('data',), 0)
+        logger.info("JSPro loggers count (from data array): %s", jspro_loggers_count, extra=SUCCESS)
+        return jspro_loggers_count
+    
+    @staticmethod
+    def _count_mix_jspro_loggers(data_jspro, ip_address):
+        """Count JSPro loggers on a MIX TALIS5 site: length of the data array"""
+        if "data" in data_jspro:
+            logger.info("site %s message: %s", ip_address, data_jspro.get('message'))
+        jspro_loggers_count = len(data_jspro.get("data", []))
+        logger.info("JSPro loggers count (from data array): %s", jspro_loggers_count, extra=SUCCESS)
+        return jspro_loggers_count
+    
+    @staticmethod
+    def _stream_count_jspro_loggers(chunks, ip_address):
+        """Streaming JSPro count; handles a bare list"""
+        scan = count_json_arrays(chunks, [()])
+        if scan.root_type != 'array':
+            raise UnexpectedStructure("response is not a list")
+        
+        logger.info("JSPro loggers count: %s", scan.counts[()], extra=SUCCESS)
+        return scan.counts[()]
+    
+    @staticmethod
+    def _count_jspro_loggers(data, ip_address):
+        """Count JSPro loggers: the response is a bare list"""
+        if isinstance(data, list):
+            logger.info("JSPro loggers count: %s", len(data), extra=SUCCESS)
+            return len(data)
+        logger.error("Unexpected JSPro data structure from %s: %s", ip_address, type(data))
+        return None
+
+def run_worker(worker_index=0):
+    """
+    Work through the current distributed sweep until every job is done.
+    
+    Jobs are claimed in batches with a lease; the lease is renewed right before
+    each site is probed, and a site's results are written in the transaction
+    that completes its job, only while the lease is still live. A site whose
+    lease expired (e.g. its worker crashed or stalled) is re-claimed by another
+    worker, and the late worker's results are dropped, so it is never recorded twice.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    fetcher = SiteInfoFetcher(url)
+    
+    run_id = Database.open_distributed_sweep(fetcher.fetch_site_info, sweep_interval)
+    if run_id is None:
+        logger.error("Worker %s could not join a distributed sweep", worker_id)
+        return []
+    logger.info("Worker %s (#%s) joined distributed sweep %s", worker_id, worker_index, run_id)
+    
+    def store(timestamp, pr_code, site_name, ip_address, battery_version,
+              ping_success, ping_time_ms, length_loggers_data):
+        """Write a site's results with its job's completion, only while this worker's lease is live"""
+        ping_rows = [(timestamp, pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms, None)]
+        logger_rows = [(pr_code, length_loggers_data, timestamp)] if ping_success else []
+        with metrics.SWEEP_STAGE_SECONDS.time('db_ping_log'):
+            if Database.complete_sweep_job(run_id, pr_code, worker_id, 'saved', ping_success, ping_rows, logger_rows):
+                return 'saved', True
+        logger.warning("Job %s not completed (lease expired or database error), dropping its results", pr_code)
+        return 'lease_lost', False
+    
+    results = []
+    while True:
+        sites = Database.claim_sweep_jobs(run_id, worker_id, sweep_batch_size, sweep_lease_seconds)
+        
+        if not sites:
+            if Database.finish_distributed_sweep(run_id):
+                logger.info("Worker %s closed distributed sweep %s", worker_id, run_id)
+                break
+            # Other workers still hold leases; wait in case one of them dies
+            counts = Database.get_sweep_job_counts(run_id)
+            if not counts.get('pending') and not counts.get('claimed'):
+                break
+            time.sleep(sweep_poll_seconds)
+            continue
+        
+        spans = []
+        for site in sites:
+            pr_code = site.get('pr_code')
+            if not Database.renew_sweep_job(run_id, pr_code, worker_id, sweep_lease_seconds):
+                logger.warning("Lease on %s lost, leaving it to another worker", pr_code)
+                continue
+            
+            outcome, result, span = fetcher.process_site(site, store=store)
+            if outcome not in ('saved', 'lease_lost'):
+                # Nothing to write (skipped or failed); close the job if it is still ours
+                ping_success = result['ping_success'] if result else None
+                if not Database.complete_sweep_job(run_id, pr_code, worker_id, outcome or 'skipped', ping_success):
+                    logger.warning("Lease on %s expired before completion", pr_code)
+            if outcome == 'lease_lost':
+                continue
+            
+            if result is not None:
+                results.append(result)
+            if span is not None:
+                spans.append(span)
+        
+        Database.insert_sweep_spans(run_id, spans)
+        fetcher.save_state()
+    
+    logger.info("Worker %s processed %s sites in sweep %s", worker_id, len(results), run_id)
+    return results
+
+def run_workers(processes):
+    """Run distributed sweep workers in this host's process pool and collect their results"""
+    if processes <= 1:
+        return run_worker()
+    
+    # Spawned children re-import this module and start their own logging listener
+    with multiprocessing.get_context('spawn').Pool(processes, initializer=configure_logging) as pool:
+        worker_results = pool.map(run_worker, range(processes))
+    return [result for results in worker_results for result in results]
+
+def save_results(results, publisher=None):
+    """
+    Append sweep results (a list of result dicts or a FleetStore) to the local sweep archive (as backup) and log a summary
+    
+    The latest-state snapshot is published too when a SnapshotPublisher is given.
+    """
+    logger.info("Successfully processed %s sites", len(results))
+    # The fleet store yields its results in pr_code order, built one archive block at a time
+    from_fleet = isinstance(results, FleetStore)
+    
+    # Save results to the archive with proper error handling (as backup)
+    try:
+        sweep_id = SweepArchive().append_sweep(results, presorted=from_fleet)
+        logger.info("Results saved to sweep archive as sweep %s", sweep_id)
+    except (IOError, OSError) as e:
+        logger.error("Error writing to sweep archive: %s", e)
+    except TypeError as e:
+        logger.error("Error serializing results to JSON: %s", e)
+    
+    # Log a summary of results
+    success_count = results.count(UP) if from_fleet else sum(1 for r in results if r.get('ping_success'))
+    logger.info("Ping summary: %s/%s sites reachable", success_count, len(results))
+    
+    if publisher is not None:
+        publisher.publish(results)
+
+def run_combined(store):
+    """
+    Sweep every SWEEP_INTERVAL_SECONDS inside the API process (SWEEP_MODE=combined)
+    
+    Each sweep's snapshot is published to the API's SnapshotStore, which serves
+    it from memory in this process and from the snapshot file in other workers.
+    """
+    fetcher = SiteInfoFetcher(url)
+    publisher = SnapshotPublisher(store, fetcher.logger_cache.last_count)
+    while True:
+        started = time.monotonic()
+        try:
+            Database.create_tables()
+            results = fetcher.process_sites()
+            if results:
+                save_results(results, publisher)
+            else:
+                logger.warning("No sites processed")
+        except Exception as e:
+            logger.error("An unexpected error occurred in the combined sweeper: %s", e)
+        finally:
+            if metrics_textfile:
+                metrics.write_textfile(metrics_textfile)
+        time.sleep(max(0, sweep_interval - (time.monotonic() - started)))
 
-def main():
+def main(distributed=False, processes=1, schedule=False):
+    # Expose sweep metrics while running if a port is configured
+    if metrics_port:
+        try:
+            metrics.start_http_server(metrics_port)
+        except OSError as e:
+            logger.error("Could not start metrics server on port %s: %s", metrics_port, e)
+    
     try:
         # Initialize the database (create tables if needed)
         try:
             Database.create_tables()
             logger.info("Database initialized successfully")
         except Exception as db_error:
-            logger.error(f"Database initialization failed: {db_error}")
-            # Continue execution, we'll still save to JSON
-        
-        # Initialize the fetcher with the API URL
-        fetcher = SiteInfoFetcher(url)
+            logger.error("Database initialization failed: %s", db_error)
+            # Continue execution, we'll still save to the sweep archive
         
-        # Process sites (fetch, filter and ping)
-        results = fetcher.process_sites()
-        
-        if results:
-            logger.info(f"Successfully processed {len(results)} sites")
-            
-            # Save results to a file with proper error handling (as backup)
+        if schedule:
+            # Probe continuously by priority tier; results are saved once per inventory cycle
+            scheduler = ProbeScheduler(SiteInfoFetcher(url), on_cycle=save_results)
             try:
-                with open('ping_results.json', 'w', encoding='utf-8') as f:
-                    json.dump(results, f, indent=2, ensure_ascii=False)
-                logger.info("Results saved to ping_results.json")
-            except IOError as e:
-                logger.error(f"Error writing to ping_results.json: {e}")
-            except TypeError as e:
-                logger.error(f"Error serializing results to JSON: {e}")
+                scheduler.run_forever()
+            except KeyboardInterrupt:
+                scheduler.stop()
+            return
+        elif distributed:
+            # Share the sweep with workers on other processes/hosts through Postgres
+            results = run_workers(processes)
+        else:
+            # Initialize the fetcher with the API URL
+            fetcher = SiteInfoFetcher(url)
             
-            # Log a summary of results
-            success_count = sum(1 for r in results if r.get('ping_success'))
-            logger.info(f"Ping summary: {success_count}/{len(results)} sites reachable")
+            # Process sites (fetch, filter and ping)
+            results = fetcher.process_sites()
+        
+        if results:
+            save_results(results)
         else:
             logger.warning("No sites processed")
     except Exception as e:
-        logger.error(f"An unexpected error occurred: {e}")
+        logger.error("An unexpected error occurred: %s", e)
+    finally:
+        # Push file for the node_exporter textfile collector
+        if metrics_textfile:
+            metrics.write_textfile(metrics_textfile)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Ping & loggers sweeper")
+    parser.add_argument('--distributed', action='store_true',
+                        default=os.getenv('SWEEP_MODE', 'serial') == 'distributed',
+                        help="Claim sites from the shared sweep_jobs table instead of probing the whole fleet")
+    parser.add_argument('--processes', type=int, default=int(os.getenv('SWEEP_PROCESSES', 1)),
+                        help="Number of distributed worker processes on this host")
+    parser.add_argument('--schedule', action='store_true',
+                        default=os.getenv('SWEEP_MODE', 'serial') == 'schedule',
+                        help="Run continuously, probing each site at an interval based on its priority tier")
+    args = parser.parse_args()
+    
+    configure_logging()
+    if os.getenv('SWEEP_MODE') == 'combined':
+        # The API runs the sweeper in combined mode; a second one would probe every site twice
+        logger.warning("SWEEP_MODE=combined: the sweeper runs inside the API, not starting main.py")
+        raise SystemExit(0)
+    main(distributed=args.distributed, processes=args.processes, schedule=args.schedule)
     logger.info("Ping log tracker script completed.")
-    logger.info(f"Script run time: {datetime.now()}")
+    logger.info("Script run time: %s", datetime.now())
@@ -0,0 +1,361 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Prometheus text exposition format
+CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bucket upper bounds in seconds, tuned for probe/HTTP/DB latencies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class for a labelled metric family registered in REGISTRY"""
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        REGISTRY.register(self)
+
+    def _child(self, labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        lines.extend(self.collect())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Monotonic counter"""
+    metric_type = 'counter'
+
+    def _new_child(self):
+        return [0.0]
+
+    def inc(self, amount=1, *labelvalues):
+        child = self._child(labelvalues)
+        with self._lock:
+            child[0] += amount
+
+    def collect(self):
+        with self._lock:
+            items = [(labels, child[0]) for labels, child in self._children.items()]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in items
+        ]
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+    metric_type = 'gauge'
+
+    def _new_child(self):
+        return [0.0]
+
+    def set(self, value, *labelvalues):
+        child = self._child(labelvalues)
+        with self._lock:
+            child[0] = value
+
+    def inc(self, amount=1, *labelvalues):
+        child = self._child(labelvalues)
+        with self._lock:
+            child[0] += amount
+
+    def collect(self):
+        with self._lock:
+            items = [(labels, child[0]) for labels, child in self._children.items()]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in items
+        ]
+
+
+class Histogram(_Metric):
+    """Fixed-bucket histogram; observe() is a bisect plus two additions under a lock"""
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        # Per-bucket counts (last slot is +Inf), then sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value, *labelvalues):
+        child = self._child(labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            child[index] += 1
+            child[-1] += value
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def collect(self):
+        with self._lock:
+            items = [(labels, list(child)) for labels, child in self._children.items()]
+        lines = []
+        bounds = self.buckets + (float('inf'),)
+        for labels, child in items:
+            cumulative = 0
+            for bound, count in zip(bounds, child[:-1]):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, labels, ('le', _format_value(float(bound))))} {cumulative}"
+                )
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {_format_value(child[-1])}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class _Timer:
+    """
+    Context manager observing elapsed wall time into a histogram, less the time
+    the thread spent acquiring database connections (the db_connect stage)
+    """
+    __slots__ = ('histogram', 'labelvalues', 'start', 'connect_start', 'elapsed')
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+        self.start = None
+        self.connect_start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.connect_start = connect_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.start - (connect_seconds() - self.connect_start)
+        self.histogram.observe(self.elapsed, *self.labelvalues)
+        return False
+
+
+# Seconds each thread has spent acquiring database connections
+_connects = threading.local()
+
+
+def connect_seconds():
+    return getattr(_connects, 'seconds', 0.0)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def generate_latest(self):
+        """Render every registered metric in Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def generate_latest():
+    return REGISTRY.generate_latest()
+
+
+# Sweep metrics (main.py)
+SWEEP_STAGE_SECONDS = Histogram(
+    'ping_tracker_sweep_stage_seconds',
+    'Duration of each sweep stage (inventory_fetch, icmp_probe, tcp_probe, http_fallback, logger_fetch, '
+    'db_connect, db_bulk_write, db_ping_log, db_length_loggers)',
+    ('stage',)
+)
+SWEEP_DURATION_SECONDS = Histogram(
+    'ping_tracker_sweep_duration_seconds',
+    'Duration of a full sweep over the site inventory',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 900, 1800, 3600)
+)
+SWEEP_SITES_TOTAL = Counter(
+    'ping_tracker_sweep_sites_total',
+    'Sites processed by the sweeper, by outcome',
+    ('outcome',)
+)
+SWEEP_LAST_SUCCESS_TIMESTAMP = Gauge(
+    'ping_tracker_sweep_last_completed_timestamp_seconds',
+    'Unix time the last sweep completed'
+)
+
+# Database metrics (db_utils.py)
+DB_QUERY_SECONDS = Histogram(
+    'ping_tracker_db_query_seconds',
+    'Latency of Database methods',
+    ('method',)
+)
+DB_QUERY_ROWS_TOTAL = Counter(
+    'ping_tracker_db_query_rows_total',
+    'Rows returned or written by Database methods',
+    ('method',)
+)
+DB_QUERY_ERRORS_TOTAL = Counter(
+    'ping_tracker_db_query_errors_total',
+    'Database methods that raised an exception',
+    ('method',)
+)
+
+# API metrics (api.py)
+HTTP_REQUEST_SECONDS = Histogram(
+    'ping_tracker_http_request_seconds',
+    'Latency of Flask routes',
+    ('route', 'method', 'status')
+)
+
+
+def _row_count(result):
+    """Best-effort row count for a Database method result"""
+    if isinstance(result, bool):
+        return int(result)
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, dict):
+        return 1 if result else 0
+    return 0
+
+
+def instrument_query(func):
+    """
+    Decorator recording latency, row count and exceptions of a Database method
+
+    The latency leaves out connection acquisition, which instrument_connect
+    records on its own.
+    """
+    method = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        connect_start = connect_seconds()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            DB_QUERY_ERRORS_TOTAL.inc(1, method)
+            raise
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start - (connect_seconds() - connect_start), method)
+        rows = _row_count(result)
+        if rows:
+            DB_QUERY_ROWS_TOTAL.inc(rows, method)
+        return result
+
+    return wrapper
+
+
+def instrument_connect(func):
+    """
+    Decorator for Database.get_connection: its latency is the db_connect stage
+    (and its method's latency), kept out of the stages and queries it runs in
+    """
+    method = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            DB_QUERY_ERRORS_TOTAL.inc(1, method)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _connects.seconds = connect_seconds() + elapsed
+            DB_QUERY_SECONDS.observe(elapsed, method)
+            SWEEP_STAGE_SECONDS.observe(elapsed, 'db_connect')
+
+    return wrapper
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = generate_latest().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the application log
+        pass
+
+
+def start_http_server(port, addr='0.0.0.0'):
+    """Serve /metrics from a daemon thread; returns the server"""
+    server = ThreadingHTTPServer((addr, int(port)), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logger.info("Metrics server listening on %s:%s", addr, port)
+    return server
+
+
+def write_textfile(path):
+    """Atomically write metrics to a file (node_exporter textfile collector format)"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(generate_latest())
+        os.replace(tmp_path, path)
+    except IOError as e:
+        logger.error("Error writing metrics to %s: %s", path, e)
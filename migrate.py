@@ -11,6 +11,59 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# (version, description, sql); applied in order, each at most once
+MIGRATIONS = [
+    (1, "Add battery_version to ping_logs", '''
+        ALTER TABLE ping_logs ADD COLUMN IF NOT EXISTS battery_version VARCHAR(20)
+    '''),
+    (2, "Covering index for the latest-first ping_logs / length_loggers listings", '''
+        CREATE INDEX IF NOT EXISTS idx_ping_logs_timestamp_desc
+        ON ping_logs (timestamp DESC)
+        INCLUDE (pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms, length_loggers)
+    '''),
+    (3, "Index for listings filtered by site_name", '''
+        CREATE INDEX IF NOT EXISTS idx_ping_logs_site_name_timestamp
+        ON ping_logs (site_name, timestamp DESC)
+    '''),
+    (4, "Covering index for the latest row per pr_code (summary and down sites)", '''
+        CREATE INDEX IF NOT EXISTS idx_ping_logs_pr_code_timestamp
+        ON ping_logs (pr_code, timestamp DESC)
+        INCLUDE (ping_success, ping_time_ms, site_name, ip_address, battery_version)
+    '''),
+    (5, "Partial index for the average response time of successful pings", '''
+        CREATE INDEX IF NOT EXISTS idx_ping_logs_success_timestamp
+        ON ping_logs (timestamp)
+        INCLUDE (ping_time_ms)
+        WHERE ping_success = TRUE AND ping_time_ms IS NOT NULL
+    '''),
+    (6, "Partial index for the latest logger count per pr_code", '''
+        CREATE INDEX IF NOT EXISTS idx_ping_logs_loggers_pr_code_timestamp
+        ON ping_logs (pr_code, timestamp DESC)
+        INCLUDE (length_loggers)
+        WHERE length_loggers IS NOT NULL
+    '''),
+    (7, "Partial index for flapping and degrading sites", '''
+        CREATE INDEX IF NOT EXISTS idx_site_health_unstable
+        ON site_health (recent_transitions DESC, ewma_rtt_ms DESC NULLS LAST)
+        WHERE status IN ('flapping', 'degrading')
+    '''),
+    (8, "Add upstream_down to ping_logs (TRUE for sites skipped behind a group outage)", '''
+        ALTER TABLE ping_logs ADD COLUMN IF NOT EXISTS upstream_down BOOLEAN
+    '''),
+    (9, "Cover upstream_down in the latest-first listing index", '''
+        DROP INDEX IF EXISTS idx_ping_logs_timestamp_desc;
+        CREATE INDEX idx_ping_logs_timestamp_desc
+        ON ping_logs (timestamp DESC)
+        INCLUDE (pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms, length_loggers, upstream_down)
+    '''),
+    (10, "Cover upstream_down in the latest row per pr_code index", '''
+        DROP INDEX IF EXISTS idx_ping_logs_pr_code_timestamp;
+        CREATE INDEX idx_ping_logs_pr_code_timestamp
+        ON ping_logs (pr_code, timestamp DESC)
+        INCLUDE (ping_success, ping_time_ms, site_name, ip_address, battery_version, upstream_down)
+    '''),
+]
+
 def check_column_exists(cursor, table_name, column_name):
     """Check if column exists in table"""
     cursor.execute("""
@@ -31,14 +84,18 @@ def run_migrations():
         cursor = connection.cursor()
     
         # Migration process
-        # logger.info("Add new fields 'length_loggers' to ping_logs table")
-        # if not check_column_exists(cursor, 'ping_logs', 'length_loggers'):
-        #     cursor.execute("ALTER TABLE ping_logs ADD COLUMN length_loggers INTEGER")
-        #     logger.info("Added length_loggers column to ping_logs table")
-
-        # # Commit all changes
-        # connection.commit()
-        # logger.info("Database migration completed successfully.")
+        create_migration_version_table(cursor)
+        latest_version = get_latest_migration_version(cursor)
+        
+        for version, description, sql in MIGRATIONS:
+            if version <= latest_version:
+                continue
+            logger.info("Applying migration %s: %s", version, description)
+            apply_migration(cursor, version, description, sql)
+        
+        # Commit all changes
+        connection.commit()
+        logger.info("Database migration completed successfully.")
         
     except Exception as e:
         logger.error(f"Error during migration: {e}")
@@ -78,5 +135,6 @@ def apply_migration(cursor, version, description, sql):
     )
 
 if __name__ == "__main__":
+    Database.create_tables()
     run_migrations()
-    logger.info("Migration process completed.")
\ No newline at end of file
+    logger.info("Migration process completed.")
@@ -0,0 +1,85 @@
+import os
+import logging
+import ipaddress
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Sites are grouped by this IPv4 prefix length unless a named group covers them (0, the default, disables it)
+OUTAGE_PREFIX_LENGTH = int(os.getenv('OUTAGE_PREFIX_LENGTH', 0))
+# Named groups of sites behind one gateway or backhaul: "name=cidr,cidr;name=cidr"
+OUTAGE_GROUPS = os.getenv('OUTAGE_GROUPS', '')
+# Sentinels probed first in each group; if all of them fail the rest are skipped
+OUTAGE_SENTINELS = int(os.getenv('OUTAGE_SENTINELS', 2))
+# Groups smaller than this are always probed in full
+OUTAGE_MIN_GROUP_SIZE = int(os.getenv('OUTAGE_MIN_GROUP_SIZE', 4))
+
+OUTAGE_GROUPS_DOWN = metrics.Gauge(
+    'ping_tracker_outage_groups_down',
+    'Site groups whose sentinels all failed in the last sweep'
+)
+OUTAGE_SITES_SKIPPED = metrics.Gauge(
+    'ping_tracker_outage_sites_skipped',
+    'Sites marked upstream down without a probe in the last sweep'
+)
+
+
+def parse_groups(spec):
+    """Parse OUTAGE_GROUPS into (network, name) pairs, most specific network first"""
+    networks = []
+    for entry in filter(None, (part.strip() for part in spec.split(';'))):
+        name, _, cidrs = entry.partition('=')
+        for cidr in filter(None, (part.strip() for part in cidrs.split(','))):
+            try:
+                networks.append((ipaddress.ip_network(cidr, strict=False), name.strip()))
+            except ValueError:
+                logger.warning("Ignoring invalid network %s in OUTAGE_GROUPS", cidr)
+    return sorted(networks, key=lambda item: item[0].prefixlen, reverse=True)
+
+
+class SiteGrouper:
+    """
+    Groups sites that share an upstream path.
+
+    A site's group is, in order: its 'gateway' field from the inventory, the
+    most specific OUTAGE_GROUPS network holding its IP address, or its
+    /OUTAGE_PREFIX_LENGTH subnet. Sites without a group are probed on their own.
+    Sites are grouped once, when the fleet store loads them.
+    """
+
+    def __init__(self, spec=OUTAGE_GROUPS, prefix_length=OUTAGE_PREFIX_LENGTH):
+        self.networks = parse_groups(spec)
+        self.prefix_length = prefix_length
+
+    def group_key(self, site):
+        gateway = site.get('gateway')
+        if gateway:
+            return f"gw:{gateway}"
+        try:
+            address = ipaddress.ip_address(site.get('ip_address') or site.get('ip_site') or '')
+        except ValueError:
+            return None
+        for network, name in self.networks:
+            if address in network:
+                return name
+        if self.prefix_length and address.version == 4:
+            return str(ipaddress.ip_network(f"{address}/{self.prefix_length}", strict=False))
+        return None
+
+
+def pick_sentinels(sites, health, count=OUTAGE_SENTINELS):
+    """
+    Split a group into (sentinels, rest)
+
+    Sites last seen up come first, and among them the least recently probed,
+    so sentinels rotate through the group while it is down and sites skipped
+    in one sweep are probed directly in a later one.
+    """
+    def priority(site):
+        record = health.sites.get(site.get('pr_code'))
+        if record is None:
+            return (1, 0)
+        return (0 if record.up else 1, record.last_probe or 0)
+
+    ordered = sorted(sites, key=priority)
+    return ordered[:count], ordered[count:]
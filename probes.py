@@ -0,0 +1,332 @@
+import os
+import time
+import errno
+import socket
+import logging
+import platform
+import selectors
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Default backend chain, tried in order until one reaches the site
+PROBE_CHAIN = os.getenv('PROBE_CHAIN', 'icmp,http')
+# Per-site chains: "PR#141=tcp:502,icmp;PR#135=http"; these override the inventory's probe_chain
+PROBE_SITE_CHAINS = os.getenv('PROBE_SITE_CHAINS', '')
+# Seconds each probe waits for an answer
+PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', 10))
+# Port of 'tcp' entries that don't name one
+PROBE_TCP_PORT = int(os.getenv('PROBE_TCP_PORT', 80))
+# Probes in flight at once when a batch of sites is probed
+PROBE_BATCH_SIZE = int(os.getenv('PROBE_BATCH_SIZE', 64))
+
+
+def _failure(error):
+    return {"success": False, "response_time": None, "error": error}
+
+
+def _abort(abort):
+    try:
+        abort()
+    except OSError:
+        # Already finished
+        pass
+
+
+class ProbeCancel:
+    """
+    Cancels the probes of one hedged race.
+
+    A probe registers a callable that aborts it before it starts waiting.
+    Once the race is cancelled, registering aborts right away, so a probe
+    that only starts after the winner answered is stopped too.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._aborts = []
+        self._lock = threading.Lock()
+
+    def register(self, abort):
+        """Keep abort for cancel(); if the race is already cancelled, call it now and return False"""
+        with self._lock:
+            if not self.cancelled:
+                self._aborts.append(abort)
+                return True
+        _abort(abort)
+        return False
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            aborts, self._aborts = self._aborts, []
+        for abort in aborts:
+            _abort(abort)
+
+
+class ProbeBackend:
+    """
+    One way of checking that a site is reachable.
+
+    probe() checks one address; with a ProbeCancel it registers how to abort
+    itself, so a hedged probe can stop the loser. probe_batch() checks many addresses at
+    once, PROBE_BATCH_SIZE at a time; backends override it when they can do
+    better than a thread per address.
+    """
+    name = None
+    # Value of a result's "method" and of the site's remembered probe method
+    method = None
+    # SWEEP_STAGE_SECONDS stage label
+    stage = None
+
+    def __init__(self, timeout=PROBE_TIMEOUT):
+        self.timeout = timeout
+
+    def probe(self, ip_address, cancel=None):
+        raise NotImplementedError
+
+    def probe_batch(self, ip_addresses):
+        """{ip_address: result} for every address"""
+        with ThreadPoolExecutor(max_workers=max(1, min(PROBE_BATCH_SIZE, len(ip_addresses)))) as pool:
+            return dict(zip(ip_addresses, pool.map(self.probe, ip_addresses)))
+
+    def __repr__(self):
+        return self.name
+
+
+class IcmpProbe(ProbeBackend):
+    """One echo request with the system ping command"""
+    name = 'icmp'
+    method = 'system_ping'
+    stage = 'icmp_probe'
+
+    def _command(self, ip_address):
+        if platform.system().lower() == "windows":
+            return ["ping", "-n", "1", "-w", str(int(self.timeout * 1000)), ip_address]
+        return ["ping", "-c", "1", "-W", str(max(1, int(self.timeout))), ip_address]
+
+    @staticmethod
+    def _parse(stdout):
+        if platform.system().lower() == "windows":
+            reply_marker, time_suffix = "Reply from", "ms"
+        else:
+            reply_marker, time_suffix = " 0% packet loss", " "
+        if reply_marker not in stdout:
+            return _failure("no reply")
+        time_str = stdout.split("time=")[1].split(time_suffix)[0].strip() if "time=" in stdout else None
+        return {"success": True, "response_time": float(time_str) if time_str else 0}
+
+    def _spawn(self, ip_address):
+        return subprocess.Popen(
+            self._command(ip_address), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+
+    def probe(self, ip_address, cancel=None):
+        if cancel is not None and cancel.cancelled:
+            return _failure("cancelled")
+        try:
+            process = self._spawn(ip_address)
+        except OSError as e:
+            return _failure(str(e))
+        # A process spawned while the race was being cancelled is killed here
+        if cancel is not None:
+            cancel.register(process.kill)
+        stdout, _ = process.communicate()
+        return self._parse(stdout)
+
+    def probe_batch(self, ip_addresses):
+        """One ping process per address, PROBE_BATCH_SIZE running at a time"""
+        results = {}
+        for start in range(0, len(ip_addresses), PROBE_BATCH_SIZE):
+            processes = {}
+            for ip_address in ip_addresses[start:start + PROBE_BATCH_SIZE]:
+                try:
+                    processes[ip_address] = self._spawn(ip_address)
+                except OSError as e:
+                    results[ip_address] = _failure(str(e))
+            for ip_address, process in processes.items():
+                stdout, _ = process.communicate()
+                results[ip_address] = self._parse(stdout)
+        return results
+
+
+class TcpConnectProbe(ProbeBackend):
+    """
+    TCP handshake to a port, closed without sending anything.
+
+    A refused connection also counts as reachable: the site answered with a
+    RST, so it is up even if nothing listens on the port.
+    """
+    name = 'tcp'
+    method = 'tcp_connect'
+    stage = 'tcp_probe'
+
+    def __init__(self, port=PROBE_TCP_PORT, timeout=PROBE_TIMEOUT):
+        super().__init__(timeout)
+        self.port = port
+
+    @staticmethod
+    def _result(error_code, elapsed):
+        if error_code in (0, errno.ECONNREFUSED):
+            return {"success": True, "response_time": elapsed * 1000}
+        return _failure(os.strerror(error_code))
+
+    def probe(self, ip_address, cancel=None):
+        start = time.perf_counter()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Shutting the socket down aborts the connect
+        if cancel is not None and not cancel.register(lambda: sock.shutdown(socket.SHUT_RDWR)):
+            sock.close()
+            return _failure("cancelled")
+        try:
+            sock.settimeout(self.timeout)
+            error_code = sock.connect_ex((ip_address, self.port))
+        except socket.timeout:
+            return _failure("timed out")
+        except OSError as e:
+            return _failure(str(e))
+        finally:
+            sock.close()
+        if error_code in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return _failure("timed out")
+        return self._result(error_code, time.perf_counter() - start)
+
+    def probe_batch(self, ip_addresses):
+        """Non-blocking connects multiplexed on one selector, PROBE_BATCH_SIZE at a time"""
+        results = {}
+        for start in range(0, len(ip_addresses), PROBE_BATCH_SIZE):
+            chunk = ip_addresses[start:start + PROBE_BATCH_SIZE]
+            with selectors.DefaultSelector() as selector:
+                started = time.perf_counter()
+                for ip_address in chunk:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    try:
+                        error_code = sock.connect_ex((ip_address, self.port))
+                    except OSError as e:
+                        sock.close()
+                        results[ip_address] = _failure(str(e))
+                        continue
+                    if error_code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        selector.register(sock, selectors.EVENT_WRITE, ip_address)
+                    else:
+                        sock.close()
+                        results[ip_address] = self._result(error_code, time.perf_counter() - started)
+
+                deadline = started + self.timeout
+                while selector.get_map():
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    for key, _ in selector.select(remaining):
+                        selector.unregister(key.fileobj)
+                        error_code = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        key.fileobj.close()
+                        results[key.data] = self._result(error_code, time.perf_counter() - started)
+
+                for key in list(selector.get_map().values()):
+                    key.fileobj.close()
+                    results[key.data] = _failure("timed out")
+        return results
+
+    def __repr__(self):
+        return f"tcp:{self.port}"
+
+
+class HttpHeadProbe(ProbeBackend):
+    """
+    HEAD request to the controller's web server.
+
+    A 405 or 501 (HEAD not supported) still means the controller answered.
+    The request goes over a socket of its own, so a hedged loser is aborted
+    by shutting it down instead of waiting for the timeout.
+    """
+    name = 'http'
+    method = 'http_request'
+    stage = 'http_fallback'
+
+    def probe(self, ip_address, cancel=None):
+        start = time.perf_counter()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if cancel is not None and not cancel.register(lambda: sock.shutdown(socket.SHUT_RDWR)):
+            sock.close()
+            return _failure("cancelled")
+        connection = http.client.HTTPConnection(ip_address, timeout=self.timeout)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect((ip_address, 80))
+            connection.sock = sock
+            connection.request('HEAD', '/')
+            status = connection.getresponse().status
+        except (OSError, http.client.HTTPException) as e:
+            return _failure(str(e) or type(e).__name__)
+        finally:
+            connection.close()
+            sock.close()
+        response_time = (time.perf_counter() - start) * 1000
+        return {
+            "success": status < 400 or status in (405, 501),
+            "response_time": response_time
+        }
+
+
+def make_backend(spec):
+    """Backend for one chain entry: 'icmp', 'http', 'tcp' or 'tcp:<port>'"""
+    name, _, arg = spec.strip().lower().partition(':')
+    if name == 'icmp':
+        return IcmpProbe()
+    if name == 'http':
+        return HttpHeadProbe()
+    if name == 'tcp':
+        return TcpConnectProbe(int(arg) if arg else PROBE_TCP_PORT)
+    raise ValueError(f"unknown probe backend {spec!r}")
+
+
+class ProbeChains:
+    """
+    Resolves the backend chain of each site.
+
+    A site's chain comes from PROBE_SITE_CHAINS, else the inventory's
+    probe_chain field ("tcp:502,icmp" or a list of entries), else PROBE_CHAIN.
+    Backends are shared between sites with the same entry.
+    """
+
+    def __init__(self, default=PROBE_CHAIN, site_chains=PROBE_SITE_CHAINS):
+        self._backends = {}
+        self._chains = {}
+        self.default = self.parse(default) or (IcmpProbe(), HttpHeadProbe())
+        self.site_chains = {}
+        for entry in filter(None, (part.strip() for part in site_chains.split(';'))):
+            pr_code, _, spec = entry.partition('=')
+            chain = self.parse(spec)
+            if chain:
+                self.site_chains[pr_code.strip()] = chain
+
+    def parse(self, spec):
+        """Tuple of backends for a chain spec; invalid entries are logged and left out"""
+        if isinstance(spec, (list, tuple)):
+            spec = ','.join(spec)
+        if not spec:
+            return ()
+        chain = self._chains.get(spec)
+        if chain is None:
+            backends = []
+            for entry in filter(None, (part.strip() for part in spec.split(','))):
+                key = entry.lower()
+                try:
+                    if key not in self._backends:
+                        self._backends[key] = make_backend(key)
+                    backends.append(self._backends[key])
+                except ValueError as e:
+                    logger.warning("Ignoring probe chain entry: %s", e)
+            chain = self._chains[spec] = tuple(backends)
+        return chain
+
+    def for_site(self, site):
+        chain = self.site_chains.get(site.get('pr_code'))
+        if chain is None:
+            chain = self.parse(site.get('probe_chain'))
+        return chain or self.default
@@ -0,0 +1,99 @@
+import os
+import math
+import struct
+
+# Relative accuracy of reported quantiles (0.01 = within 1% of the true value)
+RTT_SKETCH_ACCURACY = float(os.getenv('RTT_SKETCH_ACCURACY', 0.01))
+# Width of a sketch time bucket in seconds; summary windows are rounded to it
+RTT_SKETCH_BUCKET_SECONDS = int(os.getenv('RTT_SKETCH_BUCKET_SECONDS', 3600))
+# pr_code under which the fleet-wide sketch of a bucket is stored
+FLEET = '*'
+
+if not 0 < RTT_SKETCH_ACCURACY < 1:
+    raise ValueError(f"RTT_SKETCH_ACCURACY must be between 0 and 1, got {RTT_SKETCH_ACCURACY}")
+
+_ZERO = struct.Struct('<I')
+# Bin index and count; a 32-bit index covers any RTT at any accuracy above 1e-9
+_BIN = struct.Struct('<iI')
+
+
+class RttSketch:
+    """
+    Mergeable quantile sketch of RTTs with log-spaced bins (DDSketch style).
+
+    A value v > 0 falls in bin ceil(log(v) / log(gamma)); every value in a bin
+    is within RTT_SKETCH_ACCURACY of the bin's midpoint, so any quantile is
+    too. Merging two sketches adds their bin counts. Serialized as a zero
+    count followed by (bin, count) pairs, a few hundred bytes at most.
+    """
+    __slots__ = ('bins', 'zero_count')
+
+    _gamma = (1 + RTT_SKETCH_ACCURACY) / (1 - RTT_SKETCH_ACCURACY)
+    _log_gamma = math.log(_gamma)
+
+    def __init__(self):
+        self.bins = {}
+        self.zero_count = 0
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.bins.values())
+
+    def add(self, value):
+        if value <= 0:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + 1
+
+    def merge(self, other):
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        return self
+
+    def quantile(self, q):
+        """Value at quantile q (0..1), or None if the sketch is empty"""
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return 2 * self._gamma ** index / (self._gamma + 1)
+        return 2 * self._gamma ** max(self.bins) / (self._gamma + 1)
+
+    def to_bytes(self):
+        return _ZERO.pack(self.zero_count) + b''.join(
+            _BIN.pack(index, count) for index, count in sorted(self.bins.items())
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls()
+        data = bytes(data)
+        sketch.zero_count = _ZERO.unpack_from(data)[0]
+        for index, count in _BIN.iter_unpack(data[_ZERO.size:]):
+            sketch.bins[index] = count
+        return sketch
+
+
+def merge_sketches(blobs):
+    """Merge serialized sketches into one RttSketch"""
+    merged = RttSketch()
+    for blob in blobs:
+        merged.merge(RttSketch.from_bytes(blob))
+    return merged
+
+
+def percentiles(sketch):
+    """p50/p95/p99 response times in ms, rounded like the other summary fields"""
+    result = {}
+    for name, q in (('response_time_p50', 0.5), ('response_time_p95', 0.95), ('response_time_p99', 0.99)):
+        value = sketch.quantile(q)
+        result[name] = round(value, 2) if value is not None else 0
+    return result
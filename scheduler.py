@@ -0,0 +1,339 @@
+import os
+import time
+import heapq
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from db_utils import Database
+from log_utils import site_context
+from fleet import FLEET_FLUSH_SITES, UP
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Probe interval per tier, in seconds; even stable sites are probed well within
+# the 300 s full-sweep period, so an outage anywhere is seen within a couple of minutes
+TIER_INTERVALS = {
+    'down': int(os.getenv('SCHEDULE_DOWN_INTERVAL', 15)),
+    'changed': int(os.getenv('SCHEDULE_CHANGED_INTERVAL', 30)),
+    'normal': int(os.getenv('SCHEDULE_NORMAL_INTERVAL', 60)),
+    'stable': int(os.getenv('SCHEDULE_STABLE_INTERVAL', 120)),
+}
+# A site that changed state within this window is 'changed'
+RECENT_CHANGE_WINDOW = int(os.getenv('SCHEDULE_RECENT_WINDOW', 3600))
+# A site with no state change for this long is 'stable'
+STABLE_AFTER = int(os.getenv('SCHEDULE_STABLE_AFTER', 86400))
+# Global probe rate (probes started per second): what the sites' tiers need, times
+# SCHEDULE_RATE_HEADROOM; a positive SCHEDULE_MAX_PROBES_PER_SECOND caps it
+MAX_PROBES_PER_SECOND = float(os.getenv('SCHEDULE_MAX_PROBES_PER_SECOND', 0))
+SCHEDULE_RATE_HEADROOM = float(os.getenv('SCHEDULE_RATE_HEADROOM', 1.5))
+MAX_PROBE_BURST = int(os.getenv('SCHEDULE_MAX_PROBE_BURST', 10))
+SCHEDULE_CONCURRENCY = int(os.getenv('SCHEDULE_CONCURRENCY', 8))
+# Probe results are written in bulk every FLEET_FLUSH_SITES sites or this many seconds
+SCHEDULE_FLUSH_SECONDS = float(os.getenv('SCHEDULE_FLUSH_SECONDS', 5))
+# Seconds between warnings while probes start a full tier interval late
+BEHIND_WARNING_SECONDS = 60
+# How often the inventory is re-fetched; each period is recorded as one run in the ledger
+INVENTORY_REFRESH_SECONDS = int(os.getenv('SCHEDULE_INVENTORY_REFRESH', 900))
+
+SCHEDULE_QUEUE_SITES = metrics.Gauge(
+    'ping_tracker_schedule_sites',
+    'Sites known to the probe scheduler, by tier',
+    ('tier',)
+)
+SCHEDULE_LAG_SECONDS = metrics.Histogram(
+    'ping_tracker_schedule_lag_seconds',
+    'Delay between a site being due and its probe starting',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+
+
+class TokenBucket:
+    """Blocking token bucket limiting the global probe rate"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SiteSchedule:
+    """Scheduling state of one site"""
+    __slots__ = ('pr_code', 'site', 'tier', 'next_due', 'last_success', 'last_change', 'in_flight', 'removed')
+
+    def __init__(self, pr_code, site):
+        self.pr_code = pr_code
+        self.site = site
+        self.tier = 'normal'
+        self.next_due = time.monotonic()
+        self.last_success = None
+        self.last_change = None
+        self.in_flight = False
+        self.removed = False
+
+    def update(self, success, now):
+        """Record a probe outcome and return the new tier"""
+        if self.last_success is None:
+            # No history yet: don't treat the first observation as a change
+            self.last_change = now - RECENT_CHANGE_WINDOW
+        elif success != self.last_success:
+            self.last_change = now
+        self.last_success = success
+        return self._retier(now)
+
+    def restore(self, success, changed_ago, now):
+        """Resume from a persisted state that last changed changed_ago seconds ago; returns the tier"""
+        self.last_success = success
+        self.last_change = now - changed_ago
+        return self._retier(now)
+
+    def _retier(self, now):
+        success = self.last_success
+        if not success:
+            self.tier = 'down'
+        elif now - self.last_change < RECENT_CHANGE_WINDOW:
+            self.tier = 'changed'
+        elif now - self.last_change >= STABLE_AFTER:
+            self.tier = 'stable'
+        else:
+            self.tier = 'normal'
+        return self.tier
+
+
+class ProbeScheduler:
+    """
+    Probe sites continuously from a priority queue keyed by next-due time.
+
+    Down and recently changed sites get short intervals, long-stable sites long
+    ones; probes are started no faster than the rate the tiers need and run on
+    a bounded thread pool. Results go to the fetcher's fleet store and are
+    written in bulk like a full sweep's.
+    """
+
+    def __init__(self, fetcher, on_cycle=None):
+        self.fetcher = fetcher
+        self.fleet = fetcher.fleet
+        self.on_cycle = on_cycle
+        self.sites = {}
+        self._heap = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        # Probes per second the sites' tiers need; the bucket's rate follows it
+        self._needed_rate = 0.0
+        self._bucket = TokenBucket(0, MAX_PROBE_BURST)
+        self._slots = threading.BoundedSemaphore(SCHEDULE_CONCURRENCY)
+        self._executor = ThreadPoolExecutor(max_workers=SCHEDULE_CONCURRENCY, thread_name_prefix='probe')
+        # Fleet indices probed since the last bulk write
+        self._pending = set()
+        self._next_flush = time.monotonic() + SCHEDULE_FLUSH_SECONDS
+        self._counts = {'saved': 0, 'failed': 0}
+        self._run_id = None
+        self._warned_behind_at = 0
+
+    def _push(self, state):
+        """Queue a site at its next_due time; caller holds self._cond"""
+        self._seq += 1
+        heapq.heappush(self._heap, (state.next_due, self._seq, state))
+        self._cond.notify()
+
+    def refresh_inventory(self):
+        """
+        Fetch the inventory into the fleet store, add new sites and drop removed ones
+
+        Sites with a health record resume their tier from its state and last
+        change, and are spread over their tier interval; others are due now.
+        """
+        with metrics.SWEEP_STAGE_SECONDS.time('inventory_fetch'):
+            site_data = self.fetcher.fetch_site_info()
+        if not site_data:
+            logger.warning("No sites available to schedule")
+            return
+
+        now = time.monotonic()
+        wall_now = time.time()
+        with self._cond:
+            # Loading renumbers and resets the fleet, so probes finished since the
+            # last flush are written first, with probe threads held off
+            self._flush()
+            current = {site.pr_code: site for site in self.fleet.load(site_data)}
+            for pr_code, state in list(self.sites.items()):
+                if pr_code not in current:
+                    state.removed = True
+                    del self.sites[pr_code]
+            for pr_code, site in current.items():
+                state = self.sites.get(pr_code)
+                if state is not None:
+                    state.site = site
+                    continue
+                state = self.sites[pr_code] = SiteSchedule(pr_code, site)
+                health = self.fetcher.health.sites.get(pr_code)
+                if health is not None and health.up is not None and health.last_change is not None:
+                    tier = state.restore(health.up, max(wall_now - health.last_change, 0), now)
+                    state.next_due = now + random.uniform(0, TIER_INTERVALS[tier])
+                self._push(state)
+            self._needed_rate = sum(1 / TIER_INTERVALS[state.tier] for state in self.sites.values())
+            self._update_rate()
+        if MAX_PROBES_PER_SECOND > 0 and self._needed_rate > MAX_PROBES_PER_SECOND:
+            logger.warning(
+                "%s sites need %.1f probes/s but SCHEDULE_MAX_PROBES_PER_SECOND is %s; the schedule will fall behind",
+                len(current), self._needed_rate, MAX_PROBES_PER_SECOND
+            )
+        logger.info("Scheduler tracking %s sites, %.1f probes/s", len(current), self._needed_rate)
+
+    def _update_rate(self):
+        """Follow the probe rate the tiers need; caller holds self._cond"""
+        rate = self._needed_rate * SCHEDULE_RATE_HEADROOM
+        if MAX_PROBES_PER_SECOND > 0:
+            rate = min(rate, MAX_PROBES_PER_SECOND)
+        self._bucket.rate = rate
+
+    def _start_cycle(self):
+        self._counts = {'saved': 0, 'failed': 0}
+        self._run_id = Database.start_sweep_run(SCHEDULE_CONCURRENCY, len(self.sites), mode='scheduled')
+
+    def _flush(self):
+        """Write the results probed since the last flush in bulk"""
+        self._next_flush = time.monotonic() + SCHEDULE_FLUSH_SECONDS
+        with self._cond:
+            indices = sorted(self._pending)
+            self._pending = set()
+        if not indices:
+            return
+        outcome = self.fetcher.write_fleet(indices)
+        with self._cond:
+            self._counts['saved' if outcome in ('saved', 'spooled') else 'failed'] += len(indices)
+
+    def _finish_cycle(self):
+        """Write pending results, the cycle's spans and counts to the run ledger, and hand the fleet to on_cycle"""
+        self._flush()
+        with self._cond:
+            counts = dict(self._counts)
+            spans = list(self.fleet.span_rows())
+            reachable = self.fleet.count(UP)
+        if self._run_id is not None:
+            Database.insert_sweep_spans(self._run_id, spans)
+            Database.finish_sweep_run(self._run_id, counts['saved'], counts['failed'], reachable)
+        metrics.SWEEP_LAST_SUCCESS_TIMESTAMP.set(time.time())
+        self.fetcher.save_state()
+        if self.on_cycle and len(self.fleet):
+            self.on_cycle(self.fleet)
+
+    def _probe(self, state, due):
+        site = state.site
+        success = None
+        try:
+            SCHEDULE_LAG_SECONDS.observe(max(time.monotonic() - due, 0))
+            with site_context(site.site_name):
+                probed_at = time.time()
+                site_start = time.perf_counter()
+                success, rtt_ms, loggers, spans = self.fetcher.measure_site(site)
+        except Exception as e:
+            logger.error("Scheduled probe of %s failed: %s", state.pr_code, e)
+            metrics.SWEEP_SITES_TOTAL.inc(1, 'error')
+        finally:
+            self._slots.release()
+
+        now = time.monotonic()
+        with self._cond:
+            state.in_flight = False
+            # The site's index is that of its current record; a removed site has none
+            if state.removed:
+                return
+            if success is None:
+                self.fleet.record_failed(state.site.index)
+                self._counts['failed'] += 1
+            else:
+                self.fleet.record(state.site.index, probed_at, success, rtt_ms, loggers, spans, time.perf_counter() - site_start)
+                self._pending.add(state.site.index)
+                previous_tier = state.tier
+                tier = state.update(success, now)
+                if tier != previous_tier:
+                    logger.info("Site %s moved from %s to %s tier", state.pr_code, previous_tier, tier)
+                    self._needed_rate += 1 / TIER_INTERVALS[tier] - 1 / TIER_INTERVALS[previous_tier]
+                    self._update_rate()
+            interval = TIER_INTERVALS[state.tier]
+            # Jitter keeps sites that were probed together from staying in lockstep
+            state.next_due = now + interval * random.uniform(0.9, 1.1)
+            self._push(state)
+
+    def _check_behind(self, state, due, now):
+        """Warn (at most every BEHIND_WARNING_SECONDS) when a probe starts a full tier interval late"""
+        lag = now - due
+        if lag < TIER_INTERVALS[state.tier] or now - self._warned_behind_at < BEHIND_WARNING_SECONDS:
+            return
+        self._warned_behind_at = now
+        logger.warning(
+            "Probe schedule is behind: %s (%s tier) started %.0f s late; %.1f probes/s allowed, %s threads",
+            state.pr_code, state.tier, lag, self._bucket.rate, SCHEDULE_CONCURRENCY
+        )
+
+    def _update_tier_gauges(self):
+        with self._cond:
+            counts = {tier: 0 for tier in TIER_INTERVALS}
+            for state in self.sites.values():
+                counts[state.tier] += 1
+        for tier, count in counts.items():
+            SCHEDULE_QUEUE_SITES.set(count, tier)
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def run_forever(self):
+        """Dispatch due probes until stop() is called"""
+        self.refresh_inventory()
+        self._start_cycle()
+        next_refresh = time.monotonic() + INVENTORY_REFRESH_SECONDS
+
+        try:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                if now >= next_refresh:
+                    self._finish_cycle()
+                    self.refresh_inventory()
+                    self._update_tier_gauges()
+                    self._start_cycle()
+                    next_refresh = now + INVENTORY_REFRESH_SECONDS
+
+                if len(self._pending) >= FLEET_FLUSH_SITES or (self._pending and now >= self._next_flush):
+                    self._flush()
+
+                with self._cond:
+                    if not self._heap or self._heap[0][0] > now:
+                        wake_at = min(self._heap[0][0], next_refresh) if self._heap else next_refresh
+                        if self._pending:
+                            wake_at = min(wake_at, self._next_flush)
+                        self._cond.wait(timeout=max(wake_at - now, 0.05))
+                        continue
+                    due, _, state = heapq.heappop(self._heap)
+                    if state.removed or state.in_flight:
+                        continue
+                    state.in_flight = True
+
+                # Bound in-flight probes, then the global start rate
+                self._slots.acquire()
+                self._bucket.acquire()
+                self._check_behind(state, due, time.monotonic())
+                self._executor.submit(self._probe, state, due)
+        finally:
+            self._executor.shutdown(wait=True)
+            self._finish_cycle()
@@ -0,0 +1,235 @@
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+import threading
+from array import array
+from sweep_archive import summarize_results
+from time_utils import convert_to_jakarta_time
+
+logger = logging.getLogger(__name__)
+
+# File the sweeper publishes the latest-state snapshot to (empty disables publishing)
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', os.path.join('snapshot', 'latest.snap'))
+# The API only serves a snapshot younger than this (seconds)
+SNAPSHOT_MAX_AGE = int(os.getenv('SNAPSHOT_MAX_AGE', 2 * int(os.getenv('SWEEP_INTERVAL_SECONDS', 300))))
+
+MAGIC = b'PLTS'
+VERSION = 1
+# File header: magic, version, section count, creation time
+_HEADER = struct.Struct('<4sHHd')
+# Section table entry: name, offset, length
+_SECTION = struct.Struct('<32sQQ')
+
+PING_LOG_FIELDS = ('timestamp', 'pr_code', 'site_name', 'ip_address', 'battery_version', 'ping_success', 'ping_time_ms', 'upstream_down')
+LENGTH_LOGGER_FIELDS = ('timestamp', 'pr_code', 'site_name', 'ip_address', 'battery_version', 'length_loggers')
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def encode_rows(rows):
+    """
+    Serialize rows as the comma-joined body of a JSON array
+
+    Returns:
+        tuple: (body, index) where index holds each row's end offset (uint64)
+    """
+    parts = [_dumps(row) for row in rows]
+    ends = array('Q')
+    position = 0
+    for part in parts:
+        position += len(part)
+        ends.append(position)
+        position += 1
+    return b','.join(parts), ends.tobytes()
+
+
+def pack(sections, created_at):
+    """Lay out named byte sections behind a header and section table"""
+    table_size = _HEADER.size + _SECTION.size * len(sections)
+    table = [_HEADER.pack(MAGIC, VERSION, len(sections), created_at)]
+    offset = table_size
+    for name, data in sections.items():
+        if len(name.encode('utf-8')) > 32:
+            raise ValueError(f"section name {name!r} is too long")
+        table.append(_SECTION.pack(name.encode('utf-8'), offset, len(data)))
+        offset += len(data)
+    return b''.join(table) + b''.join(sections.values())
+
+
+class Snapshot:
+    """
+    Immutable latest-state snapshot, read in place from bytes or a memory map.
+
+    Sections hold ready-to-send JSON: 'summary' is the /ping_logs/summary
+    response, 'ping_logs' and 'length_loggers' are rows (latest first) with
+    a '.idx' section of row end offsets, so any page is a single slice.
+    """
+
+    def __init__(self, buffer):
+        magic, version, count, created_at = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a snapshot file")
+        self.created_at = created_at
+        self._buffer = buffer
+        self._sections = {}
+        self._indexes = {}
+        for position in range(count):
+            name, offset, length = _SECTION.unpack_from(buffer, _HEADER.size + position * _SECTION.size)
+            self._sections[name.rstrip(b'\0').decode('utf-8')] = (offset, length)
+
+    @property
+    def age(self):
+        return time.time() - self.created_at
+
+    def section(self, name):
+        offset, length = self._sections[name]
+        return self._buffer[offset:offset + length]
+
+    def _index(self, name):
+        ends = self._indexes.get(name)
+        if ends is None:
+            ends = array('Q')
+            ends.frombytes(self.section(name + '.idx'))
+            self._indexes[name] = ends
+        return ends
+
+    def page(self, name, limit, offset=0):
+        """
+        JSON array of rows [offset, offset + limit) of a row section
+
+        Returns:
+            tuple: (JSON bytes, number of rows)
+        """
+        ends = self._index(name)
+        start = max(offset, 0)
+        stop = min(len(ends), start + max(limit, 0))
+        if start >= stop:
+            return b'[]', 0
+        base = self._sections[name][0]
+        first = ends[start - 1] + 1 if start else 0
+        return b'[' + self._buffer[base + first:base + ends[stop - 1]] + b']', stop - start
+
+
+class SnapshotStore:
+    """
+    Publishes snapshots and hands out the latest one.
+
+    A snapshot is written to a temporary file and renamed over SNAPSHOT_PATH,
+    so readers never see a partial file. The publishing process serves its
+    own snapshot from memory; other processes (e.g. other gunicorn workers)
+    memory-map the file and remap it when it is replaced.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self._local = None
+        self._mapped = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def publish(self, sections, created_at=None):
+        blob = pack(sections, created_at or time.time())
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(blob)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        self._local = Snapshot(blob)
+        return self._local
+
+    def latest(self, max_age=SNAPSHOT_MAX_AGE):
+        """The latest snapshot, or None if there is none younger than max_age"""
+        snapshot = self._local or self._map()
+        if snapshot is None or snapshot.age > max_age:
+            return None
+        return snapshot
+
+    def _map(self):
+        if not self.path:
+            return None
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if signature != self._signature:
+                try:
+                    with open(self.path, 'rb') as f:
+                        # The mapping outlives the file object and a later rename
+                        view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._mapped = Snapshot(view)
+                except (OSError, ValueError, struct.error) as e:
+                    logger.error("Error mapping snapshot %s: %s", self.path, e)
+                    self._mapped = None
+                self._signature = signature
+            return self._mapped
+
+
+class SnapshotPublisher:
+    """
+    Builds the latest-state snapshot from a sweep's results.
+
+    last_loggers(ip_address) gives the last known logger count of a site, so
+    sites that are down keep their count as they do in ping_logs.
+    """
+
+    def __init__(self, store=None, last_loggers=None):
+        self.store = store or SnapshotStore()
+        self.last_loggers = last_loggers
+
+    def publish(self, results):
+        rows = []
+        for result in results:
+            row = dict(result)
+            if row.get('length_loggers') is None and self.last_loggers is not None:
+                row['length_loggers'] = self.last_loggers(row.get('ip_address'))
+            rows.append(row)
+        rows.sort(key=lambda row: row.get('timestamp') or '', reverse=True)
+
+        summary = summarize_results(rows)
+        summary['time_period'] = 'Latest sweep'
+        summary['timestamp'] = convert_to_jakarta_time(rows[0].get('timestamp')) if rows else None
+        summary['source'] = 'snapshot'
+        down_sites = [
+            {
+                'pr_code': row.get('pr_code'),
+                'site_name': row.get('site_name'),
+                'ip_address': row.get('ip_address'),
+                'battery_version': row.get('battery_version'),
+                'last_check': convert_to_jakarta_time(row.get('timestamp')),
+                'outage_group': row.get('outage_group'),
+                'upstream_down': bool(row.get('upstream_down'))
+            }
+            for row in sorted(rows, key=lambda row: row.get('site_name') or '')
+            if not row.get('ping_success')
+        ]
+
+        for row in rows:
+            row['timestamp'] = convert_to_jakarta_time(row.get('timestamp'))
+        ping_logs, ping_logs_index = encode_rows([{field: row.get(field) for field in PING_LOG_FIELDS} for row in rows])
+        length_loggers, length_loggers_index = encode_rows([{field: row.get(field) for field in LENGTH_LOGGER_FIELDS} for row in rows])
+
+        try:
+            snapshot = self.store.publish({
+                'summary': _dumps({'status': 'success', 'data': {'summary': summary, 'down_sites': down_sites}}),
+                'ping_logs': ping_logs,
+                'ping_logs.idx': ping_logs_index,
+                'length_loggers': length_loggers,
+                'length_loggers.idx': length_loggers_index,
+            })
+        except (IOError, OSError) as e:
+            logger.error("Error publishing snapshot to %s: %s", self.store.path, e)
+            return None
+        logger.info("Published snapshot of %s sites", len(rows))
+        return snapshot
@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import zlib
+import struct
+import logging
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')
+# Total size of unreplayed segments; writes beyond it are dropped
+SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_BYTES', 256 * 1024 * 1024))
+# Buffered records are fsynced once this many are pending or this many seconds have passed
+SPOOL_FSYNC_RECORDS = int(os.getenv('SPOOL_FSYNC_RECORDS', 50))
+SPOOL_FSYNC_SECONDS = float(os.getenv('SPOOL_FSYNC_SECONDS', 1))
+# After a failed write, go straight to the spool for this long before trying the DB again
+SPOOL_RETRY_SECONDS = int(os.getenv('SPOOL_RETRY_SECONDS', 30))
+SPOOL_REPLAY_INTERVAL = int(os.getenv('SPOOL_REPLAY_INTERVAL', 30))
+SPOOL_REPLAY_BATCH = int(os.getenv('SPOOL_REPLAY_BATCH', 500))
+
+# Record framing: payload length, CRC32 of the payload, then the JSON payload
+_HEADER = struct.Struct('<II')
+
+OPEN_SUFFIX = '.open'
+SEALED_SUFFIX = '.log'
+REPLAY_SUFFIX = '.replay-'
+
+SPOOL_RECORDS_TOTAL = metrics.Counter(
+    'ping_tracker_spool_records_total',
+    'Database writes handled by the local spool, by event (spooled, replayed, dropped, corrupt)',
+    ('event',)
+)
+SPOOL_BACKLOG_BYTES = metrics.Gauge(
+    'ping_tracker_spool_backlog_bytes',
+    'Bytes of spooled writes waiting to be replayed'
+)
+SPOOL_BACKLOG_SEGMENTS = metrics.Gauge(
+    'ping_tracker_spool_backlog_segments',
+    'Spool segments waiting to be replayed'
+)
+SPOOL_OLDEST_SECONDS = metrics.Gauge(
+    'ping_tracker_spool_oldest_segment_age_seconds',
+    'Age of the oldest spool segment waiting to be replayed'
+)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _owner_pid(name):
+    """pid that holds an open or claimed segment, from its file name"""
+    if REPLAY_SUFFIX in name:
+        return int(name.rsplit(REPLAY_SUFFIX, 1)[1])
+    return int(name[:-len(OPEN_SUFFIX)].rsplit('-', 1)[1])
+
+
+def _segment_base(name):
+    if REPLAY_SUFFIX in name:
+        return name.rsplit(REPLAY_SUFFIX, 1)[0][:-len(SEALED_SUFFIX)]
+    return name.rsplit('.', 1)[0]
+
+
+class WriteSpool:
+    """
+    Durable local spool for database writes that could not be made.
+
+    Records are appended to this process's open segment
+    (spool-<ms>-<pid>.open), framed with a length and CRC32 so a torn or
+    corrupted tail is detected and skipped. Writes are fsynced in batches.
+    Before a replay the open segment is sealed (renamed to .log); a replayer
+    claims a sealed segment by renaming it, and deletes it once every record
+    has been committed.
+    """
+
+    def __init__(self, directory=SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self._name = None
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._full = False
+        # Backlog outside the open segment when it was opened
+        self._other_bytes = 0
+        self._recover()
+        self.update_gauges()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _names(self):
+        try:
+            return sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return []
+
+    def _recover(self):
+        """Seal open and claimed segments left behind by processes that died"""
+        for name in self._names():
+            if not (name.endswith(OPEN_SUFFIX) or REPLAY_SUFFIX in name):
+                continue
+            try:
+                pid = _owner_pid(name)
+            except ValueError:
+                continue
+            if pid != os.getpid() and _pid_alive(pid):
+                continue
+            try:
+                os.rename(self._path(name), self._path(_segment_base(name) + SEALED_SUFFIX))
+                logger.info("Recovered spool segment %s", name)
+            except FileNotFoundError:
+                pass
+
+    def backlog(self):
+        """(bytes, segments, oldest segment mtime) of everything not yet replayed"""
+        total = 0
+        segments = 0
+        oldest = None
+        for name in self._names():
+            try:
+                stat = os.stat(self._path(name))
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            if stat.st_size:
+                segments += 1
+                oldest = stat.st_mtime if oldest is None else min(oldest, stat.st_mtime)
+        return total, segments, oldest
+
+    def update_gauges(self):
+        total, segments, oldest = self.backlog()
+        SPOOL_BACKLOG_BYTES.set(total)
+        SPOOL_BACKLOG_SEGMENTS.set(segments)
+        SPOOL_OLDEST_SECONDS.set(time.time() - oldest if oldest else 0)
+        return total
+
+    def append(self, kind, args):
+        """Spool one write; returns False if the spool is full or unwritable"""
+        payload = json.dumps({'kind': kind, 'args': args}, separators=(',', ':'), default=str).encode('utf-8')
+        record = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._other_bytes = self.update_gauges()
+                    if self._other_bytes + len(record) > self.max_bytes:
+                        return self._drop()
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._name = f"spool-{int(time.time() * 1000):016d}-{os.getpid()}{OPEN_SUFFIX}"
+                    self._file = open(self._path(self._name), 'ab')
+                elif self._other_bytes + self._file.tell() + len(record) > self.max_bytes:
+                    return self._drop()
+                self._file.write(record)
+                self._pending += 1
+                self._full = False
+                if self._pending >= SPOOL_FSYNC_RECORDS or time.monotonic() - self._last_sync >= SPOOL_FSYNC_SECONDS:
+                    self._sync()
+            except (IOError, OSError) as e:
+                logger.error("Error writing to spool %s: %s", self._name, e)
+                SPOOL_RECORDS_TOTAL.inc(1, 'dropped')
+                return False
+        SPOOL_RECORDS_TOTAL.inc(1, 'spooled')
+        return True
+
+    def _drop(self):
+        if not self._full:
+            logger.error("Spool is full (%s bytes), dropping writes until it is replayed", self.max_bytes)
+            self._full = True
+        SPOOL_RECORDS_TOTAL.inc(1, 'dropped')
+        return False
+
+    def _sync(self):
+        """Flush and fsync pending records; caller holds self._lock"""
+        if self._file is not None and self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            try:
+                self._sync()
+            except (IOError, OSError) as e:
+                logger.error("Error syncing spool %s: %s", self._name, e)
+        self.update_gauges()
+
+    def seal(self):
+        """Close the open segment so it can be replayed; later writes start a new one"""
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                self._sync()
+                self._file.close()
+                os.rename(self._path(self._name), self._path(_segment_base(self._name) + SEALED_SUFFIX))
+            except (IOError, OSError) as e:
+                logger.error("Error sealing spool %s: %s", self._name, e)
+            self._file = None
+            self._name = None
+
+    def claim(self):
+        """Claim the oldest sealed segment for replay; returns its file name or None"""
+        for name in self._names():
+            if not name.endswith(SEALED_SUFFIX):
+                continue
+            claimed = f"{name}{REPLAY_SUFFIX}{os.getpid()}"
+            try:
+                os.rename(self._path(name), self._path(claimed))
+                return claimed
+            except FileNotFoundError:
+                # Claimed by another process first
+                continue
+        return None
+
+    def release(self, name):
+        """Give back a claimed segment that could not be fully replayed"""
+        os.rename(self._path(name), self._path(_segment_base(name) + SEALED_SUFFIX))
+
+    def remove(self, name):
+        os.remove(self._path(name))
+
+    def read(self, name):
+        """Yield the records of a segment in order, stopping at a torn or corrupted record"""
+        with open(self._path(name), 'rb') as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if not header:
+                    return
+                if len(header) == _HEADER.size:
+                    length, checksum = _HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) == length and zlib.crc32(payload) == checksum:
+                        yield json.loads(payload)
+                        continue
+                logger.warning("Spool segment %s has a corrupt record at byte %s; skipping the rest", name, f.tell())
+                SPOOL_RECORDS_TOTAL.inc(1, 'corrupt')
+                return
+
+
+class SpoolReplayer:
+    """
+    Background thread replaying sealed spool segments into Postgres.
+
+    Runs every SPOOL_REPLAY_INTERVAL seconds (or when kicked) while the
+    database is reachable; segments are replayed oldest first, in batches of
+    SPOOL_REPLAY_BATCH records, so sweeps never wait on a replay.
+    """
+
+    def __init__(self, spool, database=None):
+        self.spool = spool
+        # Database, or a stand-in with check_connection and replay_spooled_writes
+        self._database = database
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def database(self):
+        if self._database is None:
+            # Imported on first use, so writing and reading the spool needs no database driver
+            from db_utils import Database
+            self._database = Database
+        return self._database
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='spool-replay', daemon=True)
+            self._thread.start()
+
+    def kick(self):
+        """Replay as soon as possible"""
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.replay()
+            except Exception as e:
+                logger.error("Spool replay failed: %s", e)
+            self._wake.wait(SPOOL_REPLAY_INTERVAL)
+            self._wake.clear()
+
+    def replay(self):
+        """Replay every sealed segment; returns the number of records committed"""
+        if not self.spool.backlog()[0] or not self.database.check_connection():
+            return 0
+        self.spool.seal()
+
+        replayed = 0
+        while not self._stop.is_set():
+            name = self.spool.claim()
+            if name is None:
+                break
+            batch = []
+            try:
+                for record in self.spool.read(name):
+                    batch.append(record)
+                    if len(batch) >= SPOOL_REPLAY_BATCH:
+                        self._commit(batch)
+                        replayed += len(batch)
+                        batch = []
+                if batch:
+                    self._commit(batch)
+                    replayed += len(batch)
+            except Exception:
+                self.spool.release(name)
+                self.spool.update_gauges()
+                raise
+            self.spool.remove(name)
+            logger.info("Replayed spool segment %s", name)
+
+        self.spool.update_gauges()
+        if replayed:
+            logger.info("Replayed %s spooled writes", replayed)
+        return replayed
+
+    def _commit(self, batch):
+        if not self.database.replay_spooled_writes(batch):
+            raise IOError("database rejected the replay batch")
+        SPOOL_RECORDS_TOTAL.inc(len(batch), 'replayed')
@@ -1,4 +1,4 @@
 #!bin/bash
 
-python main.py &
+if [ "$SWEEP_MODE" != combined ]; then python main.py & fi
 gunicorn --bind 0.0.0.0:5090 api:app
\ No newline at end of file
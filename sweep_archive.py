@@ -0,0 +1,249 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import bisect
+import itertools
+import logging
+import threading
+from rtt_sketch import RttSketch, percentiles
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+# Rotate to a new segment after this many bytes or seconds
+ARCHIVE_SEGMENT_BYTES = int(os.getenv('ARCHIVE_SEGMENT_BYTES', 64 * 1024 * 1024))
+ARCHIVE_SEGMENT_SECONDS = int(os.getenv('ARCHIVE_SEGMENT_SECONDS', 24 * 3600))
+# Oldest segments beyond this count are deleted
+ARCHIVE_MAX_SEGMENTS = int(os.getenv('ARCHIVE_MAX_SEGMENTS', 30))
+# Sites per compressed block; a site lookup decompresses one block
+ARCHIVE_BLOCK_SITES = int(os.getenv('ARCHIVE_BLOCK_SITES', 256))
+
+DATA_SUFFIX = '.ndjson.gz'
+INDEX_SUFFIX = '.idx'
+
+# Index record: sweep_id, sweep time, block offset, block length, site count, first/last pr_code
+_INDEX_RECORD = struct.Struct('<QdQII16s16s')
+
+
+def _pad(pr_code):
+    return (pr_code or '').encode('utf-8')[:16].ljust(16, b'\0')
+
+
+def _unpad(raw):
+    return raw.rstrip(b'\0').decode('utf-8')
+
+
+class IndexEntry:
+    __slots__ = ('sweep_id', 'swept_at', 'offset', 'length', 'sites', 'first_pr_code', 'last_pr_code', 'segment')
+
+    def __init__(self, record, segment):
+        sweep_id, swept_at, offset, length, sites, first, last = record
+        self.sweep_id = sweep_id
+        self.swept_at = swept_at
+        self.offset = offset
+        self.length = length
+        self.sites = sites
+        self.first_pr_code = _unpad(first)
+        self.last_pr_code = _unpad(last)
+        self.segment = segment
+
+
+class SweepArchive:
+    """
+    Append-only, compressed archive of sweep results.
+
+    Each segment is a pair of files:
+        <name>.ndjson.gz  concatenated gzip members, each one block of up to
+                          ARCHIVE_BLOCK_SITES results (one JSON line per site,
+                          sorted by pr_code); readable with zcat
+        <name>.idx        fixed-size binary records, one per block
+
+    Data is written before its index record, so a crash leaves at most an
+    unindexed tail that readers never see. One process should write at a time.
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    # Writing
+
+    def _segments(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len(INDEX_SUFFIX)] for name in names if name.endswith(INDEX_SUFFIX))
+
+    def _current_segment(self):
+        """Return the segment to append to, rotating by size and age"""
+        segments = self._segments()
+        if segments:
+            name = segments[-1]
+            data_path = os.path.join(self.directory, name + DATA_SUFFIX)
+            created = int(name.split('-', 1)[1]) / 1000
+            size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+            if size < ARCHIVE_SEGMENT_BYTES and time.time() - created < ARCHIVE_SEGMENT_SECONDS:
+                return name
+        name = f"sweeps-{int(time.time() * 1000):016d}"
+        open(os.path.join(self.directory, name + INDEX_SUFFIX), 'ab').close()
+        self._prune(segments + [name])
+        return name
+
+    def _prune(self, segments):
+        for name in segments[:-ARCHIVE_MAX_SEGMENTS] if ARCHIVE_MAX_SEGMENTS > 0 else []:
+            for suffix in (INDEX_SUFFIX, DATA_SUFFIX):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+            logger.info("Removed archive segment %s", name)
+
+    def append_sweep(self, results, swept_at=None, presorted=False):
+        """
+        Append one sweep's results
+
+        results can be any iterable of result dicts; with presorted it must
+        already be in pr_code order and is consumed one block at a time.
+
+        Returns:
+            int: The sweep id (milliseconds since the epoch)
+        """
+        swept_at = swept_at or time.time()
+        sweep_id = int(swept_at * 1000)
+        rows = iter(results) if presorted else iter(sorted(results, key=lambda result: result.get('pr_code') or ''))
+        site_count = 0
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            name = self._current_segment()
+            data_path = os.path.join(self.directory, name + DATA_SUFFIX)
+            index_path = os.path.join(self.directory, name + INDEX_SUFFIX)
+
+            records = []
+            with open(data_path, 'ab') as data_file:
+                offset = data_file.tell()
+                while True:
+                    block = list(itertools.islice(rows, ARCHIVE_BLOCK_SITES))
+                    if not block:
+                        break
+                    site_count += len(block)
+                    payload = ''.join(
+                        json.dumps(row, ensure_ascii=False, separators=(',', ':'), default=str) + '\n'
+                        for row in block
+                    ).encode('utf-8')
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                    member = compressor.compress(payload) + compressor.flush()
+                    data_file.write(member)
+                    records.append(_INDEX_RECORD.pack(
+                        sweep_id, swept_at, offset, len(member), len(block),
+                        _pad(block[0].get('pr_code')), _pad(block[-1].get('pr_code'))
+                    ))
+                    offset += len(member)
+                data_file.flush()
+                os.fsync(data_file.fileno())
+
+            with open(index_path, 'ab') as index_file:
+                index_file.write(b''.join(records))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+
+        logger.info("Archived sweep %s (%s sites) to %s", sweep_id, site_count, name)
+        return sweep_id
+
+    # Reading
+
+    def _index(self, name):
+        """Index entries of a segment, read through a memory map"""
+        index_path = os.path.join(self.directory, name + INDEX_SUFFIX)
+        try:
+            with open(index_path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                usable = size - size % _INDEX_RECORD.size
+                if not usable:
+                    return []
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    return [
+                        IndexEntry(record, name)
+                        for record in _INDEX_RECORD.iter_unpack(view[:usable])
+                    ]
+        except (FileNotFoundError, ValueError):
+            return []
+
+    def _read_block(self, entry):
+        data_path = os.path.join(self.directory, entry.segment + DATA_SUFFIX)
+        with open(data_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                member = view[entry.offset:entry.offset + entry.length]
+        payload = zlib.decompress(member, 31)
+        return [json.loads(line) for line in payload.splitlines() if line]
+
+    def _sweep_blocks(self, sweep_id=None):
+        """Index entries of one sweep (the latest if sweep_id is None), newest segment first"""
+        for name in reversed(self._segments()):
+            entries = self._index(name)
+            if not entries:
+                continue
+            target = sweep_id if sweep_id is not None else entries[-1].sweep_id
+            blocks = [entry for entry in entries if entry.sweep_id == target]
+            if blocks:
+                return blocks
+            if sweep_id is None or entries[0].sweep_id < sweep_id:
+                return []
+        return []
+
+    def list_sweeps(self, limit=20):
+        """Most recent sweeps as dicts with sweep_id, swept_at and sites"""
+        sweeps = []
+        for name in reversed(self._segments()):
+            by_id = {}
+            for entry in self._index(name):
+                sweep = by_id.setdefault(entry.sweep_id, {'sweep_id': entry.sweep_id, 'swept_at': entry.swept_at, 'sites': 0})
+                sweep['sites'] += entry.sites
+            sweeps.extend(sorted(by_id.values(), key=lambda sweep: sweep['sweep_id'], reverse=True))
+            if len(sweeps) >= limit:
+                break
+        return sweeps[:limit]
+
+    def read_sweep(self, sweep_id=None):
+        """All results of a sweep (the latest if sweep_id is None)"""
+        results = []
+        for entry in self._sweep_blocks(sweep_id):
+            results.extend(self._read_block(entry))
+        return results
+
+    def find_site(self, pr_code, sweep_id=None):
+        """Result of one site in a sweep, decompressing only the block that holds it"""
+        blocks = self._sweep_blocks(sweep_id)
+        position = bisect.bisect_left([entry.last_pr_code for entry in blocks], pr_code)
+        if position == len(blocks) or blocks[position].first_pr_code > pr_code:
+            return None
+        for result in self._read_block(blocks[position]):
+            if result.get('pr_code') == pr_code:
+                return result
+        return None
+
+
+def summarize_results(results):
+    """Summary of a single sweep in the shape of Database.get_summary"""
+    total_sites = len({result.get('pr_code') for result in results})
+    up = [result for result in results if result.get('ping_success')]
+    response_times = [result['ping_time_ms'] for result in up if result.get('ping_time_ms') is not None]
+    loggers = [result['length_loggers'] for result in results if result.get('length_loggers')]
+    sketch = RttSketch()
+    for response_time in response_times:
+        sketch.add(response_time)
+    return {
+        'total_sites': total_sites,
+        'sites_up': len(up),
+        'sites_down': total_sites - len(up),
+        'sites_upstream_down': sum(1 for result in results if result.get('upstream_down')),
+        'uptime_percentage': round(len(up) * 100 / total_sites, 2) if total_sites else 0,
+        'average_response_time': round(sum(response_times) / len(response_times), 2) if response_times else 0,
+        **percentiles(sketch),
+        'sites_with_loggers': len(loggers),
+        'average_loggers_per_site': round(sum(loggers) / len(loggers), 1) if loggers else 0,
+    }
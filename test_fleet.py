@@ -0,0 +1,143 @@
+"""
+Tests for the fleet store: inventory loading, record reuse, measurements and
+the rows generated from them.
+"""
+import pytest
+
+from datetime import datetime
+
+from fleet import FleetStore, UP, DOWN, UPSTREAM_DOWN, FAILED, NOT_PROBED
+
+
+class GatewayGrouper:
+    """Groups sites by their gateway field, like SiteGrouper does with gateways configured"""
+
+    def group_key(self, site):
+        gateway = site.get('gateway')
+        return f"gw:{gateway}" if gateway else None
+
+
+PROBED_AT = 1700000000.5
+
+
+def formatted(seconds):
+    return datetime.fromtimestamp(int(seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def inventory(count, **overrides):
+    return [
+        dict({'pr_code': f'PR{index:02d}', 'site_name': f'site {index}', 'ip_address': f'10.0.0.{index}',
+              'battery_version': 'TALIS5 FULL'}, **overrides)
+        for index in reversed(range(count))
+    ]
+
+
+def test_load_sorts_by_pr_code_and_skips_bad_entries():
+    fleet = FleetStore()
+    sites = fleet.load(inventory(3) + [
+        'not a site',
+        {'pr_code': 'NOIP', 'site_name': 'no address'},
+        {'pr_code': 'PR01', 'site_name': 'duplicate', 'ip_address': '10.9.9.9'},
+        {'pr_code': 'LEGACY', 'site_name': 'legacy', 'ip_site': '10.1.1.1'},
+    ])
+    assert [site.pr_code for site in sites] == ['LEGACY', 'PR00', 'PR01', 'PR02']
+    assert [site.index for site in sites] == [0, 1, 2, 3]
+    assert sites[0].ip_address == '10.1.1.1'
+    assert sites[2].site_name == 'site 1'
+    assert len(fleet.state) == 4
+
+
+def test_unchanged_records_are_reused_and_changed_ones_replaced():
+    fleet = FleetStore()
+    first = fleet.load(inventory(3))
+    second = fleet.load(inventory(3))
+    assert all(old is new for old, new in zip(first, second))
+
+    changed = inventory(3)
+    changed[0]['battery_version'] = 'TALIS5 MIX'
+    third = fleet.load(changed)
+    assert third[2] is not first[2]
+    assert third[2].battery_version == 'TALIS5 MIX'
+    assert third[0] is first[0]
+
+
+def test_load_resets_measurements():
+    fleet = FleetStore()
+    fleet.load(inventory(2))
+    fleet.record(0, PROBED_AT, True, 12, 3, {'ping': 0.012}, 0.5)
+    fleet.load(inventory(2))
+    assert list(fleet.state) == [NOT_PROBED, NOT_PROBED]
+    assert len(fleet) == 0
+    assert list(fleet) == []
+
+
+def test_rows_come_from_the_arrays():
+    fleet = FleetStore()
+    fleet.load(inventory(4))
+    fleet.record(0, PROBED_AT, True, 12, 3, {'ping': 0.012, 'logger': 0.3}, 0.5)
+    fleet.record(1, PROBED_AT + 75, False, None, None, {'ping': 1.0, 'fallback': 2.0}, 3.0)
+    fleet.record_upstream_down(2, PROBED_AT + 90)
+    fleet.record_failed(3)
+
+    # Each site carries its own probe time
+    assert list(fleet.ping_rows([0, 1, 2])) == [
+        (formatted(PROBED_AT), 'PR00', 'site 0', '10.0.0.0', 'TALIS5 FULL', True, 12, None),
+        (formatted(PROBED_AT + 75), 'PR01', 'site 1', '10.0.0.1', 'TALIS5 FULL', False, None, None),
+        (formatted(PROBED_AT + 90), 'PR02', 'site 2', '10.0.0.2', 'TALIS5 FULL', False, None, True),
+    ]
+    assert list(fleet.logger_rows([0, 1, 2])) == [('PR00', 3, formatted(PROBED_AT))]
+    assert list(fleet.span_rows()) == [
+        ('PR00', 12, None, 300, None, 500),
+        ('PR01', 1000, 2000, None, None, 3000),
+    ]
+    assert fleet.count(UP) == 1
+    assert fleet.count(DOWN, UPSTREAM_DOWN) == 2
+    assert fleet.count(FAILED) == 1
+    assert len(fleet) == 3
+
+
+def test_record_write_shares_the_write_time():
+    fleet = FleetStore()
+    fleet.load(inventory(3))
+    fleet.record(0, PROBED_AT, True, 12, 3, {}, 0.5)
+    fleet.record(1, PROBED_AT + 75, False, None, None, {}, 1.0)
+    fleet.record_upstream_down(2, PROBED_AT + 90)
+    fleet.record_write([0, 1, 2], True, 1.5)
+    assert list(fleet.saved) == [1, 1, 1]
+    assert [row[4] for row in fleet.span_rows()] == [500, 500]
+
+
+def test_results_match_process_site_shape():
+    fleet = FleetStore(GatewayGrouper())
+    fleet.load(inventory(2, gateway='A'))
+    fleet.record(0, PROBED_AT, True, 12, 3, {}, 0.5)
+    fleet.record_upstream_down(1, PROBED_AT + 90)
+    up, upstream_down = list(fleet)
+    assert up == {
+        'timestamp': formatted(PROBED_AT), 'pr_code': 'PR00', 'site_name': 'site 0', 'ip_address': '10.0.0.0',
+        'battery_version': 'TALIS5 FULL', 'ping_success': True, 'ping_time_ms': 12, 'length_loggers': 3,
+        'saved_to_db': False,
+    }
+    assert upstream_down['upstream_down'] is True
+    assert upstream_down['outage_group'] == 'gw:A'
+
+
+def test_groups():
+    fleet = FleetStore(GatewayGrouper())
+    fleet.load(inventory(2, gateway='A') + [
+        {'pr_code': 'X1', 'ip_address': '10.2.0.1', 'gateway': 'B'},
+        {'pr_code': 'X2', 'ip_address': '10.2.0.2'},
+    ])
+    groups = {key: [site.pr_code for site in members] for key, members in fleet.groups()}
+    assert groups == {'gw:A': ['PR00', 'PR01'], 'gw:B': ['X1'], None: ['X2']}
+
+
+@pytest.mark.parametrize('chain', ['tcp:502,icmp', ['tcp:502', 'icmp']])
+def test_site_records_stand_in_for_inventory_entries(chain):
+    fleet = FleetStore()
+    (site,) = fleet.load([{'pr_code': 'PR1', 'ip_address': '10.0.0.1', 'probe_chain': chain}])
+    assert site.get('ip_address') == '10.0.0.1'
+    assert site.get('battery_version') == 'UNKNOWN'
+    assert site.get('gateway', 'none') == 'none'
+    assert site.get('index') is None
+    assert fleet.load([{'pr_code': 'PR1', 'ip_address': '10.0.0.1', 'probe_chain': chain}])[0] is site
@@ -0,0 +1,85 @@
+"""
+Tests for the streaming JSON array counter.
+
+Documents are fed in chunks of every size, so each token, escape sequence
+and scalar is split at a chunk boundary somewhere; the counts must match
+what json.loads sees.
+"""
+import json
+import pytest
+
+from json_count import JsonArrayCounter, count_json_arrays
+
+DOCUMENTS = [
+    # Talis5-style response: loggers under data
+    (b'{"status": "ok", "data": [{"id": 1, "tags": [1, 2]}, {"id": 2, "note": "a, b ] }"}, {}]}', [('data',)]),
+    # JSPro-style response: nested arrays next to ones that are not counted
+    (b'{"data": {"mppt": [[1, 2], [3], []], "other": [1, 2, 3]}, "message": "done"}', [('data', 'mppt'), ('data', 'other')]),
+    # Bare list at the root, with escapes and numbers long enough to be split
+    (b'[{"name": "quote \\" and \\\\ backslash"}, 123456789.125, -1e-10, true, null, "\\u00e9"]', [()]),
+    # Empty arrays and whitespace
+    (b' { "data" : [ ] , "more" : [ [ ] ] } ', [('data',), ('more',)]),
+]
+
+
+def expected_count(document, path):
+    value = json.loads(document)
+    for key in path:
+        value = value[key]
+    return len(value)
+
+
+def chunked(document, size):
+    return [document[start:start + size] for start in range(0, len(document), size)]
+
+
+@pytest.mark.parametrize('document, paths', DOCUMENTS)
+def test_counts_match_json_loads_at_every_chunk_size(document, paths):
+    for size in range(1, len(document) + 1):
+        counter = count_json_arrays(chunked(document, size), paths)
+        for path in paths:
+            assert counter.counts[path] == expected_count(document, path), (path, size)
+            assert counter.types[path] == 'array'
+
+
+def test_missing_and_non_array_paths():
+    counter = count_json_arrays([b'{"data": {"count": 3}, "message": "no loggers"}'], [('data',), ('loggers',)])
+    assert counter.root_type == 'object'
+    assert counter.root_keys == {'data', 'message'}
+    assert counter.types == {('data',): 'other'}
+    assert counter.counts == {}
+
+
+def test_captures_string_values_split_across_chunks():
+    document = b'{"message": "Unauthorized \\"token\\"", "data": []}'
+    for size in range(1, len(document) + 1):
+        counter = count_json_arrays(chunked(document, size), [('data',)], [('message',)])
+        assert counter.values[('message',)] == 'Unauthorized "token"'
+        assert counter.counts[('data',)] == 0
+
+
+def test_arrays_inside_arrays_are_not_matched_by_path():
+    counter = count_json_arrays([b'[{"data": [1, 2]}]'], [('data',), ()])
+    assert counter.counts == {(): 1}
+
+
+@pytest.mark.parametrize('document', [
+    b'{"data": [1, 2',
+    b'{"data": "unterminated',
+    b'',
+])
+def test_truncated_documents_are_rejected(document):
+    with pytest.raises(ValueError):
+        count_json_arrays([document], [('data',)])
+
+
+@pytest.mark.parametrize('document', [
+    b'{"data": [1, 2}}',
+    b'[1, 2]]',
+    b'[1] [2]',
+])
+def test_malformed_documents_are_rejected(document):
+    counter = JsonArrayCounter([()])
+    with pytest.raises(ValueError):
+        counter.feed(document)
+        counter.close()
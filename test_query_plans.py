@@ -0,0 +1,126 @@
+"""
+Query plan checks for the Database read queries.
+
+Every query the API runs is explained on a seeded copy of ping_logs, and a
+check fails if a table estimated above PLAN_SEQ_SCAN_THRESHOLD rows is read by
+a sequential scan. The queries come from db_utils itself, so the checks can't
+drift from what the methods run.
+
+Needs a migrated Postgres (python migrate.py) reachable through the DB_*
+settings; skipped otherwise. Seeding happens in a transaction that is rolled
+back, and ping_logs is analyzed again afterwards.
+"""
+import os
+import json
+from datetime import datetime, timedelta
+import pytest
+
+pytest.importorskip('psycopg2')
+pytest.importorskip('dotenv')
+
+import db_utils
+from db_utils import Database
+from rtt_sketch import FLEET
+
+# Synthetic ping_logs rows added (and rolled back) before explaining
+PLAN_SEED_ROWS = int(os.getenv('PLAN_SEED_ROWS', 200000))
+# Distinct sites among the seeded rows
+PLAN_SEED_SITES = int(os.getenv('PLAN_SEED_SITES', 2000))
+# Tables estimated above this many rows must not be read by a sequential scan
+PLAN_SEQ_SCAN_THRESHOLD = int(os.getenv('PLAN_SEQ_SCAN_THRESHOLD', 10000))
+
+SITE_NAME = 'plan-site-1'
+PR_CODE = 'PLAN1'
+RUN_IDS = [1, 2, 3]
+
+# (name, build(since) -> (query, params)) of every Database read query
+CHECKS = [
+    ('get_ping_logs', lambda since: db_utils.listing_query('ping_logs')),
+    ('get_ping_logs(site_name)', lambda since: db_utils.listing_query('ping_logs', site_name=SITE_NAME)),
+    ('get_length_loggers', lambda since: db_utils.listing_query('length_loggers')),
+    ('get_length_loggers(site_name)', lambda since: db_utils.listing_query('length_loggers', site_name=SITE_NAME)),
+    ('insert_ping_log(lookup)', lambda since: (db_utils.PR_CODE_LOOKUP_QUERY, (PR_CODE,))),
+    ('get_summary(total_sites)', lambda since: (db_utils.SUMMARY_TOTAL_SITES_QUERY, (since,))),
+    ('get_summary(sites_up)', lambda since: (db_utils.SUMMARY_SITES_UP_QUERY, (since,))),
+    ('get_summary(avg_response_time)', lambda since: (db_utils.SUMMARY_RESPONSE_TIME_QUERY, (since,))),
+    ('get_summary(loggers)', lambda since: (db_utils.SUMMARY_LOGGERS_QUERY, (since,))),
+    ('get_summary(uptime)', lambda since: (db_utils.SUMMARY_UPTIME_QUERY, (since,))),
+    ('get_summary(sketches)', lambda since: (db_utils.SUMMARY_SKETCHES_QUERY, (FLEET, 0))),
+    ('get_down_sites', lambda since: (db_utils.DOWN_SITES_QUERY, (since,))),
+    ('get_slow_sites(runs)', lambda since: (db_utils.RECENT_RUNS_QUERY, (10,))),
+    ('get_slow_sites(sites)', lambda since: (db_utils.SLOW_SITES_QUERY, (RUN_IDS, 20))),
+    ('get_slow_sites(stages)', lambda since: (db_utils.SLOW_STAGES_QUERY, (RUN_IDS,))),
+    ('get_site_health(flapping)', lambda since: db_utils.site_health_query(['flapping', 'degrading'], 100)),
+    ('get_group_outages', lambda since: (db_utils.GROUP_OUTAGES_QUERY, (24, 100))),
+    ('stream_ping_logs(since)', lambda since: db_utils.export_query('ping_logs', since=since)),
+    ('stream_ping_logs(site_name)', lambda since: db_utils.export_query('ping_logs', site_name=SITE_NAME)),
+    ('stream_ping_logs(length_loggers, pr_code)', lambda since: db_utils.export_query('length_loggers', pr_code=PR_CODE)),
+]
+
+
+def seed_ping_logs(cursor, rows, sites):
+    """Insert synthetic ping_logs rows spread over 30 days and refresh planner statistics"""
+    # Minutes between two rows of the same site
+    step_minutes = 30 * 24 * 60 / max(rows // sites, 1)
+    cursor.execute("""
+        INSERT INTO ping_logs (timestamp, pr_code, site_name, ip_address, battery_version, ping_success, ping_time_ms, length_loggers)
+        SELECT
+            to_char(NOW() - (g / %(sites)s) * %(step)s * INTERVAL '1 minute', 'YYYY-MM-DD HH24:MI:SS'),
+            'PLAN' || (g %% %(sites)s),
+            'plan-site-' || (g %% %(sites)s),
+            '10.' || ((g %% %(sites)s) / 65536) || '.' || ((g %% %(sites)s) / 256 %% 256) || '.' || (g %% %(sites)s %% 256),
+            'v' || (g %% 3),
+            g %% 7 <> 0,
+            CASE WHEN g %% 7 <> 0 THEN 5 + (g * 37) %% 500 END,
+            CASE WHEN g %% 3 <> 0 THEN g %% 50 END
+        FROM generate_series(0, %(rows)s - 1) AS g
+        ON CONFLICT DO NOTHING
+    """, {'rows': rows, 'sites': sites, 'step': step_minutes})
+    cursor.execute("ANALYZE ping_logs")
+    cursor.execute("ANALYZE site_health")
+
+
+def find_seq_scans(plan, reltuples, threshold):
+    """Relations read by a sequential scan in a plan tree whose estimated size exceeds threshold"""
+    found = []
+    if plan.get('Node Type') == 'Seq Scan' and reltuples.get(plan.get('Relation Name'), 0) > threshold:
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found.extend(find_seq_scans(child, reltuples, threshold))
+    return found
+
+
+@pytest.fixture(scope='module')
+def seeded():
+    """(cursor, reltuples) on a connection with seeded ping_logs, rolled back afterwards"""
+    if not Database.check_connection():
+        pytest.skip("Postgres is not reachable")
+    connection = Database.get_connection()
+    try:
+        cursor = connection.cursor()
+        seed_ping_logs(cursor, PLAN_SEED_ROWS, PLAN_SEED_SITES)
+        cursor.execute("""
+            SELECT relname, reltuples FROM pg_class
+            WHERE relname IN ('ping_logs', 'site_health', 'sweep_runs', 'sweep_site_spans',
+                              'sweep_jobs', 'rtt_sketches', 'group_outages')
+        """)
+        yield cursor, dict(cursor.fetchall())
+    finally:
+        connection.rollback()
+        cursor = connection.cursor()
+        cursor.execute("ANALYZE ping_logs")
+        cursor.execute("ANALYZE site_health")
+        connection.commit()
+        connection.close()
+
+
+@pytest.mark.parametrize('name, build', CHECKS, ids=[name for name, _ in CHECKS])
+def test_query_avoids_seq_scan_of_large_tables(seeded, name, build):
+    cursor, reltuples = seeded
+    since = (datetime.now() - timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
+    query, params = build(since)
+    cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    assert find_seq_scans(plan[0]['Plan'], reltuples, PLAN_SEQ_SCAN_THRESHOLD) == []
@@ -0,0 +1,63 @@
+"""
+Tests for the RTT quantile sketch: accuracy, merging and serialization.
+"""
+import random
+import pytest
+
+from rtt_sketch import RttSketch, RTT_SKETCH_ACCURACY, merge_sketches, percentiles
+
+
+def exact_quantile(values, q):
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def sketch_of(values):
+    sketch = RttSketch()
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+@pytest.mark.parametrize('q', [0, 0.5, 0.95, 0.99, 1])
+def test_quantiles_are_within_the_relative_accuracy(q):
+    rng = random.Random(7)
+    values = [rng.lognormvariate(4, 1.2) for _ in range(5000)]
+    expected = exact_quantile(values, q)
+    assert sketch_of(values).quantile(q) == pytest.approx(expected, rel=RTT_SKETCH_ACCURACY)
+
+
+def test_empty_sketch_and_zero_values():
+    assert RttSketch().quantile(0.5) is None
+    sketch = sketch_of([0, 0, 0, 10])
+    assert sketch.count == 4
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1) == pytest.approx(10, rel=RTT_SKETCH_ACCURACY)
+
+
+def test_merge_equals_sketch_of_all_values():
+    first = [1, 5, 20, 300]
+    second = [0, 2, 40, 40, 9000]
+    merged = sketch_of(first).merge(sketch_of(second))
+    combined = sketch_of(first + second)
+    assert merged.bins == combined.bins
+    assert merged.zero_count == combined.zero_count
+
+
+def test_round_trip_through_bytes_keeps_every_bin():
+    # Values from sub-millisecond to far beyond any RTT, so bin indexes exceed 16 bits
+    sketch = sketch_of([0, 0.001, 0.5, 1, 12.5, 800, 1e6, 1e300])
+    assert max(sketch.bins) > 32767
+    restored = RttSketch.from_bytes(sketch.to_bytes())
+    assert restored.bins == sketch.bins
+    assert restored.zero_count == sketch.zero_count
+
+
+def test_merge_sketches_and_percentiles():
+    blobs = [sketch_of([10] * 50).to_bytes(), sketch_of([100] * 50).to_bytes(), RttSketch().to_bytes()]
+    merged = merge_sketches(blobs)
+    assert merged.count == 100
+    result = percentiles(merged)
+    assert result['response_time_p50'] == pytest.approx(10, rel=RTT_SKETCH_ACCURACY)
+    assert result['response_time_p99'] == pytest.approx(100, rel=RTT_SKETCH_ACCURACY)
+    assert percentiles(RttSketch()) == {'response_time_p50': 0, 'response_time_p95': 0, 'response_time_p99': 0}
@@ -0,0 +1,98 @@
+"""
+Tests for the latest-state snapshot: file layout, paging, publishing and
+mapping the file from another store.
+"""
+import json
+import os
+import time
+import pytest
+
+from snapshot import Snapshot, SnapshotStore, SnapshotPublisher, encode_rows, pack
+
+
+ROWS = [{'pr_code': f'PR{index}', 'site_name': f'Site "{index}"', 'ping_success': index % 2 == 0} for index in range(5)]
+
+
+def snapshot_of(rows):
+    body, index = encode_rows(rows)
+    return Snapshot(pack({'rows': body, 'rows.idx': index}, time.time()))
+
+
+@pytest.mark.parametrize('limit, offset', [(5, 0), (2, 0), (2, 2), (2, 4), (10, 3), (0, 0), (3, 5), (3, -1)])
+def test_pages_match_slicing(limit, offset):
+    data, count = snapshot_of(ROWS).page('rows', limit, offset)
+    expected = ROWS[max(offset, 0):max(offset, 0) + limit]
+    assert json.loads(data) == expected
+    assert count == len(expected)
+
+
+def test_empty_row_section():
+    assert snapshot_of([]).page('rows', 10) == (b'[]', 0)
+
+
+def test_sections_and_header():
+    snapshot = Snapshot(pack({'summary': b'{"a":1}', 'length_loggers.idx': b''}, 1234.5))
+    assert snapshot.created_at == 1234.5
+    assert bytes(snapshot.section('summary')) == b'{"a":1}'
+    assert bytes(snapshot.section('length_loggers.idx')) == b''
+
+
+def test_invalid_files_and_names_are_rejected():
+    with pytest.raises(ValueError):
+        Snapshot(b'NOPE' + bytes(100))
+    with pytest.raises(ValueError):
+        pack({'x' * 33: b''}, time.time())
+
+
+def test_store_maps_the_published_file(tmp_path):
+    path = str(tmp_path / 'snapshot' / 'latest.snap')
+    publisher_store = SnapshotStore(path)
+    reader = SnapshotStore(path)
+    assert reader.latest() is None
+
+    publisher_store.publish({'summary': b'first'})
+    assert bytes(reader.latest().section('summary')) == b'first'
+    # A replaced file is mapped again
+    publisher_store.publish({'summary': b'second'})
+    assert bytes(reader.latest().section('summary')) == b'second'
+    assert os.listdir(tmp_path / 'snapshot') == ['latest.snap']
+
+
+def test_stale_snapshots_are_not_served(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'latest.snap'))
+    store.publish({'summary': b'{}'}, created_at=time.time() - 120)
+    assert store.latest(max_age=60) is None
+    assert store.latest(max_age=600) is not None
+
+
+def test_store_without_path_serves_from_memory():
+    store = SnapshotStore('')
+    assert store.latest() is None
+    store.publish({'summary': b'{}'})
+    assert store.latest() is not None
+
+
+def test_publisher_builds_summary_and_pages(tmp_path):
+    results = [
+        {'timestamp': '2024-01-01 00:00:00', 'pr_code': 'A', 'site_name': 'a', 'ip_address': '10.0.0.1',
+         'ping_success': True, 'ping_time_ms': 20, 'length_loggers': 4},
+        {'timestamp': '2024-01-01 00:00:05', 'pr_code': 'B', 'site_name': 'b', 'ip_address': '10.0.0.2',
+         'ping_success': False, 'ping_time_ms': None, 'length_loggers': None,
+         'upstream_down': True, 'outage_group': 'gw:1'},
+    ]
+    publisher = SnapshotPublisher(SnapshotStore(str(tmp_path / 'latest.snap')), last_loggers={'10.0.0.2': 7}.get)
+    snapshot = publisher.publish(results)
+
+    response = json.loads(bytes(snapshot.section('summary')))
+    assert response['data']['summary']['total_sites'] == 2
+    assert response['data']['summary']['sites_up'] == 1
+    assert response['data']['summary']['source'] == 'snapshot'
+    (down,) = response['data']['down_sites']
+    assert (down['pr_code'], down['outage_group'], down['upstream_down']) == ('B', 'gw:1', True)
+
+    # Rows are latest first; a down site keeps its last known logger count
+    ping_logs, count = snapshot.page('ping_logs', 10)
+    assert count == 2
+    assert [row['pr_code'] for row in json.loads(ping_logs)] == ['B', 'A']
+    length_loggers, _ = snapshot.page('length_loggers', 10)
+    assert [row['length_loggers'] for row in json.loads(length_loggers)] == [7, 4]
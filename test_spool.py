@@ -0,0 +1,127 @@
+"""
+Tests for the write spool: record framing, torn and corrupt tails, segment
+lifecycle and replay. The replayer commits to the replay_batches fixture in
+place of the database.
+"""
+import os
+import pytest
+
+import spool
+from spool import WriteSpool, SpoolReplayer, OPEN_SUFFIX, SEALED_SUFFIX, _HEADER
+
+
+def ping_log(pr_code):
+    return {'timestamp': '2024-01-01 00:00:00', 'pr_code': pr_code, 'ping_success': True}
+
+
+def write_segment(directory, records):
+    """Spool records and seal them; returns the sealed segment's path"""
+    write_spool = WriteSpool(str(directory))
+    for record in records:
+        assert write_spool.append('ping_log', record)
+    write_spool.seal()
+    names = [name for name in os.listdir(directory) if name.endswith(SEALED_SUFFIX)]
+    assert len(names) == 1
+    return os.path.join(directory, names[0])
+
+
+class Batches(list):
+    """Stands in for the database: keeps committed batches and rejects them while rejecting is set"""
+    rejecting = False
+
+    def check_connection(self):
+        return True
+
+    def replay_spooled_writes(self, batch):
+        if self.rejecting:
+            return False
+        self.append(list(batch))
+        return True
+
+
+@pytest.fixture
+def replay_batches():
+    return Batches()
+
+
+def test_records_are_read_back_in_order(tmp_path):
+    write_spool = WriteSpool(str(tmp_path))
+    for pr_code in ('A', 'B', 'C'):
+        assert write_spool.append('ping_log', ping_log(pr_code))
+    write_spool.seal()
+    name = write_spool.claim()
+    assert [record['args']['pr_code'] for record in write_spool.read(name)] == ['A', 'B', 'C']
+    assert all(record['kind'] == 'ping_log' for record in write_spool.read(name))
+
+
+def test_torn_tail_is_skipped(tmp_path):
+    path = write_segment(tmp_path, [ping_log('A'), ping_log('B')])
+    with open(path, 'ab') as f:
+        f.write(_HEADER.pack(100, 0) + b'{"kind"')
+    write_spool = WriteSpool(str(tmp_path))
+    name = write_spool.claim()
+    assert [record['args']['pr_code'] for record in write_spool.read(name)] == ['A', 'B']
+
+
+def test_corrupt_record_stops_the_segment(tmp_path):
+    path = write_segment(tmp_path, [ping_log('A'), ping_log('B'), ping_log('C')])
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    # Flip a payload byte of the second record; its CRC no longer matches
+    first_length = _HEADER.unpack_from(data, 0)[0]
+    data[_HEADER.size * 2 + first_length + 2] ^= 0xFF
+    with open(path, 'wb') as f:
+        f.write(data)
+    write_spool = WriteSpool(str(tmp_path))
+    name = write_spool.claim()
+    assert [record['args']['pr_code'] for record in write_spool.read(name)] == ['A']
+
+
+def test_full_spool_drops_writes(tmp_path):
+    write_spool = WriteSpool(str(tmp_path), max_bytes=200)
+    results = [write_spool.append('ping_log', ping_log(f'PR{index}')) for index in range(10)]
+    assert results[0] is True
+    assert results[-1] is False
+    assert write_spool.backlog()[0] <= 200
+
+
+def test_open_segment_of_a_dead_process_is_recovered(tmp_path):
+    write_spool = WriteSpool(str(tmp_path))
+    write_spool.append('ping_log', ping_log('A'))
+    write_spool.flush()
+    # Pretend the open segment belongs to a process that no longer exists
+    (name,) = os.listdir(tmp_path)
+    assert name.endswith(OPEN_SUFFIX)
+    orphan = name.replace(f"-{os.getpid()}{OPEN_SUFFIX}", f"-999999999{OPEN_SUFFIX}")
+    os.rename(tmp_path / name, tmp_path / orphan)
+    WriteSpool(str(tmp_path))
+    assert os.listdir(tmp_path) == [orphan[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX]
+
+
+def test_replay_commits_in_batches_and_removes_segments(tmp_path, monkeypatch, replay_batches):
+    monkeypatch.setattr(spool, 'SPOOL_REPLAY_BATCH', 2)
+    write_spool = WriteSpool(str(tmp_path))
+    for pr_code in ('A', 'B', 'C'):
+        write_spool.append('ping_log', ping_log(pr_code))
+    write_spool.flush()
+    assert SpoolReplayer(write_spool, replay_batches).replay() == 3
+    assert [[record['args']['pr_code'] for record in batch] for batch in replay_batches] == [['A', 'B'], ['C']]
+    assert os.listdir(tmp_path) == []
+    # Writes after a replay go to a new segment
+    write_spool.append('ping_log', ping_log('D'))
+    write_spool.flush()
+    assert SpoolReplayer(write_spool, replay_batches).replay() == 1
+
+
+def test_rejected_replay_keeps_the_segment(tmp_path, replay_batches):
+    write_spool = WriteSpool(str(tmp_path))
+    write_spool.append('ping_log', ping_log('A'))
+    write_spool.flush()
+    replay_batches.rejecting = True
+    with pytest.raises(IOError):
+        SpoolReplayer(write_spool, replay_batches).replay()
+    (name,) = os.listdir(tmp_path)
+    assert name.endswith(SEALED_SUFFIX)
+    replay_batches.rejecting = False
+    assert SpoolReplayer(write_spool, replay_batches).replay() == 1
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,90 @@
+"""
+Tests for the sweep archive: block index, site lookups, rotation and pruning.
+"""
+import os
+import time
+import pytest
+
+import sweep_archive
+from sweep_archive import SweepArchive, summarize_results, DATA_SUFFIX, INDEX_SUFFIX
+
+
+def sweep_results(count, ping_success=True):
+    return [
+        {'pr_code': f'PR{index:03d}', 'ping_success': ping_success, 'ping_time_ms': 10 + index, 'length_loggers': 2}
+        for index in range(count)
+    ]
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(sweep_archive, 'ARCHIVE_BLOCK_SITES', 4)
+    return SweepArchive(str(tmp_path))
+
+
+def test_sweep_is_read_back_sorted_by_pr_code(archive):
+    results = sweep_results(10)
+    sweep_id = archive.append_sweep(list(reversed(results)), swept_at=1000.0)
+    assert sweep_id == 1000000
+    assert archive.read_sweep() == results
+    assert archive.read_sweep(sweep_id) == results
+    assert archive.list_sweeps() == [{'sweep_id': sweep_id, 'swept_at': 1000.0, 'sites': 10}]
+
+
+def test_blocks_are_indexed_by_pr_code_range(archive):
+    archive.append_sweep(sweep_results(10), swept_at=1000.0)
+    blocks = archive._sweep_blocks()
+    assert [(block.first_pr_code, block.last_pr_code, block.sites) for block in blocks] == [
+        ('PR000', 'PR003', 4), ('PR004', 'PR007', 4), ('PR008', 'PR009', 2),
+    ]
+
+
+def test_find_site_in_latest_and_older_sweeps(archive):
+    archive.append_sweep(sweep_results(10, ping_success=False), swept_at=1000.0)
+    archive.append_sweep(sweep_results(10), swept_at=2000.0)
+    assert archive.find_site('PR005')['ping_success'] is True
+    assert archive.find_site('PR005', 1000000)['ping_success'] is False
+    assert archive.find_site('PR999') is None
+    assert archive.find_site('PR000', 3000000) is None
+    assert [sweep['sweep_id'] for sweep in archive.list_sweeps()] == [2000000, 1000000]
+
+
+def test_unindexed_tail_is_ignored(archive, tmp_path):
+    archive.append_sweep(sweep_results(3), swept_at=1000.0)
+    (name,) = [name for name in os.listdir(tmp_path) if name.endswith(INDEX_SUFFIX)]
+    # A crash after the data write leaves a partial index record behind
+    with open(tmp_path / name, 'ab') as f:
+        f.write(b'\x01\x02\x03')
+    with open(tmp_path / (name[:-len(INDEX_SUFFIX)] + DATA_SUFFIX), 'ab') as f:
+        f.write(b'garbage')
+    assert archive.read_sweep() == sweep_results(3)
+
+
+def test_segments_rotate_by_size_and_are_pruned(archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(sweep_archive, 'ARCHIVE_SEGMENT_BYTES', 1)
+    monkeypatch.setattr(sweep_archive, 'ARCHIVE_MAX_SEGMENTS', 2)
+    for swept_at in (1000.0, 2000.0, 3000.0):
+        archive.append_sweep(sweep_results(2), swept_at=swept_at)
+        # Segment names are millisecond timestamps
+        time.sleep(0.002)
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(INDEX_SUFFIX)]) == 2
+    assert [sweep['sweep_id'] for sweep in archive.list_sweeps()] == [3000000, 2000000]
+    assert archive.read_sweep(1000000) == []
+    assert archive.find_site('PR001', 2000000)['pr_code'] == 'PR001'
+
+
+def test_summarize_results():
+    results = sweep_results(3) + [
+        {'pr_code': 'DOWN', 'ping_success': False, 'ping_time_ms': None, 'length_loggers': None},
+        {'pr_code': 'SKIPPED', 'ping_success': False, 'ping_time_ms': None, 'length_loggers': None, 'upstream_down': True},
+    ]
+    summary = summarize_results(results)
+    assert summary['total_sites'] == 5
+    assert summary['sites_up'] == 3
+    assert summary['sites_down'] == 2
+    assert summary['sites_upstream_down'] == 1
+    assert summary['uptime_percentage'] == 60.0
+    assert summary['average_response_time'] == 11.0
+    assert summary['sites_with_loggers'] == 3
+    assert summary['average_loggers_per_site'] == 2.0
+    assert summarize_results([])['uptime_percentage'] == 0
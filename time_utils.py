@@ -0,0 +1,24 @@
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+def convert_to_jakarta_time(timestamp_str):
+    """Convert a timestamp string to Jakarta time (UTC+7)"""
+    if not timestamp_str:
+        return timestamp_str
+
+    try:
+        # Check if timestamp is already in Jakarta time
+        if datetime.now().astimezone().utcoffset() == timedelta(hours=7):
+            # System is already in Jakarta timezone
+            return timestamp_str
+        else:
+            # Convert UTC time to Jakarta time
+            dt = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
+            jakarta_dt = dt + timedelta(hours=7)
+            return jakarta_dt.strftime('%Y-%m-%d %H:%M:%S')
+    except Exception as e:
+        logger.error("Error converting timestamp to Jakarta time: %s", e)
+        return timestamp_str